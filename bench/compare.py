@@ -0,0 +1,96 @@
+"""Compare two load-test reports, e.g. from before and after a change:
+
+    python -m bench.compare base.json head.json
+"""
+
+import argparse
+import json
+from typing import Optional
+
+# (label, path into the report, True if higher is better)
+METRICS = (
+    ("throughput_rps", ("throughput_rps",), True),
+    ("latency p50", ("latency_seconds", "p50"), False),
+    ("latency p95", ("latency_seconds", "p95"), False),
+    ("latency p99", ("latency_seconds", "p99"), False),
+    ("ok latency p95", ("ok_latency_seconds", "p95"), False),
+    ("ok rate", ("rates", "ok"), True),
+    ("queue_full rate", ("rates", "queue_full"), False),
+    ("change_in_progress rate", ("rates", "change_in_progress"), False),
+    ("generation_error rate", ("rates", "generation_error"), False),
+    ("model_unavailable rate", ("rates", "model_unavailable"), False),
+    ("peak traced memory", ("peak_traced_memory_bytes",), False),
+    ("max rss", ("max_rss_bytes",), False),
+)
+
+
+def _lookup(report: dict, path: tuple[str, ...]) -> Optional[float]:
+    value = report
+    for part in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def compare(base: dict, head: dict) -> list[dict]:
+    rows = []
+    for label, path, higher_is_better in METRICS:
+        old = _lookup(base, path)
+        new = _lookup(head, path)
+        if old is None and new is None:
+            continue
+        change = None
+        if old and new is not None:
+            change = (new - old) / old
+        rows.append(
+            {
+                "metric": label,
+                "base": old,
+                "head": new,
+                "change": change,
+                "higher_is_better": higher_is_better,
+            }
+        )
+    return rows
+
+
+def format_rows(rows: list[dict]) -> str:
+    lines = [f"{'metric':<26}{'base':>14}{'head':>14}{'change':>10}"]
+    for row in rows:
+        change = "" if row["change"] is None else f"{row['change']:+.1%}"
+        lines.append(
+            f"{row['metric']:<26}{_fmt(row['base']):>14}{_fmt(row['head']):>14}{change:>10}"
+        )
+    return "\n".join(lines)
+
+
+def _fmt(value: Optional[float]) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, int):
+        return str(value)
+    return f"{value:.4g}"
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Compare two rengabot load-test reports")
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--json", action="store_true", help="print the rows as JSON")
+    args = parser.parse_args(argv)
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    rows = compare(base, head)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        commits = (base.get("commit") or "?")[:10], (head.get("commit") or "?")[:10]
+        print(f"{commits[0]} -> {commits[1]}")
+        print(format_rows(rows))
+
+
+if __name__ == "__main__":
+    main()
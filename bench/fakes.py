@@ -0,0 +1,287 @@
+import asyncio
+import io
+import random
+import threading
+import time
+import types
+
+from PIL import Image
+
+
+class LatencyDistribution:
+    """Log-normal latency with the given median, which is a decent fit for
+    remote model calls: most are close to the median with a long tail."""
+
+    def __init__(self, median: float, sigma: float = 0.5, rng: random.Random = None):
+        self.median = median
+        self.sigma = sigma
+        self.rng = rng or random.Random()
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * self.rng.lognormvariate(0, self.sigma)
+
+
+class FakeModelError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeModel:
+    """Stand-in for an AIModel with configurable latency and failure rates.
+    Generated images are a small real PNG so the output pipeline does real work."""
+
+    def __init__(
+        self,
+        validation_latency: float = 0.3,
+        generation_latency: float = 8.0,
+        sigma: float = 0.5,
+        invalid_rate: float = 0.1,
+        error_rate: float = 0.02,
+        image_side: int = 256,
+        seed: int = 0,
+    ):
+        self.rng = random.Random(seed)
+        self.validation_latency = LatencyDistribution(validation_latency, sigma, self.rng)
+        self.generation_latency = LatencyDistribution(generation_latency, sigma, self.rng)
+        self.invalid_rate = invalid_rate
+        self.error_rate = error_rate
+        out = io.BytesIO()
+        Image.effect_noise((image_side, image_side), 32).convert("RGB").save(out, format="PNG")
+        self.image_bytes = out.getvalue()
+        self.validate_calls = 0
+        self.generate_calls = 0
+
+    def _verdict(self):
+        self.validate_calls += 1
+        if self.rng.random() < self.invalid_rate:
+            return (False, "that's two changes")
+        return (True, None)
+
+    def _image(self):
+        self.generate_calls += 1
+        if self.rng.random() < self.error_rate:
+            raise FakeModelError(503, "UNAVAILABLE")
+        return self.image_bytes
+
+    def validate_prompt(self, prompt):
+        time.sleep(self.validation_latency.sample())
+        return self._verdict()
+
+    def generate_image(self, prompt, image_path):
+        time.sleep(self.generation_latency.sample())
+        return self._image()
+
+    async def validate_prompt_async(self, prompt):
+        await asyncio.sleep(self.validation_latency.sample())
+        return self._verdict()
+
+    async def generate_image_async(self, prompt, image_path):
+        await asyncio.sleep(self.generation_latency.sample())
+        return self._image()
+
+
+class FakeRedis:
+    """In-process stand-in for the few Redis commands the lock manager uses.
+    Scripts are matched by text and run as their Python equivalents."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: dict[str, bytes] = {}
+        self._expires: dict[str, float] = {}
+
+    def get(self, name):
+        with self._lock:
+            return self._get(name)
+
+    def set(self, name, value, nx=False, px=None):
+        with self._lock:
+            if nx and self._get(name) is not None:
+                return None
+            self._data[name] = _encode(value)
+            self._expires.pop(name, None)
+            if px is not None:
+                self._expires[name] = time.monotonic() + px / 1000.0
+            return True
+
+    def incr(self, name):
+        with self._lock:
+            value = int(self._get(name) or 0) + 1
+            self._data[name] = str(value).encode()
+            return value
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._delete(n) for n in names)
+
+    def pexpire(self, name, ms):
+        with self._lock:
+            if self._get(name) is None:
+                return 0
+            self._expires[name] = time.monotonic() + int(ms) / 1000.0
+            return 1
+
+    def eval(self, script, numkeys, *args):
+        from game.locks import RELEASE_SCRIPT, RENEW_SCRIPT
+
+        if script not in (RELEASE_SCRIPT, RENEW_SCRIPT):
+            raise NotImplementedError("unknown script")
+        keys, argv = args[:numkeys], args[numkeys:]
+        with self._lock:
+            if self._get(keys[0]) != _encode(argv[0]):
+                return 0
+            if script == RELEASE_SCRIPT:
+                return self._delete(keys[0])
+            self._expires[keys[0]] = time.monotonic() + int(argv[1]) / 1000.0
+            return 1
+
+    def _get(self, name):
+        expires = self._expires.get(name)
+        if expires is not None and expires <= time.monotonic():
+            self._delete(name)
+        return self._data.get(name)
+
+    def _delete(self, name) -> int:
+        self._expires.pop(name, None)
+        return 1 if self._data.pop(name, None) is not None else 0
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakeS3Error(Exception):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3:
+    """In-process stand-in for the S3 client calls the object storage makes,
+    in the spirit of a local MinIO. Multipart parts are kept until the upload
+    is completed or aborted."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.objects: dict[tuple[str, str], bytes] = {}
+        self.uploads: dict[str, dict[int, bytes]] = {}
+        self.calls: dict[str, int] = {}
+
+    def _count(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None):
+        with self._lock:
+            self._count("put_object")
+            if IfNoneMatch == "*" and (Bucket, Key) in self.objects:
+                raise FakeS3Error("PreconditionFailed")
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {"ETag": str(hash(bytes(Body)))}
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            self._count("get_object")
+            data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise FakeS3Error("NoSuchKey")
+        return {"Body": io.BytesIO(data)}
+
+    def head_object(self, Bucket, Key):
+        with self._lock:
+            self._count("head_object")
+            data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise FakeS3Error("404")
+        return {"ContentLength": len(data)}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000):
+        with self._lock:
+            self._count("list_objects_v2")
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start : start + MaxKeys]
+        response = {"Contents": [{"Key": k} for k in page], "IsTruncated": False}
+        if start + MaxKeys < len(keys):
+            response["IsTruncated"] = True
+            response["NextContinuationToken"] = str(start + MaxKeys)
+        return response
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"{Bucket}/{Key}/{random.getrandbits(32)}"
+        with self._lock:
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self._count("upload_part")
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"part-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            parts = self.uploads.pop(UploadId)
+            numbers = [p["PartNumber"] for p in MultipartUpload["Parts"]]
+            self.objects[(Bucket, Key)] = b"".join(parts[n] for n in numbers)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class FakeRengabot:
+    def __init__(self, model, service):
+        self.model = model
+        self.service = service
+
+
+class FakeSlackClient:
+    """Records what the Slack handlers send, with optional upload latency."""
+
+    def __init__(self, upload_latency: float = 0.0):
+        self.upload_latency = upload_latency
+        self.uploads = []
+        self.messages = []
+
+    async def files_upload_v2(self, **kwargs):
+        await asyncio.sleep(self.upload_latency)
+        self.uploads.append(kwargs)
+
+    async def chat_postMessage(self, **kwargs):
+        self.messages.append(kwargs)
+
+    async def chat_postEphemeral(self, **kwargs):
+        self.messages.append(kwargs)
+
+
+class FakeDiscordChannel:
+    def __init__(self, channel_id: int, upload_latency: float = 0.0):
+        self.id = channel_id
+        self.upload_latency = upload_latency
+        self.sent = []
+
+    async def send(self, content=None, file=None, **kwargs):
+        if file is not None:
+            await asyncio.sleep(self.upload_latency)
+        self.sent.append({"content": content, "file": file})
+
+
+def fake_discord_message(guild_id: int, channel: FakeDiscordChannel, user_id: int):
+    return types.SimpleNamespace(
+        id=random.getrandbits(48),
+        guild=types.SimpleNamespace(id=guild_id),
+        channel=channel,
+        author=types.SimpleNamespace(id=user_id, bot=False),
+    )
+
+
+NULL_LOGGER = types.SimpleNamespace(
+    exception=lambda *a, **k: None,
+    info=lambda *a, **k: None,
+)
@@ -0,0 +1,143 @@
+"""Cold-start import benchmark.
+
+Imports the bot's entry points in fresh interpreters and reports how long
+each took and which heavy SDKs got pulled in:
+
+    python -m bench.imports --runs 5 --out imports.json
+    python -m bench.imports --budget-ms 400   # exit 1 if `import main` is slower
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only load once the platform or model using them does.
+HEAVY_MODULES = ("slack_bolt", "discord", "aiohttp", "google.genai", "httpx")
+
+SCENARIOS = {
+    "main": "import main",
+    "slack": "import main, messengers.slack",
+    "discord": "import main, messengers.discord",
+    "gemini": "import main, model.gemini",
+    "gemini_client": "import main, model.gemini, google.genai",
+}
+
+_CHILD = """
+import json, sys, time
+started = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    "import_seconds": elapsed,
+    "heavy_modules": [m for m in {heavy!r} if m in sys.modules],
+    "modules": len(sys.modules),
+}}))
+"""
+
+
+def measure(code: str, importtime: bool = False) -> dict:
+    args = [sys.executable]
+    if importtime:
+        args += ["-X", "importtime"]
+    script = _CHILD.format(code=code, heavy=HEAVY_MODULES)
+    started = time.perf_counter()
+    proc = subprocess.run(
+        args + ["-c", script],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - started
+    if importtime:
+        result["slowest"] = _slowest_imports(proc.stderr)
+    return result
+
+
+def _slowest_imports(stderr: str, limit: int = 15) -> list[dict]:
+    """Modules with the largest cumulative time from -X importtime."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append(
+            {"module": name.strip(), "cumulative_ms": int(cumulative_us) / 1000.0}
+        )
+    rows.sort(key=lambda r: r["cumulative_ms"], reverse=True)
+    return rows[:limit]
+
+
+def run(scenarios: list[str], runs: int, importtime: bool) -> dict:
+    report = {"python": sys.version.split()[0], "runs": runs, "scenarios": {}}
+    for name in scenarios:
+        samples = [measure(SCENARIOS[name]) for _ in range(runs)]
+        imports = [s["import_seconds"] for s in samples]
+        processes = [s["process_seconds"] for s in samples]
+        entry = {
+            "code": SCENARIOS[name],
+            "import_ms": _summary(imports),
+            "process_ms": _summary(processes),
+            "heavy_modules": samples[-1]["heavy_modules"],
+            "modules": samples[-1]["modules"],
+        }
+        if importtime:
+            entry["slowest"] = measure(SCENARIOS[name], importtime=True)["slowest"]
+        report["scenarios"][name] = entry
+    return report
+
+
+def _summary(seconds: list[float]) -> dict:
+    ms = [s * 1000.0 for s in seconds]
+    return {
+        "median": statistics.median(ms),
+        "min": min(ms),
+        "max": max(ms),
+    }
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Rengabot import-time benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--scenario", action="append", choices=sorted(SCENARIOS), help="default: all"
+    )
+    parser.add_argument("--importtime", action="store_true", help="list the slowest imports")
+    parser.add_argument("--budget-ms", type=float, help="fail if `import main` is slower")
+    parser.add_argument("--out", help="write the report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or list(SCENARIOS)
+    if args.budget_ms is not None and "main" not in scenarios:
+        scenarios.insert(0, "main")
+    report = run(scenarios, args.runs, args.importtime)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.budget_ms is not None:
+        main_report = report["scenarios"]["main"]
+        median = main_report["import_ms"]["median"]
+        if median > args.budget_ms or main_report["heavy_modules"]:
+            print(
+                f"import main took {median:.0f}ms (budget {args.budget_ms:.0f}ms), "
+                f"heavy modules loaded: {main_report['heavy_modules'] or 'none'}",
+                file=sys.stderr,
+            )
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,377 @@
+"""Load test for the change pipeline.
+
+Drives GameService directly or through the Slack/Discord handlers with fake
+clients and a fake model, and prints a JSON report:
+
+    python -m bench.load --target slack --channels 20 --users 100 --duration 30 \\
+        --out report.json
+    python -m bench.compare old.json report.json
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+from PIL import Image
+
+from bench.fakes import (
+    NULL_LOGGER,
+    FakeDiscordChannel,
+    FakeModel,
+    FakeRedis,
+    FakeRengabot,
+    FakeSlackClient,
+    fake_discord_message,
+)
+from game.service import GameService, outcome_for
+
+TARGETS = ("service", "slack", "discord")
+PROMPTS = (
+    "add a bird",
+    "make it a painting",
+    "give the man a hat",
+    "turn the sky purple",
+    "add a second moon",
+)
+
+# Leading text of the handler replies that carry details.
+QUEUED_PREFIX = GameService.format_queue_position(1).split(" behind")[0]
+INVALID_PREFIX = GameService.format_invalid_prompt("x").split(":")[0]
+UNAVAILABLE_PREFIX = GameService.format_model_unavailable(1).split(".")[0]
+
+
+class Arrival:
+    def __init__(self, at: float, channel: int, user: int, prompt: str):
+        self.at = at
+        self.channel = channel
+        self.user = user
+        self.prompt = prompt
+
+
+def arrival_schedule(
+    rng: random.Random,
+    duration: float,
+    burst_rate: float,
+    burst_size: float,
+    burst_spread: float,
+    channels: int,
+    users: int,
+    channel_skew: float,
+) -> list[Arrival]:
+    """Bursts start as a Poisson process and each lands on one channel, the
+    way a few people pile onto the same image. Burst sizes are geometric with
+    the given mean; channel popularity follows a Zipf-like curve."""
+    weights = [1.0 / (i + 1) ** channel_skew for i in range(channels)]
+    arrivals = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(burst_rate)
+        if t >= duration:
+            break
+        channel = rng.choices(range(channels), weights)[0]
+        size = 1
+        if burst_size > 1:
+            while rng.random() > 1.0 / burst_size:
+                size += 1
+        for _ in range(size):
+            arrivals.append(
+                Arrival(
+                    t + rng.uniform(0, burst_spread),
+                    channel,
+                    rng.randrange(users),
+                    rng.choice(PROMPTS),
+                )
+            )
+    arrivals.sort(key=lambda a: a.at)
+    return arrivals
+
+
+def channel_key(target: str, channel: int) -> tuple[str, str, str]:
+    if target == "discord":
+        return ("discord", "1", str(channel))
+    return (target, "w", f"c{channel}")
+
+
+def percentile(values: list[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _message_outcome(service: GameService, text: str) -> str:
+    if text == service.NO_IMAGE_MESSAGE:
+        return "no_image"
+    if text == service.QUEUE_FULL_MESSAGE:
+        return "queue_full"
+    if text == service.CHANGE_IN_PROGRESS_MESSAGE:
+        return "change_in_progress"
+    if text == service.GENERATION_ERROR_MESSAGE:
+        return "generation_error"
+    if text.startswith(INVALID_PREFIX):
+        return "invalid_prompt"
+    if text.startswith(UNAVAILABLE_PREFIX):
+        return "model_unavailable"
+    return "error"
+
+
+def _service_driver(service: GameService) -> Callable:
+    async def drive(arrival: Arrival) -> tuple[str, bool]:
+        queued = False
+
+        async def on_queued(position: int):
+            nonlocal queued
+            queued = True
+
+        try:
+            await service.change_image_async(
+                *channel_key("service", arrival.channel),
+                f"u{arrival.user}",
+                arrival.prompt,
+                on_queued=on_queued,
+            )
+        except Exception as e:
+            return outcome_for(e), queued
+        return "ok", queued
+
+    return drive
+
+
+def _slack_driver(service: GameService, model, upload_latency: float) -> Callable:
+    from messengers.slack import SlackMessenger
+
+    messenger = SlackMessenger(
+        {"bot_token": "bench", "app_token": "bench"}, FakeRengabot(model, service)
+    )
+
+    async def drive(arrival: Arrival) -> tuple[str, bool]:
+        client = FakeSlackClient(upload_latency)
+        await messenger._handle_change_async(
+            client,
+            NULL_LOGGER,
+            f"u{arrival.user}",
+            "w",
+            f"c{arrival.channel}",
+            arrival.prompt,
+        )
+        texts = [m["text"] for m in client.messages]
+        return _handler_outcome(service, texts, bool(client.uploads))
+
+    return drive
+
+
+def _discord_driver(service: GameService, model, upload_latency: float) -> Callable:
+    from messengers.discord import DiscordMessenger
+
+    messenger = DiscordMessenger({"bot_token": "bench"}, FakeRengabot(model, service))
+
+    async def drive(arrival: Arrival) -> tuple[str, bool]:
+        channel = FakeDiscordChannel(arrival.channel, upload_latency)
+        message = fake_discord_message(1, channel, arrival.user)
+        await messenger._handle_change_message(message, arrival.prompt)
+        texts = [s["content"] for s in channel.sent if s["content"]]
+        uploaded = any(s["file"] is not None for s in channel.sent)
+        return _handler_outcome(service, texts, uploaded)
+
+    return drive
+
+
+def _handler_outcome(service: GameService, texts: list[str], uploaded: bool) -> tuple[str, bool]:
+    queued = any(t.startswith(QUEUED_PREFIX) for t in texts)
+    if uploaded:
+        return "ok", queued
+    if not texts:
+        return "error", queued
+    return _message_outcome(service, texts[-1]), queued
+
+
+def _base_image(side: int) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (side, side), (90, 140, 200)).save(out, format="PNG")
+    return out.getvalue()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    arrivals = arrival_schedule(
+        rng,
+        args.duration,
+        args.burst_rate,
+        args.burst_size,
+        args.burst_spread,
+        args.channels,
+        args.users,
+        args.channel_skew,
+    )
+    model = FakeModel(
+        validation_latency=args.validation_latency,
+        generation_latency=args.generation_latency,
+        sigma=args.latency_sigma,
+        invalid_rate=args.invalid_rate,
+        error_rate=args.error_rate,
+        image_side=args.image_side,
+        seed=args.seed,
+    )
+
+    with tempfile.TemporaryDirectory(prefix="rengabot-bench-") as uploads_dir:
+        service = GameService(
+            model,
+            uploads_dir=uploads_dir,
+            speculative=args.speculative,
+            queue_depth=args.queue_depth,
+            lock_backend=args.lock_backend,
+            lock_options={"client": FakeRedis()} if args.lock_backend == "redis" else None,
+            model_guard={} if args.model_guard else None,
+        )
+        base = _base_image(args.image_side)
+        for channel in range(args.channels):
+            service.save_image_bytes(*channel_key(args.target, channel), "admin", base)
+
+        if args.target == "slack":
+            drive = _slack_driver(service, model, args.upload_latency)
+        elif args.target == "discord":
+            drive = _discord_driver(service, model, args.upload_latency)
+        else:
+            drive = _service_driver(service)
+
+        async def timed(arrival: Arrival) -> tuple[str, bool, float]:
+            started = time.monotonic()
+            outcome, queued = await drive(arrival)
+            return outcome, queued, time.monotonic() - started
+
+        # Traced from here so module imports and channel setup don't count.
+        tracemalloc.start()
+        loop_start = time.monotonic()
+        tasks = []
+        for arrival in arrivals:
+            delay = loop_start + arrival.at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(timed(arrival)))
+        results = await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - loop_start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        service_stats = {
+            "speculation": service.speculation_stats(),
+            "image_cache": service.image_cache.stats(),
+            "locks": service.lock_manager.stats.snapshot(),
+        }
+
+    return _report(args, results, elapsed, peak_memory, service_stats, model)
+
+
+def _report(args, results, elapsed, peak_memory, service_stats, model) -> dict:
+    outcomes: dict[str, int] = {}
+    latencies = []
+    ok_latencies = []
+    queued = 0
+    for outcome, was_queued, latency in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        latencies.append(latency)
+        if outcome == "ok":
+            ok_latencies.append(latency)
+        queued += was_queued
+    total = len(results)
+    return {
+        "commit": _git_commit(),
+        "created_at": time.time(),
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "requests": total,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": (outcomes.get("ok", 0) / elapsed) if elapsed else 0.0,
+        "offered_rps": (total / elapsed) if elapsed else 0.0,
+        "latency_seconds": _latency_summary(latencies),
+        "ok_latency_seconds": _latency_summary(ok_latencies),
+        "outcomes": outcomes,
+        "rates": {name: count / total for name, count in outcomes.items()} if total else {},
+        "queued_rate": (queued / total) if total else 0.0,
+        "model_calls": {"validate": model.validate_calls, "generate": model.generate_calls},
+        "peak_traced_memory_bytes": peak_memory,
+        "max_rss_bytes": _max_rss_bytes(),
+        "service": service_stats,
+    }
+
+
+def _latency_summary(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": (sum(values) / len(values)) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def _max_rss_bytes() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Rengabot load test")
+    parser.add_argument("--target", choices=TARGETS, default="service")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="arrival window (s)")
+    parser.add_argument("--burst-rate", type=float, default=2.0, help="bursts per second")
+    parser.add_argument("--burst-size", type=float, default=3.0, help="mean requests per burst")
+    parser.add_argument("--burst-spread", type=float, default=0.5, help="burst width (s)")
+    parser.add_argument("--channel-skew", type=float, default=1.0)
+    parser.add_argument("--validation-latency", type=float, default=0.05, help="median (s)")
+    parser.add_argument("--generation-latency", type=float, default=0.5, help="median (s)")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--upload-latency", type=float, default=0.0)
+    parser.add_argument("--invalid-rate", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--image-side", type=int, default=256)
+    parser.add_argument("--queue-depth", type=int, default=3)
+    parser.add_argument("--speculative", action="store_true")
+    parser.add_argument(
+        "--model-guard", action="store_true", help="enable the limiter and circuit breaker"
+    )
+    parser.add_argument("--lock-backend", choices=("file", "memory", "redis"), default="file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the report here instead of stdout")
+    return parser
+
+
+def main(argv=None) -> None:
+    args = build_parser().parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
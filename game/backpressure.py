@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_overload(e: BaseException) -> bool:
+    """Whether the backend told us to slow down (HTTP 429 / RESOURCE_EXHAUSTED)."""
+    if getattr(e, "code", None) == 429:
+        return True
+    return "RESOURCE_EXHAUSTED" in str(e)
+
+
+def is_backend_failure(e: BaseException) -> bool:
+    """Errors that say the backend is unhealthy rather than that this one
+    request was bad: overload, 5xx responses, timeouts and dropped
+    connections. Works on any model's exceptions that carry an HTTP code."""
+    if is_overload(e):
+        return True
+    code = getattr(e, "code", None)
+    if isinstance(code, int) and code >= 500:
+        return True
+    return isinstance(e, (TimeoutError, asyncio.TimeoutError, ConnectionError))
+
+
+class _Waiter:
+    def __init__(self, wake: Callable[[], None]):
+        self.wake = wake
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for calls to one backend. Each success while
+    the limit is saturated raises it by 1/limit (about +1 per round of
+    calls); an overload response or a call slower than latency_target cuts
+    it by decrease_factor, at most once per decrease_interval so one burst
+    of failures doesn't collapse it to the floor.
+
+    Callers over the limit wait in FIFO order. Waiters may be threads or
+    coroutines on any event loop, since each messenger runs its own."""
+
+    def __init__(
+        self,
+        initial_limit: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        decrease_factor: float = 0.5,
+        decrease_interval: float = 1.0,
+        latency_target: Optional[float] = None,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._waiters: deque[_Waiter] = deque()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        event = threading.Event()
+        with self._lock:
+            if self._take_locked():
+                return True
+            waiter = _Waiter(event.set)
+            self._waiters.append(waiter)
+        if event.wait(timeout):
+            return True
+        return not self._withdraw(waiter)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> bool:
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_resolve, granted)
+
+        with self._lock:
+            if self._take_locked():
+                return True
+            waiter = _Waiter(wake)
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return not self._withdraw(waiter)
+        except BaseException:
+            if not self._withdraw(waiter):
+                # The slot was handed to us just as we were cancelled.
+                self.release()
+            raise
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False) -> None:
+        """Give the slot back. Pass the call's latency and whether the backend
+        pushed back to adapt the limit; a bare release (e.g. a cancelled call)
+        leaves the limit alone."""
+        with self._lock:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if overloaded or (
+                latency is not None
+                and self.latency_target is not None
+                and latency > self.latency_target
+            ):
+                self._decrease_locked()
+            elif latency is not None and saturated:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.increases += 1
+            woken = self._admit_locked()
+        for waiter in woken:
+            waiter.wake()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "waiting": len(self._waiters),
+                "increases": self.increases,
+                "decreases": self.decreases,
+            }
+
+    def _take_locked(self) -> bool:
+        if self._waiters or self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    def _admit_locked(self) -> list[_Waiter]:
+        woken = []
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            woken.append(self._waiters.popleft())
+        return woken
+
+    def _decrease_locked(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_interval:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        self.decreases += 1
+
+    def _withdraw(self, waiter: _Waiter) -> bool:
+        """Leave the wait queue. False means a slot was already handed over."""
+        with self._lock:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                return False
+            return True
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive backend failures, so calls
+    fail fast instead of queueing behind a backend that is down. After
+    reset_timeout it lets up to `probes` calls through; one success closes
+    it again and a failure re-opens it for another reset_timeout."""
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        probes: int = 1,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> Optional[float]:
+        """Seconds until a call could be let through, or None if one can go
+        now. Does not admit anything."""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    return remaining
+            elif self.state == HALF_OPEN and self._probes_in_flight >= self.probes:
+                return self.reset_timeout
+            return None
+
+    def allow(self) -> Optional[float]:
+        """Admit a call (None) or return the seconds until one could be."""
+        with self._lock:
+            if self.state == CLOSED:
+                return None
+            if self.state == OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    return remaining
+                self.state = HALF_OPEN
+                self._probes_in_flight = 0
+            if self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                return None
+            self.rejected += 1
+            return self.reset_timeout
+
+    def record(self, success: Optional[bool]) -> None:
+        """Report how an admitted call went; None for calls that were
+        abandoned without an answer."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if success:
+                    self.state = CLOSED
+                    self.failures = 0
+                    logger.info("Model circuit closed", extra={"operation": self.name})
+                elif success is False:
+                    self._open_locked()
+                return
+            if success:
+                self.failures = 0
+            elif success is False:
+                self.failures += 1
+                if self.state == CLOSED and self.failures >= self.failure_threshold:
+                    self._open_locked()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+    def _open_locked(self) -> None:
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self.opened += 1
+        logger.warning(
+            "Model circuit opened",
+            extra={"operation": self.name, "failures": self.failures},
+        )
+
+
+class ModelGuard:
+    """Circuit breaker plus adaptive limiter for one kind of model call.
+    admit() returns None once the call may start, or the number of seconds
+    the caller should tell the user to wait."""
+
+    def __init__(
+        self,
+        name: str,
+        max_wait: float = 30.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        probes: int = 1,
+        **limiter_args,
+    ):
+        self.name = name
+        self.max_wait = max_wait
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout, probes)
+        self.limiter = AdaptiveLimiter(**limiter_args)
+
+    def admit(self) -> Optional[float]:
+        refused = self.breaker.allow()
+        if refused is not None:
+            return refused
+        if not self.limiter.acquire(self.max_wait):
+            self.breaker.record(None)
+            return self.max_wait
+        return None
+
+    async def admit_async(self) -> Optional[float]:
+        refused = self.breaker.allow()
+        if refused is not None:
+            return refused
+        try:
+            acquired = await self.limiter.acquire_async(self.max_wait)
+        except BaseException:
+            self.breaker.record(None)
+            raise
+        if not acquired:
+            self.breaker.record(None)
+            return self.max_wait
+        return None
+
+    def done(self, latency: float, error: Optional[BaseException]) -> None:
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            self.limiter.release()
+            self.breaker.record(None)
+            return
+        self.limiter.release(latency, overloaded=error is not None and is_overload(error))
+        self.breaker.record(not (error is not None and is_backend_failure(error)))
+
+    def stats(self) -> dict:
+        return {"breaker": self.breaker.stats(), "limiter": self.limiter.stats()}
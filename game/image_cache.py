@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class CachedImage:
+    def __init__(self, path: str, data: bytes, mime_type: str):
+        self.path = path
+        self.data = data
+        self.mime_type = mime_type
+        # Model-specific encoding of the image, built on first use.
+        self.model_input: Any = None
+
+
+class ImageCache:
+    """LRU of the latest image for each active channel, bounded by the total
+    size of the cached bytes. Entries are keyed by channel and remember which
+    stored version they hold, so a lookup for any other version is a miss."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.resident_bytes = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, CachedImage]" = OrderedDict()
+
+    def get(self, key: Hashable, path: str) -> Optional[CachedImage]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.path != path:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, path: str, data: bytes, mime_type: str) -> CachedImage:
+        entry = CachedImage(path, data, mime_type)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.resident_bytes -= len(old.data)
+            if len(data) > self.max_bytes:
+                return entry
+            self._entries[key] = entry
+            self.resident_bytes += len(data)
+            while self.resident_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.resident_bytes -= len(evicted.data)
+        return entry
+
+    def model_input(self, entry: CachedImage, prepare: Callable[[bytes, str], Any]) -> Any:
+        if entry.model_input is None:
+            entry.model_input = prepare(entry.data, entry.mime_type)
+        return entry.model_input
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "resident_bytes": self.resident_bytes,
+                "entries": len(self._entries),
+            }
+
+
+def mime_type_for(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jpg", ".jpeg"):
+        return "image/jpeg"
+    if ext == ".webp":
+        return "image/webp"
+    return "image/png"
@@ -0,0 +1,156 @@
+import io
+import threading
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+FORMAT_MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+# Pillow format name -> extension the image store uses.
+FORMAT_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+
+# Leading bytes of the formats accepted as uploads.
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+)
+
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    for signature, kind in _SIGNATURES:
+        if header.startswith(signature):
+            return kind
+    return None
+
+
+def encode_image(img: Image.Image, fmt: str, quality: int) -> bytes:
+    """Encode without carrying over EXIF or other metadata."""
+    if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    out = io.BytesIO()
+    if fmt == "png":
+        img.save(out, format="PNG", optimize=True)
+    else:
+        img.save(out, format=fmt.upper(), quality=quality, optimize=True)
+    return out.getvalue()
+
+
+class ImagePreprocessor:
+    """Shrinks the base image before it is sent to the image model: fits it
+    within max_side, re-encodes it with a quality-controlled codec and drops
+    metadata. The original is kept if re-encoding would not make it smaller."""
+
+    def __init__(self, max_side: int = 1024, format: str = "jpeg", quality: int = 85):
+        fmt = format.lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in FORMAT_MIME_TYPES:
+            raise ValueError(f"Unsupported input image format '{format}'")
+        self.max_side = max_side
+        self.format = fmt
+        self.quality = quality
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.turns = 0
+        self.bytes_saved = 0
+
+    def process(self, data: bytes, mime_type: str) -> tuple[bytes, str]:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img = ImageOps.exif_transpose(img)
+                resized = max(img.size) > self.max_side
+                img.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+                encoded = encode_image(img, self.format, self.quality)
+        except Exception:
+            # Not something Pillow can decode; let the model deal with it.
+            return data, mime_type
+        with self._lock:
+            self.processed += 1
+        if not resized and len(encoded) >= len(data):
+            return data, mime_type
+        return encoded, FORMAT_MIME_TYPES[self.format]
+
+    def record_turn(self, original_size: int, sent_size: int) -> None:
+        with self._lock:
+            self.turns += 1
+            self.bytes_saved += original_size - sent_size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "processed": self.processed,
+                "turns": self.turns,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+class OutputNormalizer:
+    """Checks what the image model actually returned: sniffs the real format
+    from the bytes, shrinks anything over the max dimensions and optionally
+    re-encodes to a configured format. Undecodable output is passed through
+    as PNG, which is what the bot always assumed before."""
+
+    def __init__(
+        self,
+        max_width: int,
+        max_height: int,
+        format: Optional[str] = None,
+        quality: int = 90,
+    ):
+        fmt = format.lower() if format else None
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt and fmt not in FORMAT_MIME_TYPES:
+            raise ValueError(f"Unsupported output image format '{format}'")
+        self.max_width = max_width
+        self.max_height = max_height
+        self.format = fmt
+        self.quality = quality
+        self._lock = threading.Lock()
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def normalize(self, data: bytes) -> tuple[bytes, str, dict]:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                sniffed = img.format
+                img.load()
+                width, height = img.size
+                oversize = width > self.max_width or height > self.max_height
+                target = self.format or (sniffed or "PNG").lower()
+                if target.upper() not in FORMAT_EXTENSIONS:
+                    target = "png"
+                if oversize:
+                    img.thumbnail((self.max_width, self.max_height), Image.Resampling.LANCZOS)
+                if self.format or oversize or target.upper() != sniffed:
+                    out = encode_image(img, target, self.quality)
+                else:
+                    out = data
+                info = {
+                    "source_format": sniffed,
+                    "source_size": len(data),
+                    "width": img.size[0],
+                    "height": img.size[1],
+                }
+        except Exception:
+            return data, "png", {"source_format": None, "source_size": len(data)}
+        with self._lock:
+            self.images += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(out)
+        return out, FORMAT_EXTENSIONS[target.upper()], info
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "images": self.images,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
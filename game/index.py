@@ -0,0 +1,286 @@
+"""SQLite index of channel metadata, kept up to date by GameService.
+
+    python -m game.index --db channels.db most-active --limit 10
+    python -m game.index --db channels.db stale --days 30
+    python -m game.index --db channels.db rebuild --uploads-dir /srv/rengabot
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Optional
+
+from .store import ChannelImageStore, ImageVersion
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    platform TEXT NOT NULL,
+    workspace_id TEXT NOT NULL,
+    channel_id TEXT NOT NULL,
+    digest TEXT,
+    ext TEXT,
+    path TEXT,
+    turns INTEGER NOT NULL DEFAULT 0,
+    last_user_id TEXT,
+    first_seen_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (platform, workspace_id, channel_id)
+);
+CREATE INDEX IF NOT EXISTS channels_by_turns ON channels (turns);
+CREATE INDEX IF NOT EXISTS channels_by_updated ON channels (updated_at);
+"""
+
+_UPSERT = """
+INSERT INTO channels (
+    platform, workspace_id, channel_id, digest, ext, path, turns,
+    last_user_id, first_seen_at, updated_at
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (platform, workspace_id, channel_id) DO UPDATE SET
+    digest = excluded.digest,
+    ext = excluded.ext,
+    path = excluded.path,
+    turns = excluded.turns,
+    last_user_id = excluded.last_user_id,
+    first_seen_at = MIN(channels.first_seen_at, excluded.first_seen_at),
+    updated_at = excluded.updated_at
+WHERE excluded.updated_at >= channels.updated_at
+"""
+
+_COLUMNS = (
+    "platform",
+    "workspace_id",
+    "channel_id",
+    "digest",
+    "ext",
+    "path",
+    "turns",
+    "last_user_id",
+    "first_seen_at",
+    "updated_at",
+)
+
+
+class ChannelIndex:
+    """Current version, turn count, last user and timestamps per channel.
+    Updates are queued in memory and written by a background thread in one
+    transaction every flush_interval seconds (or once batch_size channels
+    are waiting), so a turn never waits on SQLite. The database runs in WAL
+    mode, so queries don't block writers and several bot processes can
+    share the file."""
+
+    def __init__(self, path: str, flush_interval: float = 1.0, batch_size: int = 100):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._db_lock = threading.Lock()
+        self._pending: dict[tuple[str, str, str], tuple] = {}
+        self._pending_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.written = 0
+
+    def record(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        version: ImageVersion,
+        user_id: str,
+        at: Optional[float] = None,
+    ) -> None:
+        at = at if at is not None else time.time()
+        row = (
+            platform,
+            workspace_id,
+            channel_id,
+            version.digest,
+            version.ext,
+            version.path,
+            version.turn,
+            user_id,
+            at,
+            at,
+        )
+        with self._pending_lock:
+            # Only the latest state of a channel needs writing.
+            self._pending[(platform, workspace_id, channel_id)] = row
+            waiting = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name="rengabot-channel-index"
+                )
+                self._thread.start()
+        if waiting >= self.batch_size:
+            self._wake.set()
+
+    def flush(self) -> int:
+        with self._pending_lock:
+            rows = list(self._pending.values())
+            self._pending.clear()
+        if not rows:
+            return 0
+        with self._db_lock, self._db:
+            self._db.executemany(_UPSERT, rows)
+        self.flushes += 1
+        self.written += len(rows)
+        return len(rows)
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(5.0)
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def get(self, platform: str, workspace_id: str, channel_id: str) -> Optional[dict]:
+        rows = self._query(
+            "SELECT * FROM channels WHERE platform = ? AND workspace_id = ? AND channel_id = ?",
+            (platform, workspace_id, channel_id),
+        )
+        return rows[0] if rows else None
+
+    def most_active(self, limit: int = 10, since: Optional[float] = None) -> list[dict]:
+        """Channels with the most turns, optionally only those played since
+        the given timestamp."""
+        return self._query(
+            "SELECT * FROM channels WHERE updated_at >= ? "
+            "ORDER BY turns DESC, updated_at DESC LIMIT ?",
+            (since or 0, limit),
+        )
+
+    def stale(self, older_than: float, limit: int = 100) -> list[dict]:
+        """Channels without a new image for older_than seconds, oldest first."""
+        return self._query(
+            "SELECT * FROM channels WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+            (time.time() - older_than, limit),
+        )
+
+    def rebuild(self, uploads_dir: str) -> int:
+        """Replace the index with what is on disk under
+        uploads_dir/<platform>/<workspace>/<channel>."""
+        rows = [row for row in _scan(uploads_dir) if row]
+        with self._pending_lock:
+            self._pending.clear()
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM channels")
+            self._db.executemany(_UPSERT, rows)
+        logger.info("Rebuilt channel index", extra={"path": self.path, "count": len(rows)})
+        return len(rows)
+
+    def _query(self, sql: str, params: tuple) -> list[dict]:
+        self.flush()
+        with self._db_lock:
+            cursor = self._db.execute(sql, params)
+            return [dict(zip(_COLUMNS, row)) for row in cursor.fetchall()]
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write channel index")
+
+
+def _scan(uploads_dir: str):
+    for platform in _subdirs(uploads_dir):
+        for workspace_id in _subdirs(os.path.join(uploads_dir, platform)):
+            for channel_id in _subdirs(os.path.join(uploads_dir, platform, workspace_id)):
+                channel_dir = os.path.join(uploads_dir, platform, workspace_id, channel_id)
+                yield _channel_row(platform, workspace_id, channel_id, channel_dir)
+
+
+def _subdirs(path: str) -> list[str]:
+    try:
+        names = sorted(os.listdir(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    return [
+        n for n in names if not n.startswith(".") and os.path.isdir(os.path.join(path, n))
+    ]
+
+
+def _channel_row(platform: str, workspace_id: str, channel_id: str, channel_dir: str):
+    store = ChannelImageStore(channel_dir)
+    version = store.current()
+    if version is None:
+        return None
+    history = store.history()
+    modified = os.path.getmtime(version.path)
+    first = history[0] if history else {}
+    last = history[-1] if history else {}
+    return (
+        platform,
+        workspace_id,
+        channel_id,
+        version.digest,
+        version.ext,
+        version.path,
+        version.turn,
+        last.get("user_id"),
+        first.get("created_at") or modified,
+        last.get("created_at") or modified,
+    )
+
+
+def _print_rows(rows: list[dict], as_json: bool) -> None:
+    if as_json:
+        print(json.dumps(rows, indent=2))
+        return
+    for row in rows:
+        updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["updated_at"]))
+        print(
+            f"{row['platform']}/{row['workspace_id']}/{row['channel_id']}"
+            f"  turns={row['turns']}  last_user={row['last_user_id'] or '-'}  updated={updated}"
+        )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Rengabot channel index")
+    parser.add_argument("--db", required=True, help="path of the SQLite index")
+    parser.add_argument("--json", action="store_true", help="print rows as JSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+    active = commands.add_parser("most-active", help="channels with the most turns")
+    active.add_argument("--limit", type=int, default=10)
+    active.add_argument("--days", type=float, help="only channels played in the last N days")
+    stale = commands.add_parser("stale", help="channels without a change for a while")
+    stale.add_argument("--days", type=float, default=30)
+    stale.add_argument("--limit", type=int, default=100)
+    rebuild = commands.add_parser("rebuild", help="re-index the channels on disk")
+    rebuild.add_argument("--uploads-dir", default=os.environ.get("UPLOADS_DIR", "/tmp"))
+    args = parser.parse_args(argv)
+
+    index = ChannelIndex(args.db)
+    try:
+        if args.command == "most-active":
+            since = time.time() - args.days * 86400 if args.days else None
+            _print_rows(index.most_active(args.limit, since), args.json)
+        elif args.command == "stale":
+            _print_rows(index.stale(args.days * 86400, args.limit), args.json)
+        else:
+            print(f"indexed {index.rebuild(args.uploads_dir)} channels")
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,400 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Optional
+
+DEFAULT_LEASE_TTL = 600.0
+# Redis leases are renewed while held, so their TTL only has to cover a
+# replica dying.
+DEFAULT_REDIS_LEASE_TTL = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+class Lease:
+    def __init__(self, key: str, token: str, acquired_at: float, expires_at: float):
+        self.key = key
+        self.token = token
+        self.acquired_at = acquired_at
+        self.expires_at = expires_at
+        # Increases with every acquisition of the key, for backends that
+        # hand out fencing tokens.
+        self.fence: Optional[int] = None
+
+
+class LockStats:
+    """Running totals for how long callers waited for and held locks."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.rejected = 0
+        self.takeovers = 0
+        self.wait_count = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.hold_count = 0
+        self.hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+        self.renewals = 0
+        self.lost = 0
+
+    def observe_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.wait_count += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def observe_hold(self, seconds: float) -> None:
+        with self._lock:
+            self.hold_count += 1
+            self.hold_seconds += seconds
+            self.max_hold_seconds = max(self.max_hold_seconds, seconds)
+
+    def count(self, field: str) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "rejected": self.rejected,
+                "takeovers": self.takeovers,
+                "wait_count": self.wait_count,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+                "hold_count": self.hold_count,
+                "hold_seconds": self.hold_seconds,
+                "max_hold_seconds": self.max_hold_seconds,
+                "renewals": self.renewals,
+                "lost": self.lost,
+            }
+
+
+class LockManager(ABC):
+    """Non-blocking, lease-based exclusive locks keyed by string. A lease that
+    outlives its TTL is considered abandoned and may be taken over."""
+
+    # Whether keys are paths of lock files on this host rather than names
+    # shared by every replica.
+    local_paths = False
+
+    def __init__(self, ttl: float = DEFAULT_LEASE_TTL):
+        self.ttl = ttl
+        self.stats = LockStats()
+
+    def acquire(self, key: str) -> Optional[Lease]:
+        now = time.time()
+        lease = Lease(key, uuid.uuid4().hex, now, now + self.ttl)
+        if not self._try_acquire(lease):
+            self.stats.count("rejected")
+            return None
+        self.stats.count("acquired")
+        return lease
+
+    def release(self, lease: Optional[Lease]) -> None:
+        if not lease:
+            return
+        try:
+            self._release(lease)
+        finally:
+            self.stats.observe_hold(time.time() - lease.acquired_at)
+
+    def is_held(self, lease: Lease) -> bool:
+        """Whether the lease is still ours, checked before committing work
+        done under it. Backends without renewal trust the TTL."""
+        return True
+
+    @abstractmethod
+    def _try_acquire(self, lease: Lease) -> bool:
+        pass
+
+    @abstractmethod
+    def _release(self, lease: Lease) -> None:
+        pass
+
+
+class InMemoryLockManager(LockManager):
+    """Locks for a single bot process. Safe to share between the messenger
+    threads and their event loops since acquisition never blocks."""
+
+    def __init__(self, ttl: float = DEFAULT_LEASE_TTL):
+        super().__init__(ttl)
+        self._mutex = threading.Lock()
+        self._leases: dict[str, Lease] = {}
+
+    def _try_acquire(self, lease: Lease) -> bool:
+        with self._mutex:
+            held = self._leases.get(lease.key)
+            if held and held.expires_at > lease.acquired_at:
+                return False
+            if held:
+                self.stats.count("takeovers")
+            self._leases[lease.key] = lease
+            return True
+
+    def _release(self, lease: Lease) -> None:
+        with self._mutex:
+            held = self._leases.get(lease.key)
+            if held and held.token == lease.token:
+                del self._leases[lease.key]
+
+
+class FileLeaseLockManager(LockManager):
+    """Locks shared between processes on one host. The key is the path of the
+    lock file, which records the owner host, PID and lease expiry. Leases
+    whose expiry has passed are taken over, as are leases whose owner is a
+    dead process on this host. PIDs from other hosts (or containers sharing
+    the directory) can't be checked, so those leases run to expiry."""
+
+    local_paths = True
+
+    def _try_acquire(self, lease: Lease) -> bool:
+        os.makedirs(os.path.dirname(lease.key) or ".", exist_ok=True)
+        if self._create(lease):
+            return True
+        held = _read_lease_file(lease.key, self.ttl)
+        if held is None:
+            # Released between our create and read; try once more.
+            return self._create(lease)
+        if not _lease_is_stale(held, lease.acquired_at):
+            return False
+        if not self._break(lease.key, held):
+            return False
+        logger.warning(
+            "Took over stale change lock",
+            extra={"path": lease.key},
+        )
+        self.stats.count("takeovers")
+        return self._create(lease)
+
+    def _release(self, lease: Lease) -> None:
+        held = _read_lease_file(lease.key, self.ttl)
+        if held is None or held.get("token") != lease.token:
+            return
+        try:
+            os.unlink(lease.key)
+        except FileNotFoundError:
+            pass
+
+    def _create(self, lease: Lease) -> bool:
+        try:
+            fd = os.open(lease.key, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        record = {
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "token": lease.token,
+            "expires_at": lease.expires_at,
+        }
+        try:
+            os.write(fd, json.dumps(record).encode("ascii"))
+        except Exception:
+            os.close(fd)
+            try:
+                os.unlink(lease.key)
+            except FileNotFoundError:
+                pass
+            raise
+        os.close(fd)
+        return True
+
+    def _break(self, path: str, held: dict) -> bool:
+        # Move the stale file aside rather than unlinking it, so we can check
+        # that nobody replaced it with a live lease after we inspected it.
+        tombstone = f"{path}.stale.{uuid.uuid4().hex}"
+        try:
+            os.rename(path, tombstone)
+        except FileNotFoundError:
+            return True
+        moved = _read_lease_file(tombstone, self.ttl)
+        if moved is not None and moved.get("token") != held.get("token"):
+            try:
+                os.link(tombstone, path)
+            except FileExistsError:
+                pass
+            os.unlink(tombstone)
+            return False
+        os.unlink(tombstone)
+        return True
+
+
+# Compare-and-delete / compare-and-extend, so a replica can never release
+# or renew a lease that expired and was taken by someone else.
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisLockManager(LockManager):
+    """Locks shared by bot replicas through Redis (or anything speaking its
+    protocol). A lease is a key set with NX and a TTL, holding a random token
+    and a fencing number from INCR. While held it is renewed every
+    renew_interval seconds, so the TTL only needs to cover a replica dying,
+    not the longest generation; a lease that could not be renewed is
+    reported by is_held() so its work is not committed. Commits carry the
+    fence, and the channel's image store refuses one older than the last
+    it recorded, which covers a lease lost after that check."""
+
+    def __init__(
+        self,
+        client,
+        ttl: float = DEFAULT_REDIS_LEASE_TTL,
+        prefix: str = "rengabot:lock:",
+        renew_interval: Optional[float] = None,
+    ):
+        super().__init__(ttl)
+        self.client = client
+        self.prefix = prefix
+        self.renew_interval = renew_interval or ttl / 3
+        self._mutex = threading.Lock()
+        self._held: dict[str, Lease] = {}
+        self._lost: set[str] = set()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def is_held(self, lease: Lease) -> bool:
+        with self._mutex:
+            if lease.token in self._lost:
+                return False
+        value = self.client.get(self.prefix + lease.key)
+        return _decode(value) == _lease_value(lease)
+
+    def stop(self) -> None:
+        with self._mutex:
+            self._held.clear()
+        self._wake.set()
+
+    def _try_acquire(self, lease: Lease) -> bool:
+        key = self.prefix + lease.key
+        lease.fence = int(self.client.incr(key + ":fence"))
+        if not self.client.set(key, _lease_value(lease), nx=True, px=self._ttl_ms()):
+            return False
+        with self._mutex:
+            self._held[lease.token] = lease
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._renew_loop, daemon=True, name="rengabot-lock-renewal"
+                )
+                self._thread.start()
+        return True
+
+    def _release(self, lease: Lease) -> None:
+        with self._mutex:
+            self._held.pop(lease.token, None)
+            self._lost.discard(lease.token)
+        self.client.eval(RELEASE_SCRIPT, 1, self.prefix + lease.key, _lease_value(lease))
+
+    def _renew_loop(self) -> None:
+        while not self._wake.wait(self.renew_interval):
+            with self._mutex:
+                leases = list(self._held.values())
+            for lease in leases:
+                self._renew(lease)
+
+    def _renew(self, lease: Lease) -> None:
+        try:
+            renewed = self.client.eval(
+                RENEW_SCRIPT, 1, self.prefix + lease.key, _lease_value(lease), self._ttl_ms()
+            )
+        except Exception:
+            # Keep trying until the TTL runs out; is_held() will tell.
+            logger.exception("Failed to renew change lock", extra={"lock": lease.key})
+            return
+        with self._mutex:
+            if lease.token not in self._held:
+                return
+            if renewed:
+                lease.expires_at = time.time() + self.ttl
+                self.stats.count("renewals")
+                return
+            del self._held[lease.token]
+            self._lost.add(lease.token)
+        self.stats.count("lost")
+        logger.warning("Lost change lock", extra={"lock": lease.key, "fence": lease.fence})
+
+    def _ttl_ms(self) -> int:
+        return int(self.ttl * 1000)
+
+
+def create_lock_manager(
+    backend: str = "file", ttl: Optional[float] = None, **options
+) -> LockManager:
+    """Without a ttl each backend uses its own default: DEFAULT_LEASE_TTL for
+    file and memory locks, DEFAULT_REDIS_LEASE_TTL for renewed Redis leases."""
+    if backend == "file":
+        return FileLeaseLockManager(ttl or DEFAULT_LEASE_TTL)
+    if backend == "memory":
+        return InMemoryLockManager(ttl or DEFAULT_LEASE_TTL)
+    if backend == "redis":
+        client = options.pop("client", None)
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(options.pop("url", "redis://localhost:6379/0"))
+        return RedisLockManager(client, ttl or DEFAULT_REDIS_LEASE_TTL, **options)
+    raise ValueError(f"Unknown lock backend '{backend}'")
+
+
+def _lease_value(lease: Lease) -> str:
+    return f"{lease.token}:{lease.fence}"
+
+
+def _decode(value) -> Optional[str]:
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def _read_lease_file(path: str, ttl: float) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            raw = f.read()
+        mtime = os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+    try:
+        record = json.loads(raw)
+        if isinstance(record, dict):
+            return record
+    except ValueError:
+        pass
+    # Lock files from older versions only hold a PID (or arbitrary text), so
+    # fall back to the file age for expiry.
+    pid = int(raw) if raw.strip().isdigit() else None
+    return {"pid": pid, "token": None, "expires_at": mtime + ttl}
+
+
+def _lease_is_stale(record: dict, now: float) -> bool:
+    if record.get("expires_at", 0) <= now:
+        return True
+    if record.get("host") != socket.gethostname():
+        return False
+    pid = record.get("pid")
+    return bool(pid) and not _pid_alive(pid)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
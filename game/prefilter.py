@@ -0,0 +1,150 @@
+import logging
+import re
+import threading
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+ENFORCE = "enforce"
+SHADOW = "shadow"
+
+_EDIT_VERBS = r"(?:add|remove|delete|change|make|turn|replace|put|give|swap|move|paint|color|colour)"
+
+_RESOLUTION = re.compile(
+    r"\b(?:\d{1,2}\s?k|ultra[\s-]?hd|uhd|full[\s-]?hd|hd|high(?:er)?[\s-]?res(?:olution)?|"
+    r"(?:increase|raise|boost|double|triple)\s+(?:the\s+)?(?:resolution|size|dimensions)|"
+    r"upscale|\d{3,5}\s?(?:x|×|by)\s?\d{3,5}|\d+\s?(?:mp|megapixels?))\b",
+    re.IGNORECASE,
+)
+_RULE_CHANGE = re.compile(
+    r"\b(?:new\s+rules?|change\s+the\s+rules?|rules?\s+(?:change|update)|"
+    r"ignore\s+(?:all\s+|the\s+|your\s+|previous\s+|prior\s+)*(?:rules|instructions)|"
+    r"(?:two|2|three|3|multiple|several)\s+changes|from\s+now\s+on|"
+    r"respond\s+with|valid\s*[\"']?\s*:\s*true)",
+    re.IGNORECASE,
+)
+_COMPOUND = re.compile(
+    rf"\b{_EDIT_VERBS}\b[^.;!?]*?(?:\band\s+(?:then\s+|also\s+)?|\bthen\s+|[;,]\s*(?:and\s+)?(?:then\s+)?)"
+    rf"{_EDIT_VERBS}\b",
+    re.IGNORECASE,
+)
+
+
+class PrefilterHit:
+    def __init__(self, rule: str, reason: str):
+        self.rule = rule
+        self.reason = reason
+
+
+class Rule:
+    def __init__(self, name: str, reason: str, matches: Callable[[str], bool]):
+        self.name = name
+        self.reason = reason
+        self.matches = matches
+
+
+def default_rules(max_length: int) -> dict[str, Rule]:
+    return {
+        "empty": Rule("empty", "the prompt is empty", lambda p: not p.strip()),
+        "too_long": Rule(
+            "too_long",
+            f"the prompt is longer than {max_length} characters",
+            lambda p: len(p) > max_length,
+        ),
+        "resolution": Rule(
+            "resolution",
+            "it tries to change the fixed image size",
+            lambda p: bool(_RESOLUTION.search(p)),
+        ),
+        "rule_change": Rule(
+            "rule_change",
+            "it tries to change the rules of the game",
+            lambda p: bool(_RULE_CHANGE.search(p)),
+        ),
+        "compound": Rule(
+            "compound",
+            "that's more than one change",
+            lambda p: bool(_COMPOUND.search(p)),
+        ),
+    }
+
+
+class PromptPrefilter:
+    """Cheap local checks for prompts the validation model would reject on
+    their face. In "enforce" mode a match rejects the prompt without an API
+    call; in "shadow" mode matches are only logged and counted, and compared
+    with the model's verdict to measure how often each rule agrees."""
+
+    def __init__(
+        self,
+        mode: str = ENFORCE,
+        rules: Optional[list[str]] = None,
+        max_length: int = 500,
+    ):
+        if mode not in (ENFORCE, SHADOW):
+            raise ValueError(f"Unknown prefilter mode '{mode}'")
+        available = default_rules(max_length)
+        names = rules if rules is not None else list(available)
+        unknown = [n for n in names if n not in available]
+        if unknown:
+            raise ValueError(f"Unknown prefilter rules: {', '.join(unknown)}")
+        self.mode = mode
+        self.rules = [available[n] for n in names]
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.hits = {rule.name: 0 for rule in self.rules}
+        # Shadow mode: rule hits the model agreed / disagreed with, and
+        # prompts the model rejected that no rule caught.
+        self.agreed = {rule.name: 0 for rule in self.rules}
+        self.disagreed = {rule.name: 0 for rule in self.rules}
+        self.missed = 0
+
+    @property
+    def enforcing(self) -> bool:
+        return self.mode == ENFORCE
+
+    def evaluate(self, prompt: str) -> Optional[PrefilterHit]:
+        for rule in self.rules:
+            if rule.matches(prompt):
+                return PrefilterHit(rule.name, rule.reason)
+        return None
+
+    def check(self, prompt: str) -> Optional[PrefilterHit]:
+        hit = self.evaluate(prompt)
+        with self._lock:
+            self.checked += 1
+            if hit:
+                self.hits[hit.rule] += 1
+        return hit
+
+    def record_model_verdict(self, prompt: str, valid: bool) -> None:
+        if self.enforcing:
+            return
+        hit = self.evaluate(prompt)
+        with self._lock:
+            if hit is None:
+                if not valid:
+                    self.missed += 1
+                return
+            if valid:
+                self.disagreed[hit.rule] += 1
+            else:
+                self.agreed[hit.rule] += 1
+        if valid:
+            logger.info(
+                "Prefilter rule disagreed with the model",
+                extra={"rule": hit.rule},
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {
+                "mode": self.mode,
+                "checked": self.checked,
+                "hits": dict(self.hits),
+            }
+            if not self.enforcing:
+                stats["agreed"] = dict(self.agreed)
+                stats["disagreed"] = dict(self.disagreed)
+                stats["missed"] = self.missed
+            return stats
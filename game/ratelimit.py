@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ("user", "channel", "workspace")
+
+# Drop buckets that have refilled completely every this many checks, so idle
+# users don't accumulate.
+_SWEEP_EVERY = 1024
+
+
+class RateLimiter:
+    """Token buckets for change requests per user, channel and workspace.
+
+    Each scope is configured as {"rate": N, "per": seconds, "burst": M}:
+    N changes per `per` seconds on average, with up to `burst` (default N)
+    in a row. A request needs a token from every configured scope and takes
+    them all or none. Buckets are a (tokens, updated_at) pair refilled
+    lazily on access, so a check is a few dict lookups under one lock.
+
+    With `path` set, the buckets are saved to a JSON file every
+    save_interval seconds by a background thread and loaded on startup, so
+    a restart doesn't hand everyone a fresh burst."""
+
+    def __init__(
+        self,
+        user: Optional[dict] = None,
+        channel: Optional[dict] = None,
+        workspace: Optional[dict] = None,
+        path: Optional[str] = None,
+        save_interval: float = 30.0,
+    ):
+        self.limits: dict[str, tuple[float, float]] = {}
+        for scope, config in zip(SCOPES, (user, channel, workspace)):
+            if config:
+                rate = float(config["rate"]) / float(config.get("per", 60))
+                burst = float(config.get("burst", config["rate"]))
+                self.limits[scope] = (rate, burst)
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._buckets: dict[tuple, list[float]] = {}
+        self._checks = 0
+        self._dirty = False
+        self.allowed = 0
+        self.limited = {scope: 0 for scope in self.limits}
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if path:
+            self._load()
+            self._thread = threading.Thread(
+                target=self._save_loop, daemon=True, name="rengabot-rate-limits"
+            )
+            self._thread.start()
+
+    def acquire(
+        self, platform: str, workspace_id: str, channel_id: str, user_id: str
+    ) -> Optional[tuple[str, float]]:
+        """Take a token from each scope. Returns None if the request may go
+        ahead, otherwise the limiting scope and seconds until it may retry."""
+        if not self.limits:
+            return None
+        keys = _scope_keys(platform, workspace_id, channel_id, user_id)
+        now = time.time()
+        with self._lock:
+            buckets = []
+            refused = None
+            for scope, (rate, burst) in self.limits.items():
+                key = (scope,) + keys[scope]
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = [burst, now]
+                else:
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                if bucket[0] < 1:
+                    wait = (1 - bucket[0]) / rate
+                    if refused is None or wait > refused[1]:
+                        refused = (scope, wait)
+                buckets.append(bucket)
+            self._checks += 1
+            if self._checks % _SWEEP_EVERY == 0:
+                self._sweep(now)
+            if refused:
+                self.limited[refused[0]] += 1
+                return refused
+            for bucket in buckets:
+                bucket[0] -= 1
+            self.allowed += 1
+            self._dirty = True
+        return None
+
+    def refund(self, platform: str, workspace_id: str, channel_id: str, user_id: str) -> None:
+        """Give back the tokens an acquire() took for a request that was then
+        turned away before doing any work."""
+        if not self.limits:
+            return
+        keys = _scope_keys(platform, workspace_id, channel_id, user_id)
+        with self._lock:
+            for scope, (_, burst) in self.limits.items():
+                bucket = self._buckets.get((scope,) + keys[scope])
+                if bucket is not None:
+                    bucket[0] = min(burst, bucket[0] + 1)
+            self.allowed -= 1
+            self._dirty = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "allowed": self.allowed,
+                "limited": dict(self.limited),
+                "buckets": len(self._buckets),
+            }
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = [list(key) + bucket for key, bucket in self._buckets.items()]
+            self._dirty = False
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(5.0)
+        if self.path:
+            self.save()
+
+    def _sweep(self, now: float) -> None:
+        for key, (tokens, updated_at) in list(self._buckets.items()):
+            rate, burst = self.limits.get(key[0], (0.0, 0.0))
+            if not rate or tokens + (now - updated_at) * rate >= burst:
+                del self._buckets[key]
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                rows = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning("Ignoring unreadable rate limit state", extra={"path": self.path})
+            return
+        for row in rows:
+            *key, tokens, updated_at = row
+            if key and key[0] in self.limits:
+                self._buckets[tuple(key)] = [tokens, updated_at]
+
+    def _save_loop(self) -> None:
+        while not self._stopped.wait(self.save_interval):
+            try:
+                self.save()
+            except Exception:
+                logger.exception("Failed to save rate limit state")
+
+
+def _scope_keys(platform: str, workspace_id: str, channel_id: str, user_id: str) -> dict:
+    return {
+        "user": (platform, workspace_id, user_id),
+        "channel": (platform, workspace_id, channel_id),
+        "workspace": (platform, workspace_id),
+    }
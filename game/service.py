@@ -1,8 +1,30 @@
+import asyncio
+import contextlib
+import contextvars
 import logging
 import os
-from typing import Optional
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
 from PIL import Image
 
+from telemetry import metrics, tracing
+
+from .backpressure import CLOSED, OPEN, ModelGuard
+from .index import ChannelIndex
+from .imaging import ImagePreprocessor, OutputNormalizer
+from .image_cache import CachedImage, ImageCache, mime_type_for
+from .locks import Lease, create_lock_manager
+from .prefilter import PromptPrefilter
+from .ratelimit import RateLimiter
+from .storage import create_storage
+from .store import ChannelImageStore, ImageVersion, StaleFenceError
+
+
+COMMIT_LOCK_TIMEOUT = 10.0
+
 
 class NoImageError(Exception):
     pass
@@ -18,10 +40,32 @@ class GenerationError(Exception):
     pass
 
 
+class ModelUnavailableError(GenerationError):
+    """The model backend is failing or overloaded, so the call was refused
+    without being attempted."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"model unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class RateLimitedError(Exception):
+    """The user, channel or workspace has used up its change allowance."""
+
+    def __init__(self, retry_after: float, scope: str = "user"):
+        super().__init__(f"{scope} rate limited, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+        self.scope = scope
+
+
 class ChangeInProgressError(Exception):
     pass
 
 
+class ChangeQueueFullError(ChangeInProgressError):
+    pass
+
+
 class ImageTooLargeError(Exception):
     def __init__(self, width: int, height: int, max_width: int, max_height: int):
         super().__init__(
@@ -41,26 +85,158 @@ class GameService:
     NO_IMAGE_MESSAGE = "No image has been set yet. An admin must run `/rengabot set-image` first."
     GENERATION_ERROR_MESSAGE = "Image generation failed. Please try again."
     CHANGE_IN_PROGRESS_MESSAGE = "Someone else beat you to it"
+    QUEUE_FULL_MESSAGE = "Too many changes are already waiting in this channel. Try again in a bit."
     MAX_IMAGE_WIDTH = 1024
     MAX_IMAGE_HEIGHT = 1024
 
-    def __init__(self, model, uploads_dir: Optional[str] = None):
+    def __init__(
+        self,
+        model,
+        uploads_dir: Optional[str] = None,
+        speculative: bool = False,
+        queue_depth: int = 0,
+        lock_backend: str = "file",
+        lock_ttl: Optional[float] = None,
+        lock_options: Optional[dict] = None,
+        image_cache_bytes: int = 64 * 1024 * 1024,
+        input_image: Optional[dict] = None,
+        output_image: Optional[dict] = None,
+        model_guard: Optional[dict] = None,
+        prefilter: Optional[dict] = None,
+        storage: Optional[dict] = None,
+        index: Optional[dict] = None,
+        rate_limits: Optional[dict] = None,
+    ):
         self.model = model
         self.uploads_dir = uploads_dir or os.environ.get("UPLOADS_DIR", "/tmp")
         self._logger = logging.getLogger(__name__)
+        # Speculative mode starts generating while the prompt is still being
+        # validated. An invalid verdict throws the generation away, so track
+        # how often that happens to weigh the cost against the latency saved.
+        self.speculative = speculative
+        self.speculative_generations = 0
+        self.wasted_generations = 0
+        self._speculation_lock = threading.Lock()
+        self._speculative_executor = None
+        if self.speculative:
+            self._speculative_executor = ThreadPoolExecutor(
+                thread_name_prefix="rengabot-speculative"
+            )
+        # How many changes may wait behind the running one in a channel.
+        # With 0 a busy channel rejects new changes outright.
+        self.queue_depth = queue_depth
+        self._channel_queues: dict[tuple[str, str, str], _ChannelQueue] = {}
+        # Where channel images and history live: files under uploads_dir by
+        # default, or an object store shared by several replicas. uploads_dir
+        # still holds lock files and in-progress uploads.
+        self.storage = create_storage(**(storage or {}))
+        # Optional SQLite index of per-channel metadata for admin queries
+        # (python -m game.index); written in batches off the turn path.
+        self.channel_index = None
+        if index is not None:
+            self.channel_index = ChannelIndex(**index)
+        self.lock_manager = create_lock_manager(lock_backend, lock_ttl, **(lock_options or {}))
+        # Short locks around each commit to a channel's history, separate from
+        # the change locks (which set-image doesn't take) so their stats and
+        # keys don't mix.
+        self.commit_locks = create_lock_manager(lock_backend, lock_ttl, **(lock_options or {}))
+        # Latest image bytes (and the model's encoding of them) per channel,
+        # so turns and uploads don't go back to disk. Disk stays the durable copy.
+        self.image_cache = ImageCache(image_cache_bytes)
+        # Optional downscale/re-encode of the base image before it goes to
+        # the model; the result is cached with the image version above.
+        self.input_preprocessor = None
+        if input_image:
+            self.input_preprocessor = ImagePreprocessor(**input_image)
+        self.output_normalizer = OutputNormalizer(
+            self.MAX_IMAGE_WIDTH, self.MAX_IMAGE_HEIGHT, **(output_image or {})
+        )
+        # Concurrency limit and circuit breaker per kind of model call, so a
+        # struggling backend gets less traffic and users get a quick answer.
+        self.model_guards: dict[str, ModelGuard] = {}
+        if model_guard is not None:
+            shared = {k: v for k, v in model_guard.items() if k not in _MODEL_OPERATIONS}
+            for operation in _MODEL_OPERATIONS:
+                self.model_guards[operation] = ModelGuard(
+                    operation, **shared, **(model_guard.get(operation) or {})
+                )
+        # Local rules that turn away obviously invalid prompts before they
+        # cost a model call (or, in shadow mode, only log what they would do).
+        self.prefilter = None
+        if prefilter is not None:
+            self.prefilter = PromptPrefilter(**prefilter)
+        # Token buckets per user, channel and workspace, checked before any
+        # model call so one busy player can't use up the quota. A token is
+        # only taken once the change has got past the lock or into the queue,
+        # so "someone else beat you to it" doesn't cost anything.
+        self.rate_limiter = None
+        if rate_limits is not None:
+            self.rate_limiter = RateLimiter(**rate_limits)
+        if metrics.registry() is not None:
+            metrics.register_collector(self.collect_metrics)
 
     def channel_dir(self, platform: str, workspace_id: str, channel_id: str) -> str:
         return os.path.join(self.uploads_dir, platform, workspace_id, channel_id)
 
+    def channel_store(
+        self, platform: str, workspace_id: str, channel_id: str
+    ) -> ChannelImageStore:
+        if self.storage.local_paths:
+            prefix = self.channel_dir(platform, workspace_id, channel_id)
+        else:
+            prefix = self.storage.join(platform, workspace_id, channel_id)
+        return ChannelImageStore(
+            prefix,
+            self.storage,
+            commit_lock=lambda: self._commit_lock(platform, workspace_id, channel_id),
+        )
+
+    @contextlib.contextmanager
+    def _commit_lock(self, platform: str, workspace_id: str, channel_id: str):
+        """Hold the channel's commit lock, waiting for it since commits are
+        short. If it can't be had in COMMIT_LOCK_TIMEOUT (an abandoned lease
+        on another host), go ahead: the store still won't overwrite a turn."""
+        if self.commit_locks.local_paths:
+            key = os.path.join(self.channel_dir(platform, workspace_id, channel_id), ".commit.lock")
+        else:
+            key = f"{platform}/{workspace_id}/{channel_id}/commit"
+        deadline = time.monotonic() + COMMIT_LOCK_TIMEOUT
+        delay = 0.005
+        lease = self.commit_locks.acquire(key)
+        while lease is None and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+            lease = self.commit_locks.acquire(key)
+        if lease is None:
+            self._logger.warning(
+                "Committing without the channel commit lock",
+                extra={
+                    "platform": platform,
+                    "workspace_id": workspace_id,
+                    "channel_id": channel_id,
+                },
+            )
+        try:
+            yield
+        finally:
+            self.commit_locks.release(lease)
+
     def get_current_image_path(
         self, platform: str, workspace_id: str, channel_id: str
     ) -> Optional[str]:
-        channel_dir = self.channel_dir(platform, workspace_id, channel_id)
-        for ext in ("png", "jpg", "jpeg"):
-            path = os.path.join(channel_dir, f"current.{ext}")
-            if os.path.exists(path):
-                return path
-        return None
+        """Path of the current image, or its key when storage is remote."""
+        version = self.channel_store(platform, workspace_id, channel_id).current()
+        return version.path if version else None
+
+    async def get_current_image_path_async(
+        self, platform: str, workspace_id: str, channel_id: str
+    ) -> Optional[str]:
+        return await asyncio.to_thread(
+            self.get_current_image_path, platform, workspace_id, channel_id
+        )
+
+    def get_history(self, platform: str, workspace_id: str, channel_id: str) -> list[dict]:
+        return self.channel_store(platform, workspace_id, channel_id).history()
 
     def save_image_bytes(
         self,
@@ -70,14 +246,24 @@ class GameService:
         user_id: str,
         image_bytes: bytes,
         ext: str = "png",
+        prompt: Optional[str] = None,
+        requested_at: Optional[float] = None,
+        details: Optional[dict] = None,
+        fence: Optional[int] = None,
     ) -> str:
-        if ext not in ("png", "jpg", "jpeg"):
+        if ext not in ("png", "jpg", "jpeg", "webp"):
             ext = "png"
-        channel_dir = self.channel_dir(platform, workspace_id, channel_id)
-        os.makedirs(channel_dir, exist_ok=True)
-        path = os.path.join(channel_dir, f"current.{ext}")
-        with open(path, "wb") as f:
-            f.write(image_bytes)
+        store = self.channel_store(platform, workspace_id, channel_id)
+        version = store.put_bytes(
+            image_bytes, ext, user_id, prompt, requested_at, details, fence
+        )
+        self._index_version(platform, workspace_id, channel_id, version, user_id)
+        self.image_cache.put(
+            (platform, workspace_id, channel_id),
+            version.path,
+            image_bytes,
+            mime_type_for(version.path),
+        )
         self._logger.info(
             "Saved renga image bytes",
             extra={
@@ -86,10 +272,21 @@ class GameService:
                 "channel_id": channel_id,
                 "user_id": user_id,
                 "ext": ext,
-                "path": path,
+                "path": version.path,
             },
         )
-        return path
+        return version.path
+
+    def _index_version(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        version: ImageVersion,
+        user_id: str,
+    ) -> None:
+        if self.channel_index is not None:
+            self.channel_index.record(platform, workspace_id, channel_id, version, user_id)
 
     def save_image_file(
         self,
@@ -103,10 +300,9 @@ class GameService:
         if ext not in ("png", "jpg", "jpeg"):
             ext = "png"
         self._validate_image_size(src_path)
-        channel_dir = self.channel_dir(platform, workspace_id, channel_id)
-        os.makedirs(channel_dir, exist_ok=True)
-        dest_path = os.path.join(channel_dir, f"current.{ext}")
-        os.replace(src_path, dest_path)
+        store = self.channel_store(platform, workspace_id, channel_id)
+        version = store.put_file(src_path, ext, user_id)
+        self._index_version(platform, workspace_id, channel_id, version, user_id)
         self._logger.info(
             "Saved renga image file",
             extra={
@@ -115,10 +311,60 @@ class GameService:
                 "channel_id": channel_id,
                 "user_id": user_id,
                 "ext": ext,
-                "path": dest_path,
+                "path": version.path,
             },
         )
-        return dest_path
+        return version.path
+
+    def _save_generated_image(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        user_id: str,
+        image_bytes: bytes,
+        prompt: str,
+        requested_at: float,
+        lease: Optional[Lease] = None,
+    ) -> str:
+        # Decoding and re-encoding is CPU bound; async callers run this in a
+        # worker thread.
+        log_extra = {
+            "platform": platform,
+            "workspace_id": workspace_id,
+            "channel_id": channel_id,
+            "user_id": user_id,
+        }
+        if lease is not None and not self.lock_manager.is_held(lease):
+            # Another replica took the channel over while we were generating;
+            # committing now would clobber its turn.
+            self._logger.warning("Change image discarded: lock lost", extra=log_extra)
+            raise ChangeInProgressError()
+        with metrics.timed(
+            "rengabot_save_seconds", platform=platform, workspace=workspace_id
+        ), tracing.span("save"):
+            image_bytes, ext, details = self.output_normalizer.normalize(image_bytes)
+            try:
+                return self.save_image_bytes(
+                    platform,
+                    workspace_id,
+                    channel_id,
+                    user_id,
+                    image_bytes,
+                    ext=ext,
+                    prompt=prompt,
+                    requested_at=requested_at,
+                    details=details,
+                    fence=lease.fence if lease is not None else None,
+                )
+            except StaleFenceError as e:
+                # The lease was lost after the check above and a later holder
+                # has already committed.
+                self._logger.warning(
+                    "Change image discarded: fenced out",
+                    extra={**log_extra, "fence": e.fence, "stored_fence": e.stored_fence},
+                )
+                raise ChangeInProgressError() from e
 
     def _validate_image_size(self, path: str) -> None:
         try:
@@ -135,38 +381,64 @@ class GameService:
         channel_dir = self.channel_dir(platform, workspace_id, channel_id)
         return os.path.join(channel_dir, ".change.lock")
 
+    def _change_lock_key(self, platform: str, workspace_id: str, channel_id: str) -> str:
+        if self.lock_manager.local_paths:
+            return self._change_lock_path(platform, workspace_id, channel_id)
+        return f"{platform}/{workspace_id}/{channel_id}"
+
     def _acquire_change_lock(
-        self, platform: str, workspace_id: str, channel_id: str
-    ) -> Optional[tuple[int, str]]:
-        channel_dir = self.channel_dir(platform, workspace_id, channel_id)
-        os.makedirs(channel_dir, exist_ok=True)
-        lock_path = self._change_lock_path(platform, workspace_id, channel_id)
-        try:
-            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        except FileExistsError:
-            return None
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        waiting_since: Optional[float] = None,
+    ) -> Optional[Lease]:
+        lock_key = self._change_lock_key(platform, workspace_id, channel_id)
+        lease = self.lock_manager.acquire(lock_key)
+        if lease and waiting_since is not None:
+            waited = time.monotonic() - waiting_since
+            self.lock_manager.stats.observe_wait(waited)
+            metrics.observe(
+                "rengabot_lock_wait_seconds", waited, platform=platform, workspace=workspace_id
+            )
+            tracing.record_span("lock_wait", waited)
+        return lease
+
+    def _release_change_lock(self, lease: Optional[Lease]) -> None:
+        self.lock_manager.release(lease)
+
+    async def _acquire_change_lock_async(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        waiting_since: Optional[float] = None,
+    ) -> Optional[Lease]:
+        # Lock backends may make network round trips (Redis), so they run
+        # off the event loop. A lease won after the caller was cancelled is
+        # handed straight back.
+        acquiring = asyncio.ensure_future(
+            asyncio.to_thread(
+                self._acquire_change_lock, platform, workspace_id, channel_id, waiting_since
+            )
+        )
         try:
-            os.write(fd, str(os.getpid()).encode("ascii"))
-        except Exception:
-            os.close(fd)
-            try:
-                os.unlink(lock_path)
-            except FileNotFoundError:
-                pass
+            return await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(self._release_abandoned_lock)
             raise
-        return (fd, lock_path)
 
-    def _release_change_lock(self, lock: Optional[tuple[int, str]]) -> None:
-        if not lock:
+    async def _release_change_lock_async(self, lease: Optional[Lease]) -> None:
+        if lease:
+            # Shielded so a cancelled change still gives its lease back.
+            await asyncio.shield(asyncio.to_thread(self._release_change_lock, lease))
+
+    def _release_abandoned_lock(self, acquiring: asyncio.Future) -> None:
+        if acquiring.cancelled() or acquiring.exception() or not acquiring.result():
             return
-        fd, lock_path = lock
-        try:
-            os.close(fd)
-        finally:
-            try:
-                os.unlink(lock_path)
-            except FileNotFoundError:
-                pass
+        asyncio.get_running_loop().run_in_executor(
+            None, self._release_change_lock, acquiring.result()
+        )
 
     def show_image(self, platform: str, workspace_id: str, channel_id: str) -> str:
         path = self.get_current_image_path(platform, workspace_id, channel_id)
@@ -174,6 +446,47 @@ class GameService:
             raise NoImageError()
         return path
 
+    def read_image(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        path: Optional[str] = None,
+    ) -> bytes:
+        """Return the bytes of a stored image (the current one by default),
+        served from the in-memory cache when possible."""
+        path = path or self.show_image(platform, workspace_id, channel_id)
+        return self._cached_image((platform, workspace_id, channel_id), path).data
+
+    async def read_image_async(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        path: Optional[str] = None,
+    ) -> bytes:
+        if not path:
+            path = await self.get_current_image_path_async(platform, workspace_id, channel_id)
+            if not path:
+                raise NoImageError()
+        entry = await self._cached_image_async((platform, workspace_id, channel_id), path)
+        return entry.data
+
+    def _cached_image(self, key: tuple[str, str, str], path: str) -> CachedImage:
+        entry = self.image_cache.get(key, path)
+        return entry or self._read_into_cache(key, path)
+
+    async def _cached_image_async(self, key: tuple[str, str, str], path: str) -> CachedImage:
+        entry = self.image_cache.get(key, path)
+        if entry:
+            return entry
+        data = await self.storage.get_async(path)
+        return self.image_cache.put(key, path, data, mime_type_for(path))
+
+    def _read_into_cache(self, key: tuple[str, str, str], path: str) -> CachedImage:
+        data = self.storage.get(path)
+        return self.image_cache.put(key, path, data, mime_type_for(path))
+
     def change_image(
         self,
         platform: str,
@@ -182,7 +495,29 @@ class GameService:
         user_id: str,
         prompt: str,
     ) -> str:
-        lock = self._acquire_change_lock(platform, workspace_id, channel_id)
+        try:
+            with tracing.span("service.change_image", channel=channel_id):
+                path = self._change_image(platform, workspace_id, channel_id, user_id, prompt)
+        except Exception as e:
+            _record_outcome(platform, workspace_id, e)
+            raise
+        _record_outcome(platform, workspace_id, None)
+        return path
+
+    def _change_image(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        user_id: str,
+        prompt: str,
+    ) -> str:
+        requested_at = time.time()
+        self._prefilter_prompt(prompt, (platform, workspace_id, channel_id), user_id)
+        self._check_model_available()
+        lock = self._acquire_change_lock(
+            platform, workspace_id, channel_id, waiting_since=time.monotonic()
+        )
         if not lock:
             self._logger.info(
                 "Change image rejected: lock held",
@@ -207,20 +542,19 @@ class GameService:
         try:
             if not current_path:
                 raise NoImageError()
-            valid, reason = self.model.validate_prompt(prompt)
-            if not valid:
-                raise InvalidPromptError(reason)
-            try:
-                image_bytes = self.model.generate_image(prompt, current_path)
-            except Exception as e:
-                raise GenerationError(str(e)) from e
-            new_path = self.save_image_bytes(
+            self._check_rate_limit((platform, workspace_id, channel_id), user_id)
+            image_bytes = self._validate_and_generate(
+                prompt, (platform, workspace_id, channel_id), current_path
+            )
+            new_path = self._save_generated_image(
                 platform,
                 workspace_id,
                 channel_id,
                 user_id,
                 image_bytes,
-                ext="png",
+                prompt,
+                requested_at,
+                lock,
             )
             self._logger.info(
                 "Change image completed",
@@ -236,6 +570,695 @@ class GameService:
         finally:
             self._release_change_lock(lock)
 
+    async def change_image_async(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        user_id: str,
+        prompt: str,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> str:
+        """Async counterpart of change_image. Model calls are awaited directly
+        so an in-flight generation does not hold an executor thread.
+
+        If a change is already running in the channel the prompt joins a FIFO
+        queue of up to queue_depth entries and runs against the image produced
+        by the change before it. on_queued is awaited with the number of
+        changes ahead, and the prompt is validated while it waits."""
+        try:
+            with tracing.span("service.change_image", channel=channel_id):
+                path = await self._change_image_queued(
+                    platform, workspace_id, channel_id, user_id, prompt, on_queued
+                )
+        except Exception as e:
+            _record_outcome(platform, workspace_id, e)
+            raise
+        _record_outcome(platform, workspace_id, None)
+        return path
+
+    async def _change_image_queued(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        user_id: str,
+        prompt: str,
+        on_queued: Optional[Callable[[int], Awaitable[None]]],
+    ) -> str:
+        requested_at = time.time()
+        arrived = time.monotonic()
+        key = (platform, workspace_id, channel_id)
+        self._prefilter_prompt(prompt, key, user_id)
+        self._check_model_available()
+        queue = self._channel_queues.get(key)
+        if queue is None:
+            queue = self._channel_queues[key] = _ChannelQueue()
+        ahead = queue.pending
+        if ahead > self.queue_depth:
+            self._logger.info(
+                "Change image rejected: queue full",
+                extra={
+                    "platform": platform,
+                    "workspace_id": workspace_id,
+                    "channel_id": channel_id,
+                    "user_id": user_id,
+                },
+            )
+            if self.queue_depth:
+                raise ChangeQueueFullError()
+            raise ChangeInProgressError()
+        queue.pending += 1
+        try:
+            validated = False
+            if ahead:
+                # Queued prompts are validated while they wait, so they are
+                # charged on admission to the queue.
+                self._check_rate_limit(key, user_id)
+                self._logger.info(
+                    f"Change image queued at position {ahead}",
+                    extra={
+                        "platform": platform,
+                        "workspace_id": workspace_id,
+                        "channel_id": channel_id,
+                        "user_id": user_id,
+                    },
+                )
+                if on_queued:
+                    await on_queued(ahead)
+                await self._wait_for_turn(queue.lock, prompt, key)
+                validated = True
+            else:
+                await queue.lock.acquire()
+            try:
+                return await self._change_image_locked(
+                    platform,
+                    workspace_id,
+                    channel_id,
+                    user_id,
+                    prompt,
+                    validated,
+                    arrived,
+                    requested_at,
+                )
+            finally:
+                queue.lock.release()
+        finally:
+            queue.pending -= 1
+            if not queue.pending:
+                self._channel_queues.pop(key, None)
+
+    async def _wait_for_turn(
+        self, lock: asyncio.Lock, prompt: str, key: tuple[str, str, str]
+    ) -> None:
+        # Take our place in line first so arrival order is kept, then validate
+        # while the changes ahead run. A rejected prompt leaves the line
+        # immediately instead of holding a slot until its turn.
+        turn = asyncio.create_task(lock.acquire())
+        try:
+            valid, reason = await self._validate_prompt_async(prompt, key)
+        except BaseException:
+            await _abandon_turn(turn, lock)
+            raise
+        if not valid:
+            await _abandon_turn(turn, lock)
+            raise InvalidPromptError(reason)
+        await turn
+
+    async def _change_image_locked(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        user_id: str,
+        prompt: str,
+        validated: bool,
+        arrived: float,
+        requested_at: float,
+    ) -> str:
+        lock = await self._acquire_change_lock_async(
+            platform, workspace_id, channel_id, waiting_since=arrived
+        )
+        if not lock:
+            self._logger.info(
+                "Change image rejected: lock held",
+                extra={
+                    "platform": platform,
+                    "workspace_id": workspace_id,
+                    "channel_id": channel_id,
+                    "user_id": user_id,
+                },
+            )
+            raise ChangeInProgressError()
+        self._logger.info(
+            "Change image requested",
+            extra={
+                "platform": platform,
+                "workspace_id": workspace_id,
+                "channel_id": channel_id,
+                "user_id": user_id,
+            },
+        )
+        current_path = await self.get_current_image_path_async(
+            platform, workspace_id, channel_id
+        )
+        try:
+            if not current_path:
+                raise NoImageError()
+            if validated:
+                try:
+                    image_bytes = await self._generate_image_async(
+                        prompt, (platform, workspace_id, channel_id), current_path
+                    )
+                except ModelUnavailableError:
+                    raise
+                except Exception as e:
+                    raise GenerationError(str(e)) from e
+            else:
+                self._check_rate_limit((platform, workspace_id, channel_id), user_id)
+                image_bytes = await self._validate_and_generate_async(
+                    prompt, (platform, workspace_id, channel_id), current_path
+                )
+            new_path = await asyncio.to_thread(
+                self._save_generated_image,
+                platform,
+                workspace_id,
+                channel_id,
+                user_id,
+                image_bytes,
+                prompt,
+                requested_at,
+                lock,
+            )
+            self._logger.info(
+                "Change image completed",
+                extra={
+                    "platform": platform,
+                    "workspace_id": workspace_id,
+                    "channel_id": channel_id,
+                    "user_id": user_id,
+                    "path": new_path,
+                },
+            )
+            return new_path
+        finally:
+            await self._release_change_lock_async(lock)
+
+    def _validate_and_generate(
+        self, prompt: str, key: tuple[str, str, str], image_path: str
+    ) -> bytes:
+        if not self.speculative:
+            valid, reason = self._validate_prompt(prompt, key)
+            if not valid:
+                raise InvalidPromptError(reason)
+            try:
+                return self._generate_image(prompt, key, image_path)
+            except ModelUnavailableError:
+                raise
+            except Exception as e:
+                raise GenerationError(str(e)) from e
+
+        self._record_speculation(wasted=False)
+        generation = self._speculative_executor.submit(
+            contextvars.copy_context().run, self._generate_image, prompt, key, image_path
+        )
+        try:
+            valid, reason = self._validate_prompt(prompt, key)
+        except BaseException:
+            generation.cancel()
+            self._record_speculation(wasted=True)
+            raise
+        if not valid:
+            # A running thread can't be interrupted; its result is dropped.
+            generation.cancel()
+            self._record_speculation(wasted=True)
+            raise InvalidPromptError(reason)
+        try:
+            return generation.result()
+        except ModelUnavailableError:
+            raise
+        except Exception as e:
+            raise GenerationError(str(e)) from e
+
+    async def _validate_and_generate_async(
+        self, prompt: str, key: tuple[str, str, str], image_path: str
+    ) -> bytes:
+        if not self.speculative:
+            valid, reason = await self._validate_prompt_async(prompt, key)
+            if not valid:
+                raise InvalidPromptError(reason)
+            try:
+                return await self._generate_image_async(prompt, key, image_path)
+            except ModelUnavailableError:
+                raise
+            except Exception as e:
+                raise GenerationError(str(e)) from e
+
+        self._record_speculation(wasted=False)
+        generation = asyncio.create_task(self._generate_image_async(prompt, key, image_path))
+        try:
+            valid, reason = await self._validate_prompt_async(prompt, key)
+        except BaseException:
+            _discard_task(generation)
+            self._record_speculation(wasted=True)
+            raise
+        if not valid:
+            _discard_task(generation)
+            self._record_speculation(wasted=True)
+            raise InvalidPromptError(reason)
+        try:
+            return await generation
+        except ModelUnavailableError:
+            raise
+        except Exception as e:
+            raise GenerationError(str(e)) from e
+
+    def _record_speculation(self, wasted: bool) -> None:
+        with self._speculation_lock:
+            if wasted:
+                self.wasted_generations += 1
+            else:
+                self.speculative_generations += 1
+        if wasted:
+            self._logger.info("Speculative generation discarded")
+
+    def speculation_stats(self) -> dict:
+        with self._speculation_lock:
+            started = self.speculative_generations
+            wasted = self.wasted_generations
+        return {
+            "generations": started,
+            "wasted": wasted,
+            "wasted_rate": (wasted / started) if started else 0.0,
+        }
+
+    def _validate_prompt(self, prompt: str, key: tuple[str, str, str]):
+        with metrics.timed(
+            "rengabot_validation_seconds", **_metric_labels(key)
+        ), tracing.span("validate"):
+            verdict = self._cached_verdict(prompt)
+            if verdict is None:
+                verdict = self._guarded_call("validate", self.model.validate_prompt, prompt)
+        self._record_model_verdict(prompt, verdict)
+        return verdict
+
+    async def _validate_prompt_async(self, prompt: str, key: tuple[str, str, str]):
+        with metrics.timed(
+            "rengabot_validation_seconds", **_metric_labels(key)
+        ), tracing.span("validate"):
+            verdict = self._cached_verdict(prompt)
+            if verdict is None:
+                validate = getattr(self.model, "validate_prompt_async", None)
+                if validate:
+                    verdict = await self._guarded_call_async("validate", validate, prompt)
+                else:
+                    verdict = await self._guarded_call_async(
+                        "validate", asyncio.to_thread, self.model.validate_prompt, prompt
+                    )
+        self._record_model_verdict(prompt, verdict)
+        return verdict
+
+    def _cached_verdict(self, prompt: str):
+        """A verdict from the model's validation cache, if it has one. Cache
+        hits skip the model guard so they don't count as backend calls that
+        close a probing breaker or grow the concurrency limit."""
+        cache = getattr(self.model, "validation_cache", None)
+        if cache is None or prompt not in cache:
+            return None
+        return cache.get(prompt)
+
+    def _prefilter_prompt(
+        self, prompt: str, key: tuple[str, str, str], user_id: str
+    ) -> None:
+        if self.prefilter is None:
+            return
+        hit = self.prefilter.check(prompt)
+        if hit is None:
+            return
+        platform, workspace_id, channel_id = key
+        metrics.inc("rengabot_prefilter_hits_total", rule=hit.rule, mode=self.prefilter.mode)
+        self._logger.info(
+            "Prompt matched prefilter rule",
+            extra={
+                "platform": platform,
+                "workspace_id": workspace_id,
+                "channel_id": channel_id,
+                "user_id": user_id,
+                "rule": hit.rule,
+                "mode": self.prefilter.mode,
+            },
+        )
+        if self.prefilter.enforcing:
+            raise InvalidPromptError(hit.reason)
+
+    def _check_rate_limit(self, key: tuple[str, str, str], user_id: str) -> None:
+        if self.rate_limiter is None:
+            return
+        platform, workspace_id, channel_id = key
+        limited = self.rate_limiter.acquire(platform, workspace_id, channel_id, user_id)
+        if limited is None:
+            return
+        scope, retry_after = limited
+        metrics.inc("rengabot_rate_limited_total", platform=platform, scope=scope)
+        self._logger.info(
+            "Change image rejected: rate limited",
+            extra={
+                "platform": platform,
+                "workspace_id": workspace_id,
+                "channel_id": channel_id,
+                "user_id": user_id,
+                "scope": scope,
+            },
+        )
+        raise RateLimitedError(retry_after, scope)
+
+    def _record_model_verdict(self, prompt: str, verdict) -> None:
+        if self.prefilter is not None and not self.prefilter.enforcing:
+            self.prefilter.record_model_verdict(prompt, verdict[0])
+
+    def _generate_image(self, prompt: str, key: tuple[str, str, str], image_path: str) -> bytes:
+        with metrics.timed(
+            "rengabot_generation_seconds", **_metric_labels(key)
+        ), tracing.span("generate"):
+            return self._guarded_call(
+                "generate", self._generate_image_untimed, prompt, key, image_path
+            )
+
+    def _generate_image_untimed(
+        self, prompt: str, key: tuple[str, str, str], image_path: str
+    ) -> bytes:
+        if hasattr(self.model, "generate_image_from_input"):
+            entry = self._cached_image(key, image_path)
+            image_input = self._model_input(entry)
+            return self.model.generate_image_from_input(prompt, image_input)
+        with self._local_image_file(key, image_path) as local_path:
+            return self.model.generate_image(prompt, local_path)
+
+    async def _generate_image_async(
+        self, prompt: str, key: tuple[str, str, str], image_path: str
+    ) -> bytes:
+        with metrics.timed(
+            "rengabot_generation_seconds", **_metric_labels(key)
+        ), tracing.span("generate"):
+            return await self._guarded_call_async(
+                "generate", self._generate_image_untimed_async, prompt, key, image_path
+            )
+
+    async def _generate_image_untimed_async(
+        self, prompt: str, key: tuple[str, str, str], image_path: str
+    ) -> bytes:
+        generate = getattr(self.model, "generate_image_from_input_async", None)
+        if generate:
+            entry = await self._cached_image_async(key, image_path)
+            if entry.model_input is None:
+                image_input = await asyncio.to_thread(self._model_input, entry)
+            else:
+                image_input = self._model_input(entry)
+            return await generate(prompt, image_input)
+        if not self.storage.local_paths:
+            # Models that only take a path get a local copy; see _local_image_file.
+            return await asyncio.to_thread(self._generate_image_untimed, prompt, key, image_path)
+        generate = getattr(self.model, "generate_image_async", None)
+        if generate:
+            return await generate(prompt, image_path)
+        return await asyncio.to_thread(self.model.generate_image, prompt, image_path)
+
+    @contextlib.contextmanager
+    def _local_image_file(self, key: tuple[str, str, str], image_path: str):
+        """Models without prepare_image_input want a file path; with remote
+        storage, write the image to a temp file for the duration of the call."""
+        if self.storage.local_paths:
+            yield image_path
+            return
+        entry = self._cached_image(key, image_path)
+        suffix = os.path.splitext(image_path)[1]
+        fd, local_path = tempfile.mkstemp(suffix=suffix, dir=self.uploads_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(entry.data)
+            yield local_path
+        finally:
+            os.unlink(local_path)
+
+    def _check_model_available(self) -> None:
+        for guard in self.model_guards.values():
+            retry_after = guard.breaker.retry_after()
+            if retry_after is not None:
+                self._reject_model_call(guard.name, "circuit_open")
+                raise ModelUnavailableError(retry_after)
+
+    def _guarded_call(self, operation: str, fn, *args):
+        guard = self.model_guards.get(operation)
+        if guard is None:
+            return fn(*args)
+        retry_after = guard.admit()
+        if retry_after is not None:
+            self._reject_model_call(operation, _refusal_reason(guard))
+            raise ModelUnavailableError(retry_after)
+        started = time.monotonic()
+        error = None
+        try:
+            return fn(*args)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            guard.done(time.monotonic() - started, error)
+
+    async def _guarded_call_async(self, operation: str, fn, *args):
+        guard = self.model_guards.get(operation)
+        if guard is None:
+            return await fn(*args)
+        retry_after = await guard.admit_async()
+        if retry_after is not None:
+            self._reject_model_call(operation, _refusal_reason(guard))
+            raise ModelUnavailableError(retry_after)
+        started = time.monotonic()
+        error = None
+        try:
+            return await fn(*args)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            guard.done(time.monotonic() - started, error)
+
+    def _reject_model_call(self, operation: str, reason: str) -> None:
+        self._logger.info(
+            "Model call refused",
+            extra={"operation": operation, "reason": reason},
+        )
+        metrics.inc("rengabot_model_rejections_total", operation=operation, reason=reason)
+
+    def _model_input(self, entry: CachedImage):
+        image_input, sent_size = self.image_cache.model_input(entry, self._prepare_model_input)
+        if self.input_preprocessor:
+            self.input_preprocessor.record_turn(len(entry.data), sent_size)
+        return image_input
+
+    def _prepare_model_input(self, data: bytes, mime_type: str):
+        if self.input_preprocessor:
+            data, mime_type = self.input_preprocessor.process(data, mime_type)
+        return (self.model.prepare_image_input(data, mime_type), len(data))
+
+    def collect_metrics(self):
+        """Gauge samples for the /metrics endpoint built from the running
+        totals the service and its helpers keep."""
+        image_cache = self.image_cache.stats()
+        yield (
+            "rengabot_image_cache_hit_rate",
+            "Image cache hit rate",
+            {},
+            image_cache["hit_rate"],
+        )
+        yield (
+            "rengabot_image_cache_resident_bytes",
+            "Bytes held by the image cache",
+            {},
+            image_cache["resident_bytes"],
+        )
+        yield (
+            "rengabot_image_cache_entries",
+            "Channels in the image cache",
+            {},
+            image_cache["entries"],
+        )
+        locks = self.lock_manager.stats.snapshot()
+        for field in ("acquired", "rejected", "takeovers"):
+            yield (f"rengabot_locks_{field}", f"Change locks {field}", {}, locks[field])
+        yield (
+            "rengabot_lock_hold_seconds_max",
+            "Longest a change lock has been held",
+            {},
+            locks["max_hold_seconds"],
+        )
+        speculation = self.speculation_stats()
+        yield (
+            "rengabot_speculative_generations",
+            "Generations started before validation finished",
+            {},
+            speculation["generations"],
+        )
+        yield (
+            "rengabot_speculative_wasted_rate",
+            "Share of speculative generations thrown away",
+            {},
+            speculation["wasted_rate"],
+        )
+        if self.input_preprocessor:
+            yield (
+                "rengabot_input_bytes_saved",
+                "Model upload bytes saved by input preprocessing",
+                {},
+                self.input_preprocessor.stats()["bytes_saved"],
+            )
+        for operation, guard in self.model_guards.items():
+            limiter = guard.limiter.stats()
+            yield (
+                "rengabot_model_concurrency_limit",
+                "Current adaptive concurrency limit for model calls",
+                {"operation": operation},
+                limiter["limit"],
+            )
+            yield (
+                "rengabot_model_in_flight",
+                "Model calls currently running",
+                {"operation": operation},
+                limiter["in_flight"],
+            )
+            yield (
+                "rengabot_model_circuit_open",
+                "1 while the model circuit breaker is open, 0.5 while probing",
+                {"operation": operation},
+                {CLOSED: 0, OPEN: 1}.get(guard.breaker.state, 0.5),
+            )
+        if self.prefilter is not None and not self.prefilter.enforcing:
+            prefilter = self.prefilter.stats()
+            for rule, count in prefilter["disagreed"].items():
+                yield (
+                    "rengabot_prefilter_disagreements",
+                    "Shadow prefilter hits on prompts the model accepted",
+                    {"rule": rule},
+                    count,
+                )
+            yield (
+                "rengabot_prefilter_misses",
+                "Prompts the model rejected that no prefilter rule matched",
+                {},
+                prefilter["missed"],
+            )
+        output = self.output_normalizer.stats()
+        yield (
+            "rengabot_output_bytes_in",
+            "Bytes returned by the image model",
+            {},
+            output["bytes_in"],
+        )
+        yield (
+            "rengabot_output_bytes_out",
+            "Bytes stored after normalization",
+            {},
+            output["bytes_out"],
+        )
+        validation_cache = getattr(self.model, "validation_cache", None)
+        if validation_cache:
+            cache = validation_cache.stats()
+            yield ("rengabot_validation_cache_hits", "Validation cache hits", {}, cache["hits"])
+            yield (
+                "rengabot_validation_cache_misses",
+                "Validation cache misses",
+                {},
+                cache["misses"],
+            )
+
+    @staticmethod
+    def upload_filename(path: str) -> str:
+        return f"renga{os.path.splitext(path)[1] or '.png'}"
+
+    @staticmethod
+    def format_model_unavailable(retry_after: float) -> str:
+        seconds = max(1, int(retry_after + 0.5))
+        return f"The AI model is overloaded right now. Please try again in {seconds}s."
+
+    @staticmethod
+    def format_rate_limited(retry_after: float, scope: str = "user") -> str:
+        seconds = max(1, int(retry_after + 0.5))
+        who = {
+            "user": "You're making changes faster than allowed.",
+            "channel": "This channel is changing faster than allowed.",
+            "workspace": "This workspace has used up its changes for now.",
+        }.get(scope, "Too many changes right now.")
+        return f"{who} Please try again in {seconds}s."
+
     @staticmethod
     def format_invalid_prompt(reason: Optional[str]) -> str:
         return f"Disallowed change: {reason or 'prompt does not match the rules.'}"
+
+    @staticmethod
+    def format_queue_position(position: int) -> str:
+        noun = "change" if position == 1 else "changes"
+        return f"You're in line behind {position} other {noun}. Hang tight!"
+
+
+class _ChannelQueue:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+def _discard_task(task: asyncio.Future) -> None:
+    """Cancel a speculative task and make sure any exception it already
+    raised is retrieved so asyncio doesn't warn about it."""
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def _abandon_turn(turn: asyncio.Task, lock: asyncio.Lock) -> None:
+    turn.cancel()
+    try:
+        await turn
+    except asyncio.CancelledError:
+        return
+    # The lock was acquired before the cancel landed; hand it on.
+    lock.release()
+
+
+_MODEL_OPERATIONS = ("validate", "generate")
+
+_OUTCOMES = (
+    (NoImageError, "no_image"),
+    (RateLimitedError, "rate_limited"),
+    (InvalidPromptError, "invalid_prompt"),
+    (ModelUnavailableError, "model_unavailable"),
+    (GenerationError, "generation_error"),
+    (ChangeQueueFullError, "queue_full"),
+    (ChangeInProgressError, "change_in_progress"),
+)
+
+
+def outcome_for(error: Optional[Exception]) -> str:
+    if error is None:
+        return "ok"
+    for cls, name in _OUTCOMES:
+        if isinstance(error, cls):
+            return name
+    return "error"
+
+
+def _record_outcome(platform: str, workspace_id: str, error: Optional[Exception]) -> None:
+    metrics.inc(
+        "rengabot_change_outcomes_total",
+        platform=platform,
+        workspace=workspace_id,
+        outcome=outcome_for(error),
+    )
+
+
+def _refusal_reason(guard: ModelGuard) -> str:
+    if guard.breaker.state == CLOSED:
+        return "limit_timeout"
+    return "circuit_open"
+
+
+def _metric_labels(key: tuple[str, str, str]) -> dict:
+    return {"platform": key[0], "workspace": key[1]}
@@ -0,0 +1,353 @@
+import asyncio
+import io
+import logging
+import os
+import shutil
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import BinaryIO, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_READ_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class Storage(ABC):
+    """Where channel images, turn records and `current` pointers live. Keys
+    are "/"-separated. Apart from pointers, objects are written once and
+    never changed, so implementations may cache reads freely; pointers are
+    replaced in a single atomic write and always read fresh."""
+
+    # Whether keys are paths on this host that can be opened directly.
+    local_paths = False
+
+    def join(self, *parts: str) -> str:
+        return "/".join(parts)
+
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        """Raises FileNotFoundError if there is no such object."""
+
+    @abstractmethod
+    def put(self, key: str, data: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def put_if_absent(self, key: str, data: bytes) -> bool:
+        """Create key with data unless it already exists. Returns False,
+        leaving the existing object alone, if it did."""
+
+    @abstractmethod
+    def put_file(self, key: str, src_path: str) -> None:
+        """Store a local file under key, consuming (removing) the file."""
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def list(self, prefix: str) -> list[str]:
+        """Sorted names of the objects directly under prefix."""
+
+    @abstractmethod
+    def read_pointer(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def swap_pointer(self, key: str, data: bytes) -> None:
+        pass
+
+    async def get_async(self, key: str) -> bytes:
+        return await asyncio.to_thread(self.get, key)
+
+    def stats(self) -> dict:
+        return {}
+
+
+class FilesystemStorage(Storage):
+    """Keys are file paths (the channel directories under UPLOADS_DIR).
+    Every write goes through a temp file and a rename so a crash never
+    leaves a half-written image or pointer behind."""
+
+    local_paths = True
+
+    def join(self, *parts: str) -> str:
+        return os.path.join(*parts)
+
+    def get(self, key: str) -> bytes:
+        with open(key, "rb") as f:
+            return f.read()
+
+    def put(self, key: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(key) or ".", exist_ok=True)
+        _atomic_write(key, data)
+
+    def put_if_absent(self, key: str, data: bytes) -> bool:
+        os.makedirs(os.path.dirname(key) or ".", exist_ok=True)
+        # Write the whole object aside, then link it into place: link()
+        # fails if the name exists, and readers never see a partial file.
+        tmp_path = f"{key}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.link(tmp_path, key)
+        except FileExistsError:
+            return False
+        finally:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def put_file(self, key: str, src_path: str) -> None:
+        os.makedirs(os.path.dirname(key) or ".", exist_ok=True)
+        _atomic_move(src_path, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(key)
+
+    def list(self, prefix: str) -> list[str]:
+        try:
+            return sorted(os.listdir(prefix))
+        except FileNotFoundError:
+            return []
+
+    def read_pointer(self, key: str) -> Optional[bytes]:
+        try:
+            return self.get(key)
+        except FileNotFoundError:
+            return None
+
+    def swap_pointer(self, key: str, data: bytes) -> None:
+        self.put(key, data)
+
+
+class S3Storage(Storage):
+    """Objects in an S3-compatible bucket (AWS, MinIO, R2, ...), so replicas
+    on different hosts share channel state. `client` is a boto3 S3 client or
+    anything with the same methods. Objects larger than part_size are sent
+    as multipart uploads streamed from memory or disk, and reads of the
+    write-once objects are kept in an LRU cache of cache_bytes."""
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        prefix: str = "",
+        part_size: int = DEFAULT_PART_SIZE,
+        cache_bytes: int = DEFAULT_READ_CACHE_BYTES,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.part_size = part_size
+        self.cache_bytes = cache_bytes
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[str, bytes] = OrderedDict()
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.multipart_uploads = 0
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = self._get_object(key)
+        if data is None:
+            raise FileNotFoundError(key)
+        self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.part_size:
+            self._multipart(key, io.BytesIO(data))
+        else:
+            self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+        self._remember(key, data)
+
+    def put_if_absent(self, key: str, data: bytes) -> bool:
+        # S3 conditional writes: the PUT fails with 412 if the key exists.
+        try:
+            self.client.put_object(
+                Bucket=self.bucket, Key=self.prefix + key, Body=data, IfNoneMatch="*"
+            )
+        except Exception as e:
+            if _error_code(e) in ("PreconditionFailed", "412", "ConditionalRequestConflict"):
+                return False
+            raise
+        self._remember(key, data)
+        return True
+
+    def put_file(self, key: str, src_path: str) -> None:
+        size = os.path.getsize(src_path)
+        with open(src_path, "rb") as f:
+            if size > self.part_size:
+                self._multipart(key, f)
+            else:
+                self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=f.read())
+        os.unlink(src_path)
+
+    def exists(self, key: str) -> bool:
+        with self._lock:
+            if key in self._cache:
+                return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if _is_not_found(e):
+                return False
+            raise
+        return True
+
+    def list(self, prefix: str) -> list[str]:
+        full_prefix = self.prefix + prefix.rstrip("/") + "/"
+        names = []
+        kwargs = {"Bucket": self.bucket, "Prefix": full_prefix}
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            for item in page.get("Contents", []):
+                name = item["Key"][len(full_prefix):]
+                if name and "/" not in name:
+                    names.append(name)
+            if not page.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+        return sorted(names)
+
+    def read_pointer(self, key: str) -> Optional[bytes]:
+        return self._get_object(key)
+
+    def swap_pointer(self, key: str, data: bytes) -> None:
+        # A single PUT replaces the object atomically for readers.
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "cached_bytes": self._cached_bytes,
+                "multipart_uploads": self.multipart_uploads,
+            }
+
+    def _get_object(self, key: str) -> Optional[bytes]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if _is_not_found(e):
+                return None
+            raise
+        return response["Body"].read()
+
+    def _multipart(self, key: str, source: BinaryIO) -> None:
+        full_key = self.prefix + key
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=full_key)[
+            "UploadId"
+        ]
+        parts = []
+        try:
+            for number, chunk in enumerate(iter(lambda: source.read(self.part_size), b""), 1):
+                response = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=full_key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=chunk,
+                )
+                parts.append({"ETag": response["ETag"], "PartNumber": number})
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=full_key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=full_key, UploadId=upload_id
+                )
+            except Exception:
+                logger.exception("Failed to abort multipart upload", extra={"key": full_key})
+            raise
+        with self._lock:
+            self.multipart_uploads += 1
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > self.cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return
+            self._cache[key] = data
+            self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+
+
+def create_storage(backend: str = "filesystem", **options) -> Storage:
+    if backend == "filesystem":
+        return FilesystemStorage()
+    if backend == "s3":
+        client = options.pop("client", None)
+        if client is None:
+            import boto3
+
+            client = boto3.client(
+                "s3",
+                endpoint_url=options.pop("endpoint_url", None),
+                region_name=options.pop("region", None),
+            )
+        return S3Storage(client, **options)
+    raise ValueError(f"Unknown storage backend '{backend}'")
+
+
+def _error_code(error: Exception) -> Optional[str]:
+    return ((getattr(error, "response", None) or {}).get("Error") or {}).get("Code")
+
+
+def _is_not_found(error: Exception) -> bool:
+    return _error_code(error) in ("404", "NoSuchKey", "NotFound")
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _atomic_move(src_path: str, dest_path: str) -> None:
+    try:
+        os.replace(src_path, dest_path)
+        return
+    except OSError:
+        # Different filesystem; copy next to the destination, then rename.
+        pass
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+    shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+    os.unlink(src_path)
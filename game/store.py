@@ -0,0 +1,185 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+from typing import Callable, ContextManager, Optional
+
+from .storage import FilesystemStorage, Storage
+
+POINTER_NAME = "current"
+IMAGES_DIR = "images"
+TURNS_DIR = "turns"
+LEGACY_EXTENSIONS = ("png", "jpg", "jpeg")
+
+
+class StaleFenceError(Exception):
+    """A commit carried a lower fencing number than the pointer already
+    records: the lease it was made under has since gone to someone else."""
+
+    def __init__(self, fence: int, stored_fence: int):
+        super().__init__(fence, stored_fence)
+        self.fence = fence
+        self.stored_fence = stored_fence
+
+
+class ImageVersion:
+    def __init__(self, digest: str, ext: str, path: str, turn: int):
+        self.digest = digest
+        self.ext = ext
+        self.path = path
+        self.turn = turn
+
+
+class ChannelImageStore:
+    """Versioned image history for one channel.
+
+    Every image is written once under images/ with its SHA-256 as the name, a
+    JSON record of each turn goes under turns/, and the small `current`
+    pointer names the latest version. `channel_dir` is the channel's key
+    prefix in `storage`, which by default is a directory on local disk.
+    Channels created before this layout only have current.{png,jpg,jpeg},
+    which is still read until the first new version is written.
+
+    Commits (turn record plus pointer swap) run under `commit_lock`, so
+    writers sharing the channel take turns. Turn records are also created
+    only if absent, so a writer that got past the lock anyway chains onto
+    the turn it collided with instead of overwriting it. A commit made under
+    a fenced lease records the fence in the pointer, and one carrying a
+    lower fence than the pointer's is refused with StaleFenceError."""
+
+    def __init__(
+        self,
+        channel_dir: str,
+        storage: Optional[Storage] = None,
+        commit_lock: Optional[Callable[[], ContextManager]] = None,
+    ):
+        self.channel_dir = channel_dir
+        self.storage = storage or FilesystemStorage()
+        self.commit_lock = commit_lock or contextlib.nullcontext
+
+    def current(self) -> Optional[ImageVersion]:
+        pointer = self._read_pointer()
+        if pointer:
+            return ImageVersion(
+                pointer["digest"],
+                pointer["ext"],
+                self._image_path(pointer["digest"], pointer["ext"]),
+                pointer["turn"],
+            )
+        if not self.storage.local_paths:
+            return None
+        for ext in LEGACY_EXTENSIONS:
+            path = self.storage.join(self.channel_dir, f"current.{ext}")
+            if self.storage.exists(path):
+                return ImageVersion("", ext, path, 0)
+        return None
+
+    def put_bytes(
+        self,
+        image_bytes: bytes,
+        ext: str,
+        user_id: str,
+        prompt: Optional[str] = None,
+        requested_at: Optional[float] = None,
+        details: Optional[dict] = None,
+        fence: Optional[int] = None,
+    ) -> ImageVersion:
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        path = self._image_path(digest, ext)
+        if not self.storage.exists(path):
+            self.storage.put(path, image_bytes)
+        return self._commit(
+            digest, ext, len(image_bytes), user_id, prompt, requested_at, details, fence
+        )
+
+    def put_file(
+        self,
+        src_path: str,
+        ext: str,
+        user_id: str,
+        prompt: Optional[str] = None,
+    ) -> ImageVersion:
+        digest = _hash_file(src_path)
+        size = os.path.getsize(src_path)
+        path = self._image_path(digest, ext)
+        if self.storage.exists(path):
+            os.unlink(src_path)
+        else:
+            self.storage.put_file(path, src_path)
+        return self._commit(digest, ext, size, user_id, prompt, None, None, None)
+
+    def history(self) -> list[dict]:
+        turns_dir = self.storage.join(self.channel_dir, TURNS_DIR)
+        return [
+            json.loads(self.storage.get(self.storage.join(turns_dir, name)))
+            for name in self.storage.list(turns_dir)
+            if name.endswith(".json")
+        ]
+
+    def _commit(
+        self,
+        digest: str,
+        ext: str,
+        size: int,
+        user_id: str,
+        prompt: Optional[str],
+        requested_at: Optional[float],
+        details: Optional[dict],
+        fence: Optional[int],
+    ) -> ImageVersion:
+        with self.commit_lock():
+            parent = self._read_pointer()
+            stored_fence = parent.get("fence") if parent else None
+            if fence is None:
+                fence = stored_fence
+            elif stored_fence is not None and stored_fence > fence:
+                raise StaleFenceError(fence, stored_fence)
+            turn = parent["turn"] + 1 if parent else 1
+            parent_digest = parent["digest"] if parent else None
+            while True:
+                record = {
+                    "turn": turn,
+                    "digest": digest,
+                    "ext": ext,
+                    "size": size,
+                    "user_id": user_id,
+                    "prompt": prompt,
+                    "parent": parent_digest,
+                    "requested_at": requested_at,
+                    "created_at": time.time(),
+                }
+                if details:
+                    record.update(details)
+                turn_key = self._turn_key(turn)
+                if self.storage.put_if_absent(turn_key, json.dumps(record).encode("utf-8")):
+                    break
+                # Someone else already has this turn; follow on from theirs.
+                parent_digest = json.loads(self.storage.get(turn_key))["digest"]
+                turn += 1
+            pointer = {"digest": digest, "ext": ext, "turn": turn}
+            if fence is not None:
+                pointer["fence"] = fence
+            self.storage.swap_pointer(
+                self.storage.join(self.channel_dir, POINTER_NAME),
+                json.dumps(pointer).encode("utf-8"),
+            )
+        return ImageVersion(digest, ext, self._image_path(digest, ext), turn)
+
+    def _turn_key(self, turn: int) -> str:
+        return self.storage.join(self.channel_dir, TURNS_DIR, f"{turn:08d}.json")
+
+    def _read_pointer(self) -> Optional[dict]:
+        raw = self.storage.read_pointer(self.storage.join(self.channel_dir, POINTER_NAME))
+        return json.loads(raw) if raw is not None else None
+
+    def _image_path(self, digest: str, ext: str) -> str:
+        return self.storage.join(self.channel_dir, IMAGES_DIR, f"{digest}.{ext}")
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,431 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+import zlib
+from concurrent.futures import Future, InvalidStateError
+from multiprocessing.connection import wait
+from typing import Awaitable, Callable, Optional
+
+from telemetry import metrics, tracing
+
+from .service import (
+    ChangeInProgressError,
+    ChangeQueueFullError,
+    GameService,
+    GenerationError,
+    NoImageError,
+    RateLimitedError,
+    _record_outcome,
+)
+
+logger = logging.getLogger(__name__)
+
+_QUEUED = "queued"
+_DONE = "done"
+_ERROR = "error"
+
+# Raised by a worker before it would have charged its own rate limits, so
+# the supervisor gives back the user and workspace tokens it took.
+_NOT_ADMITTED = (ChangeInProgressError, ChangeQueueFullError, NoImageError, RateLimitedError)
+
+QUICK_DEATH_SECONDS = 10.0
+MAX_RESTART_DELAY = 30.0
+
+
+class WorkerCrashedError(GenerationError):
+    """A change kept taking its worker process down with it."""
+
+
+def shard_for(key: tuple[str, str, str], shards: int) -> int:
+    """Stable across processes and restarts, unlike hash()."""
+    return zlib.crc32("\0".join(key).encode()) % shards
+
+
+class _Job:
+    def __init__(self, job_id: int, args: tuple, on_queued, loop):
+        self.id = job_id
+        self.args = args
+        self.on_queued = on_queued
+        self.loop = loop
+        # Lets the worker's spans join the caller's trace.
+        self.trace = tracing.current_parent()
+        self.future: Future = Future()
+        self.attempts = 0
+
+
+class _Worker:
+    def __init__(self, index: int, process, jobs):
+        self.index = index
+        self.process = process
+        self.jobs = jobs
+        self.started = time.monotonic()
+        # Consecutive deaths soon after starting, for restart backoff.
+        self.quick_deaths = 0
+        # Sent but not finished, in the order they were sent.
+        self.pending: dict[int, _Job] = {}
+
+
+class ShardedGameService:
+    """Runs image changes in a pool of worker processes so model calls, image
+    decoding and normalization don't share the messengers' GIL. Each channel
+    always goes to the same worker, whose own GameService keeps that
+    channel's FIFO order, queue and image cache. Everything else (showing
+    and setting images, formatting) is served by the local `service`.
+
+    A worker that dies is restarted and the changes it hadn't answered are
+    sent to the new process; a change that has crashed max_job_attempts
+    workers fails with WorkerCrashedError.
+
+    User and workspace rate limits span channels on every worker, so they
+    are enforced here, by the local `service` (built from
+    supervisor_game_config), before a change is sent; workers only enforce
+    channel limits."""
+
+    def __init__(
+        self,
+        service: GameService,
+        config: dict,
+        processes: int,
+        max_job_attempts: int = 2,
+        start_method: str = "spawn",
+    ):
+        if processes < 1:
+            raise ValueError("processes must be at least 1")
+        self.service = service
+        self.config = config
+        self.processes = processes
+        self.max_job_attempts = max_job_attempts
+        self._context = multiprocessing.get_context(start_method)
+        self._results = self._context.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._workers: list[_Worker] = []
+        self._stopped = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self.restarts = 0
+        self.requeued = 0
+
+    def __getattr__(self, name):
+        return getattr(self.service, name)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._workers:
+                return
+            self._workers = [self._spawn(i) for i in range(self.processes)]
+        for target, name in (
+            (self._read_results, "rengabot-worker-results"),
+            (self._monitor, "rengabot-worker-monitor"),
+        ):
+            thread = threading.Thread(target=target, daemon=True, name=name)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stopped.set()
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.jobs.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self._results.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def change_image(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        user_id: str,
+        prompt: str,
+    ) -> str:
+        self._acquire_rate_limit(platform, workspace_id, channel_id, user_id)
+        job = self._submit((platform, workspace_id, channel_id, user_id, prompt), None, None)
+        try:
+            path = job.future.result()
+        except Exception as e:
+            self._failed(job, e)
+            raise
+        _record_outcome(platform, workspace_id, None)
+        return path
+
+    async def change_image_async(
+        self,
+        platform: str,
+        workspace_id: str,
+        channel_id: str,
+        user_id: str,
+        prompt: str,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> str:
+        self._acquire_rate_limit(platform, workspace_id, channel_id, user_id)
+        job = self._submit(
+            (platform, workspace_id, channel_id, user_id, prompt),
+            on_queued,
+            asyncio.get_running_loop(),
+        )
+        try:
+            path = await asyncio.wrap_future(job.future)
+        except Exception as e:
+            self._failed(job, e)
+            raise
+        _record_outcome(platform, workspace_id, None)
+        return path
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "processes": self.processes,
+                "pending": {w.index: len(w.pending) for w in self._workers},
+                "restarts": self.restarts,
+                "requeued": self.requeued,
+            }
+
+    def _acquire_rate_limit(
+        self, platform: str, workspace_id: str, channel_id: str, user_id: str
+    ) -> None:
+        try:
+            self.service._check_rate_limit((platform, workspace_id, channel_id), user_id)
+        except RateLimitedError as e:
+            _record_outcome(platform, workspace_id, e)
+            raise
+
+    def _failed(self, job: _Job, error: Exception) -> None:
+        platform, workspace_id, channel_id, user_id, _ = job.args
+        if isinstance(error, _NOT_ADMITTED) and self.service.rate_limiter is not None:
+            self.service.rate_limiter.refund(platform, workspace_id, channel_id, user_id)
+        _record_outcome(platform, workspace_id, error)
+
+    def _submit(self, args: tuple, on_queued, loop) -> _Job:
+        if self._stopped.is_set():
+            raise RuntimeError("worker pool is stopped")
+        self.start()
+        job = _Job(next(self._ids), args, on_queued, loop)
+        with self._lock:
+            worker = self._workers[shard_for(args[:3], self.processes)]
+            self._send(worker, job)
+        return job
+
+    def _send(self, worker: _Worker, job: _Job) -> None:
+        job.attempts += 1
+        worker.pending[job.id] = job
+        worker.jobs.put((job.id, job.args, job.trace))
+
+    def _spawn(self, index: int) -> _Worker:
+        jobs = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.config, jobs, self._results),
+            name=f"rengabot-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        logger.info("Started worker process", extra={"worker": index, "pid": process.pid})
+        return _Worker(index, process, jobs)
+
+    def _read_results(self) -> None:
+        while True:
+            try:
+                message = self._results.get()
+            except Exception:
+                logger.exception("Could not read a worker result")
+                continue
+            if message is None:
+                return
+            kind, index, job_id, payload = message
+            with self._lock:
+                worker = self._workers[index]
+                if kind == _QUEUED:
+                    job = worker.pending.get(job_id)
+                else:
+                    job = worker.pending.pop(job_id, None)
+            if job is None:
+                continue
+            try:
+                if kind == _QUEUED:
+                    if job.on_queued and job.loop:
+                        asyncio.run_coroutine_threadsafe(job.on_queued(payload), job.loop)
+                elif kind == _DONE:
+                    _settle(job.future, result=payload)
+                else:
+                    _settle(job.future, error=_decode_error(payload))
+            except Exception as e:
+                # One bad message must not stop the reader, or every later
+                # change would wait forever.
+                logger.exception(
+                    "Could not handle a worker result", extra={"worker": index, "job": job_id}
+                )
+                _settle(job.future, error=GenerationError(f"unreadable worker result: {e!r}"))
+
+    def _monitor(self) -> None:
+        while not self._stopped.is_set():
+            with self._lock:
+                sentinels = {w.process.sentinel: w for w in self._workers}
+            for sentinel in wait(list(sentinels), timeout=0.5):
+                if self._stopped.is_set():
+                    return
+                self._restart(sentinels[sentinel])
+
+    def _restart(self, dead: _Worker) -> None:
+        exitcode = dead.process.exitcode
+        quick_deaths = 0
+        if time.monotonic() - dead.started < QUICK_DEATH_SECONDS:
+            quick_deaths = dead.quick_deaths + 1
+        # Let the result reader drain whatever the worker sent before dying,
+        # and back off if it keeps dying on startup (bad config, no API key).
+        time.sleep(min(MAX_RESTART_DELAY, 0.1 * 2 ** quick_deaths))
+        if self._stopped.is_set():
+            return
+        replacement = self._spawn(dead.index)
+        replacement.quick_deaths = quick_deaths
+        failed = []
+        with self._lock:
+            self._workers[dead.index] = replacement
+            self.restarts += 1
+            for job in dead.pending.values():
+                if job.attempts >= self.max_job_attempts:
+                    failed.append(job)
+                else:
+                    self._send(replacement, job)
+                    self.requeued += 1
+            dead.pending.clear()
+        logger.warning(
+            "Worker process died; restarted it",
+            extra={
+                "worker": dead.index,
+                "exitcode": exitcode,
+                "requeued": len(replacement.pending),
+                "failed": len(failed),
+            },
+        )
+        for job in failed:
+            _settle(job.future, error=WorkerCrashedError("worker process died"))
+
+
+def _worker_main(index: int, config: dict, jobs, results) -> None:
+    logging.basicConfig(
+        level=logging.INFO, format="%(levelname)s:%(processName)s:%(name)s:%(message)s"
+    )
+    from model import load_model
+
+    _configure_telemetry(config, index)
+    model_config = config["model"]
+    model = load_model(model_config["class"], model_config.get("args") or {})
+    service = GameService(model, **_shard_game_config(config.get("game") or {}, index))
+    asyncio.run(_serve(index, service, jobs, results))
+
+
+def _configure_telemetry(config: dict, index: int) -> None:
+    """Workers share neither the supervisor's metrics registry nor its span
+    file, so each serves metrics on its own port after the supervisor's
+    (port + 1 + index) and exports spans to its own file next to the
+    configured one (spans.worker0.jsonl, ...)."""
+    metrics_config = config.get("metrics") or {}
+    if metrics_config.get("enabled"):
+        port = metrics_config.get("port", 9464)
+        try:
+            metrics.serve(metrics_config.get("host", "127.0.0.1"), port + 1 + index if port else 0)
+        except OSError:
+            logger.warning(
+                "Could not serve worker metrics", extra={"worker": index}, exc_info=True
+            )
+    export_path = (config.get("tracing") or {}).get("export_path")
+    if export_path:
+        root, ext = os.path.splitext(export_path)
+        tracing.configure_export(f"{root}.worker{index}{ext}")
+
+
+def supervisor_game_config(game: dict) -> dict:
+    """Game config for the supervisor's own GameService: every rate limit
+    except the channel one, which the channel's worker enforces."""
+    limits = game.get("rate_limits")
+    if not limits or "channel" not in limits:
+        return game
+    return {**game, "rate_limits": {k: v for k, v in limits.items() if k != "channel"}}
+
+
+def _shard_game_config(game: dict, index: int) -> dict:
+    """Workers enforce only channel rate limits, since each channel lives on
+    one worker; user and workspace buckets would be multiplied by the number
+    of workers. Each saves its buckets to its own file. Shard indexes survive
+    restarts, so a restarted worker reloads the buckets it wrote."""
+    limits = game.get("rate_limits")
+    if not limits:
+        return game
+    if not limits.get("channel"):
+        return {k: v for k, v in game.items() if k != "rate_limits"}
+    shard_limits = {k: v for k, v in limits.items() if k not in ("user", "workspace")}
+    if limits.get("path"):
+        root, ext = os.path.splitext(limits["path"])
+        shard_limits["path"] = f"{root}.shard{index}{ext}"
+    return {**game, "rate_limits": shard_limits}
+
+
+async def _serve(index: int, service: GameService, jobs, results) -> None:
+    loop = asyncio.get_running_loop()
+    running: set[asyncio.Task] = set()
+    while True:
+        item = await loop.run_in_executor(None, jobs.get)
+        if item is None:
+            break
+        job_id, args, trace = item
+        # Tasks start in arrival order, which is what keeps each channel's
+        # changes in the order the supervisor received them.
+        task = asyncio.create_task(_run_job(index, service, results, job_id, args, trace))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    if running:
+        await asyncio.gather(*running, return_exceptions=True)
+
+
+async def _run_job(
+    index: int, service: GameService, results, job_id: int, args: tuple, trace
+) -> None:
+    async def on_queued(position: int) -> None:
+        results.put((_QUEUED, index, job_id, position))
+
+    try:
+        with tracing.continue_trace(trace):
+            path = await service.change_image_async(*args, on_queued=on_queued)
+    except Exception as e:
+        results.put((_ERROR, index, job_id, _encode_error(e)))
+        return
+    results.put((_DONE, index, job_id, path))
+
+
+def _encode_error(error: Exception) -> bytes:
+    """Game exceptions take constructor arguments that differ from their
+    args, so plain pickling can't rebuild them; send class, args and
+    attributes instead."""
+    try:
+        return pickle.dumps((type(error), error.args, dict(vars(error))))
+    except Exception:
+        return pickle.dumps((GenerationError, (repr(error),), {}))
+
+
+def _decode_error(payload: bytes) -> Exception:
+    cls, args, attrs = pickle.loads(payload)
+    error = cls.__new__(cls)
+    error.args = args
+    error.__dict__.update(attrs)
+    return error
+
+
+def _settle(future: Future, result=None, error: Optional[BaseException] = None) -> None:
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
@@ -7,6 +7,8 @@ import yaml
 from messengers import ChatMessenger, initialize_messenger
 from model import load_model
 from game.service import GameService
+from game.workers import ShardedGameService, supervisor_game_config
+from telemetry import metrics, tracing
 
 class ContextFormatter(logging.Formatter):
     _fields = ("platform", "workspace_id", "channel_id", "user_id", "path", "ext")
@@ -18,6 +20,9 @@ class ContextFormatter(logging.Formatter):
             value = getattr(record, key, None)
             if value:
                 parts.append(f"{key}={value}")
+        trace_id = getattr(record, "trace_id", None) or tracing.current_trace_id()
+        if trace_id:
+            parts.append(f"trace_id={trace_id}")
         if not parts:
             return base
         return f"{base} {' '.join(parts)}"
@@ -31,8 +36,23 @@ class Rengabot:
         self.config = config
 
         model_config = config["model"]
-        self.model = load_model(model_config["class"], model_config["args"])
-        self.service = GameService(self.model)
+        processes = (config.get("workers") or {}).get("processes", 0)
+        if processes:
+            # Changes run in worker processes, each with its own model.
+            self.model = None
+            self.service = ShardedGameService(
+                GameService(None, **supervisor_game_config(config.get("game") or {})),
+                {
+                    "model": model_config,
+                    "game": config.get("game"),
+                    "metrics": config.get("metrics"),
+                    "tracing": config.get("tracing"),
+                },
+                **config["workers"],
+            )
+        else:
+            self.model = load_model(model_config["class"], model_config["args"])
+            self.service = GameService(self.model, **(config.get("game") or {}))
 
         self.messengers = []
     
@@ -40,6 +60,8 @@ class Rengabot:
         os.replace(src_file, f"{path}/current.png")
 
     def run(self):
+        if isinstance(self.service, ShardedGameService):
+            self.service.start()
         threads = []
         for svc, svc_config in self.config["messengers"].items():
             if svc_config["enabled"]:
@@ -54,11 +76,21 @@ class Rengabot:
 if __name__ == '__main__':
     config = load_config()
     logging.basicConfig(level=logging.INFO)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(ContextFormatter(logging.BASIC_FORMAT))
     service_handler = logging.StreamHandler()
     service_formatter = ContextFormatter("%(levelname)s:%(name)s:%(message)s")
     service_handler.setFormatter(service_formatter)
     service_logger = logging.getLogger("game.service")
     service_logger.addHandler(service_handler)
     service_logger.propagate = False
+    metrics_config = config.get("metrics") or {}
+    if metrics_config.get("enabled"):
+        metrics.serve(
+            metrics_config.get("host", "127.0.0.1"),
+            metrics_config.get("port", 9464),
+        )
+    tracing_config = config.get("tracing") or {}
+    tracing.configure_export(tracing_config.get("export_path"))
     rengabot = Rengabot(config)
     rengabot.run()
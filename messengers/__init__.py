@@ -1,3 +1 @@
-from .base import ChatMessenger, initialize_messenger
-from . import slack
-from . import discord
+from .base import ChatMessenger, initialize_messenger, register
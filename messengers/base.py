@@ -1,3 +1,4 @@
+import importlib
 from abc import ABC, abstractmethod
 from typing import Callable, Dict, Type
 
@@ -11,6 +12,14 @@ class ChatMessenger(ABC):
         pass
         
 _REGISTRY: Dict[str, Type[ChatMessenger]] = {}
+
+# Built-in messengers by config name. Each module registers its class when
+# imported, so a platform's SDK is only loaded if that platform is enabled.
+# Other messengers can be loaded by setting `module` in their config.
+_MODULES: Dict[str, str] = {
+    "slack": "messengers.slack",
+    "discord": "messengers.discord",
+}
                 
 def register(name: str) -> Callable[[Type[ChatMessenger]], Type[ChatMessenger]]:
     def _decorator(cls: Type[ChatMessenger]) -> Type[ChatMessenger]:
@@ -23,6 +32,10 @@ def register(name: str) -> Callable[[Type[ChatMessenger]], Type[ChatMessenger]]:
     return _decorator
                                     
 def initialize_messenger(service, config, rengabot):
+    if service not in _REGISTRY:
+        module = (config or {}).get("module") or _MODULES.get(service)
+        if module:
+            importlib.import_module(module)
     if service in _REGISTRY:
         cls = _REGISTRY[service]
         return cls(config, rengabot)
@@ -1,22 +1,36 @@
 import asyncio
+import io
 import os
 import re
+import tempfile
 from typing import Optional
 
 import discord
 from discord import app_commands
 from game.service import (
     ChangeInProgressError,
+    ChangeQueueFullError,
     GenerationError,
     InvalidPromptError,
     InvalidImageError,
     ImageTooLargeError,
+    ModelUnavailableError,
     NoImageError,
+    RateLimitedError,
 )
 
+from telemetry import metrics, tracing
+
 from .base import ChatMessenger, register
 
 
+def _discard_upload(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
 @register("discord")
 class DiscordMessenger(ChatMessenger):
     def __init__(self, config, rengabot):
@@ -67,8 +81,16 @@ class DiscordMessenger(ChatMessenger):
                 )
                 return
 
-            await message.channel.send("Working on it...")
-            asyncio.create_task(self._handle_change_message(message, prompt))
+            with tracing.start_trace(
+                "discord.message",
+                platform="discord",
+                workspace_id=str(message.guild.id),
+                channel_id=str(message.channel.id),
+                user_id=str(message.author.id),
+                message_id=str(message.id),
+            ):
+                await message.channel.send("Working on it...")
+                asyncio.create_task(self._handle_change_message(message, prompt))
 
     def _is_admin(self, user: discord.abc.User) -> bool:
         if str(user.id) in self.config.get("admins", []):
@@ -92,14 +114,20 @@ class DiscordMessenger(ChatMessenger):
     async def _handle_change_message(self, message: discord.Message, prompt: str) -> None:
         guild_id = str(message.guild.id)
         channel_id = str(message.channel.id)
+
+        async def _on_queued(position: int):
+            await message.channel.send(
+                self.rengabot.service.format_queue_position(position)
+            )
+
         try:
-            next_path = await asyncio.to_thread(
-                self.rengabot.service.change_image,
+            next_path = await self.rengabot.service.change_image_async(
                 "discord",
                 guild_id,
                 channel_id,
                 str(message.author.id),
                 prompt,
+                on_queued=_on_queued,
             )
         except NoImageError:
             await message.channel.send(self.rengabot.service.NO_IMAGE_MESSAGE)
@@ -109,20 +137,42 @@ class DiscordMessenger(ChatMessenger):
                 self.rengabot.service.format_invalid_prompt(e.reason)
             )
             return
+        except ChangeQueueFullError:
+            await message.channel.send(self.rengabot.service.QUEUE_FULL_MESSAGE)
+            return
         except ChangeInProgressError:
             await message.channel.send(
                 self.rengabot.service.CHANGE_IN_PROGRESS_MESSAGE
             )
             return
+        except RateLimitedError as e:
+            await message.channel.send(
+                self.rengabot.service.format_rate_limited(e.retry_after, e.scope)
+            )
+            return
+        except ModelUnavailableError as e:
+            await message.channel.send(
+                self.rengabot.service.format_model_unavailable(e.retry_after)
+            )
+            return
         except GenerationError:
             await message.channel.send(
                 self.rengabot.service.GENERATION_ERROR_MESSAGE
             )
             return
 
-        await message.channel.send(
-            file=discord.File(next_path, filename="renga.png"),
+        image_bytes = await self.rengabot.service.read_image_async(
+            "discord", guild_id, channel_id, next_path
         )
+        with metrics.timed(
+            "rengabot_upload_seconds", platform="discord", workspace=guild_id
+        ), tracing.span("discord.upload"):
+            await message.channel.send(
+                file=discord.File(
+                    io.BytesIO(image_bytes),
+                    filename=self.rengabot.service.upload_filename(next_path),
+                ),
+            )
 
     def _register_commands(self):
         guild = discord.Object(id=int(self.guild_id)) if self.guild_id else None
@@ -182,18 +232,27 @@ class DiscordMessenger(ChatMessenger):
             ext = (image.filename.split(".")[-1] or "png").lower()
             if ext not in ("png", "jpg", "jpeg"):
                 ext = "png"
-            dest_path = os.path.join(dest_dir, f"current.{ext}")
-            await image.save(dest_path)
+            fd, upload_path = tempfile.mkstemp(
+                dir=dest_dir, prefix=".upload.", suffix=f".{ext}"
+            )
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    await image.save(out)
+            except BaseException:
+                _discard_upload(upload_path)
+                raise
             try:
-                self.rengabot.service.save_image_file(
+                dest_path = await asyncio.to_thread(
+                    self.rengabot.service.save_image_file,
                     "discord",
                     guild_id,
                     channel_id,
                     str(interaction.user.id),
-                    dest_path,
+                    upload_path,
                     ext,
                 )
             except ImageTooLargeError as e:
+                _discard_upload(upload_path)
                 await interaction.followup.send(
                     (
                         "Image is too large. Max resolution is "
@@ -203,19 +262,27 @@ class DiscordMessenger(ChatMessenger):
                 )
                 return
             except InvalidImageError:
+                _discard_upload(upload_path)
                 await interaction.followup.send(
                     "Uploaded file could not be opened as an image.",
                     ephemeral=True,
                 )
                 return
 
+            # With remote storage dest_path is an object key, not a file.
+            image_bytes = await self.rengabot.service.read_image_async(
+                "discord", guild_id, channel_id, dest_path
+            )
             await interaction.followup.send(
                 f"The renga has been reset: {description or '(no description)'}",
                 ephemeral=False,
             )
             await interaction.channel.send(
                 content=f"Renga reset: {description or '(no description)'}",
-                file=discord.File(dest_path, filename="renga.png"),
+                file=discord.File(
+                    io.BytesIO(image_bytes),
+                    filename=self.rengabot.service.upload_filename(dest_path),
+                ),
             )
 
         @group.command(
@@ -227,21 +294,29 @@ class DiscordMessenger(ChatMessenger):
 
             guild_id = str(interaction.guild_id)
             channel_id = str(interaction.channel_id)
-            try:
-                current_path = self.rengabot.service.show_image(
-                    "discord", guild_id, channel_id
-                )
-            except NoImageError:
+            current_path = await self.rengabot.service.get_current_image_path_async(
+                "discord", guild_id, channel_id
+            )
+            if not current_path:
                 await interaction.followup.send(
                     self.rengabot.service.NO_IMAGE_MESSAGE,
                     ephemeral=True,
                 )
                 return
 
-            await interaction.channel.send(
-                content="Current renga image:",
-                file=discord.File(current_path, filename="renga.png"),
+            image_bytes = await self.rengabot.service.read_image_async(
+                "discord", guild_id, channel_id, current_path
             )
+            with metrics.timed(
+                "rengabot_upload_seconds", platform="discord", workspace=guild_id
+            ):
+                await interaction.channel.send(
+                    content="Current renga image:",
+                    file=discord.File(
+                        io.BytesIO(image_bytes),
+                        filename=self.rengabot.service.upload_filename(current_path),
+                    ),
+                )
             await interaction.followup.send("Posted the current image.", ephemeral=True)
 
     def run(self):
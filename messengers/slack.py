@@ -1,19 +1,26 @@
+import aiohttp
 import asyncio
 import json
 import os
-import requests
 import re
+import tempfile
+from typing import Optional
 from .base import ChatMessenger, register
 from slack_bolt.async_app import AsyncApp
 from slack_bolt.adapter.socket_mode.aiohttp import AsyncSocketModeHandler
 from game.service import (
     ChangeInProgressError,
+    ChangeQueueFullError,
     GenerationError,
     InvalidPromptError,
     InvalidImageError,
     ImageTooLargeError,
+    ModelUnavailableError,
     NoImageError,
+    RateLimitedError,
 )
+from game.imaging import sniff_image_type
+from telemetry import metrics, tracing
 
 HELP_MESSAGE = """Available subcommands:
 - *set-image* - (admin only) Set or reset the starting image
@@ -25,6 +32,36 @@ CHANGE_USAGE = """To make a change, mention the bot in a channel with your reque
 Example: @rengabot add an angry dinosaur in the background
 """
 
+DEFAULT_MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+HEADER_SIZE = 8
+
+class DownloadTooLargeError(Exception):
+    pass
+
+def _check_image_header(header: bytes) -> None:
+    if not sniff_image_type(header):
+        raise InvalidImageError("not a PNG or JPEG image")
+
+def _write_upload(dest_dir: str, ext: str, data: bytes) -> str:
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, local_path = tempfile.mkstemp(dir=dest_dir, prefix=".upload.", suffix=f".{ext}")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(data)
+    except BaseException:
+        _discard_upload(local_path)
+        raise
+    return local_path
+
+
+def _discard_upload(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
 @register("slack")
 class SlackMessenger(ChatMessenger):
     def __init__(self, config, rengabot):
@@ -44,15 +81,20 @@ class SlackMessenger(ChatMessenger):
         else:
             raise Exception("no app token set for Slack")
         
+        self.max_upload_bytes = config.get("max_upload_bytes", DEFAULT_MAX_UPLOAD_BYTES)
+        self.download_concurrency = config.get(
+            "download_concurrency", DEFAULT_DOWNLOAD_CONCURRENCY
+        )
+        # Created on first use so they bind to the messenger's event loop.
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        self._download_slots: Optional[asyncio.Semaphore] = None
+
         self.app = AsyncApp(token=self.bot_token)
         self.register_listeners()
 
     def _is_admin(self, user_id: str) -> bool:
         return user_id in self.config.get("admins", [])
 
-    def _get_current_image_path(self, team_id: str, channel_id: str):
-        return self.rengabot.service.get_current_image_path("slack", team_id, channel_id)
-
     def register_listeners(self):
         self.app.event("app_mention")(self.handle_mention)
         self.app.command("/rengabot")(self.handle_slash_cmd)
@@ -77,12 +119,20 @@ class SlackMessenger(ChatMessenger):
         team_id = body.get("team_id", "")
         user_id = event.get("user", "")
 
-        await say("Working on it...")
-        task = asyncio.create_task(
-            self._handle_change_async(
-                client, logger, user_id, team_id, channel_id, prompt
+        with tracing.start_trace(
+            "slack.mention",
+            platform="slack",
+            workspace_id=team_id,
+            channel_id=channel_id,
+            user_id=user_id,
+            event_ts=event.get("ts"),
+        ):
+            await say("Working on it...")
+            task = asyncio.create_task(
+                self._handle_change_async(
+                    client, logger, user_id, team_id, channel_id, prompt
+                )
             )
-        )
         return task
 
     async def _handle_change_async(
@@ -94,14 +144,20 @@ class SlackMessenger(ChatMessenger):
         channel_id: str,
         prompt: str,
     ):
+        async def _on_queued(position: int):
+            await client.chat_postMessage(
+                channel=channel_id,
+                text=self.rengabot.service.format_queue_position(position),
+            )
+
         try:
-            next_path = await asyncio.to_thread(
-                self.rengabot.service.change_image,
+            next_path = await self.rengabot.service.change_image_async(
                 "slack",
                 team_id,
                 channel_id,
                 user_id,
                 prompt,
+                on_queued=_on_queued,
             )
         except NoImageError:
             await client.chat_postMessage(
@@ -115,12 +171,31 @@ class SlackMessenger(ChatMessenger):
                 text=self.rengabot.service.format_invalid_prompt(e.reason),
             )
             return
+        except ChangeQueueFullError:
+            await client.chat_postMessage(
+                channel=channel_id,
+                text=self.rengabot.service.QUEUE_FULL_MESSAGE,
+            )
+            return
         except ChangeInProgressError:
             await client.chat_postMessage(
                 channel=channel_id,
                 text=self.rengabot.service.CHANGE_IN_PROGRESS_MESSAGE,
             )
             return
+        except RateLimitedError as e:
+            await client.chat_postEphemeral(
+                channel=channel_id,
+                user=user_id,
+                text=self.rengabot.service.format_rate_limited(e.retry_after, e.scope),
+            )
+            return
+        except ModelUnavailableError as e:
+            await client.chat_postMessage(
+                channel=channel_id,
+                text=self.rengabot.service.format_model_unavailable(e.retry_after),
+            )
+            return
         except GenerationError as e:
             logger.exception("Image generation failed: %s", e)
             await client.chat_postMessage(
@@ -128,11 +203,17 @@ class SlackMessenger(ChatMessenger):
                 text=self.rengabot.service.GENERATION_ERROR_MESSAGE,
             )
             return
-        await client.files_upload_v2(
-            channel=channel_id,
-            file=next_path,
-            filename="renga.png",
+        image_bytes = await self.rengabot.service.read_image_async(
+            "slack", team_id, channel_id, next_path
         )
+        with metrics.timed(
+            "rengabot_upload_seconds", platform="slack", workspace=team_id
+        ), tracing.span("slack.upload"):
+            await client.files_upload_v2(
+                channel=channel_id,
+                content=image_bytes,
+                filename=self.rengabot.service.upload_filename(next_path),
+            )
 
     async def handle_slash_cmd(self, ack, body, respond, client, logger):
         await ack()
@@ -191,19 +272,27 @@ class SlackMessenger(ChatMessenger):
             case "show-image":
                 channel_id = body.get("channel_id", "")
                 team_id = body.get("team_id", "")
-                current_path = self._get_current_image_path(team_id, channel_id)
+                current_path = await self.rengabot.service.get_current_image_path_async(
+                    "slack", team_id, channel_id
+                )
                 if not current_path:
                     await respond(
                         text=self.rengabot.service.NO_IMAGE_MESSAGE,
                         response_type="ephemeral",
                     )
                     return
-                await client.files_upload_v2(
-                    channel=channel_id,
-                    file=current_path,
-                    filename="renga.png",
-                    initial_comment="Current renga image:",
+                image_bytes = await self.rengabot.service.read_image_async(
+                    "slack", team_id, channel_id, current_path
                 )
+                with metrics.timed(
+                    "rengabot_upload_seconds", platform="slack", workspace=team_id
+                ):
+                    await client.files_upload_v2(
+                        channel=channel_id,
+                        content=image_bytes,
+                        filename=self.rengabot.service.upload_filename(current_path),
+                        initial_comment="Current renga image:",
+                    )
 
     async def handle_set_image_upload(self, ack, body, client, logger):
         private_metadata = json.loads(body["view"]["private_metadata"])
@@ -237,37 +326,54 @@ class SlackMessenger(ChatMessenger):
         if file_ext not in ("png", "jpg", "jpeg"):
             file_ext = "png"
 
-        # Download the image
-        try:
-            url = f.get("url_private_download") or f.get("url_private")
-            original_name = f.get("name") or f.get("title") or f"slack-file-{file_id}"
-
-            # Ensure a safe local path
-            # TODO: figure out where files should actually go
-            dest_path = self.rengabot.service.channel_dir("slack", team_id, channel_id)
-            os.makedirs(dest_path, exist_ok=True)
-            local_path = os.path.join(dest_path, f"current.{file_ext}")
+        declared_size = f.get("size") or 0
+        if declared_size > self.max_upload_bytes:
+            await client.chat_postEphemeral(
+                channel=channel_id,
+                user=user_id,
+                text=self._upload_too_large_message(),
+            )
+            return
 
-            # Stream download with bot token
-            resp = requests.get(
-                url,
-                headers={"Authorization": f"Bearer {self.bot_token}"},
-                stream=True,
-                timeout=60,
+        url = f.get("url_private_download") or f.get("url_private")
+        dest_dir = self.rengabot.service.channel_dir("slack", team_id, channel_id)
+        try:
+            local_path = await self._download_file(url, dest_dir, file_ext)
+        except DownloadTooLargeError:
+            await client.chat_postEphemeral(
+                channel=channel_id,
+                user=user_id,
+                text=self._upload_too_large_message(),
+            )
+            return
+        except InvalidImageError:
+            await client.chat_postEphemeral(
+                channel=channel_id,
+                user=user_id,
+                text="Uploaded file is not a PNG or JPEG image.",
             )
-            resp.raise_for_status()
-            with open(local_path, "wb") as out:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        out.write(chunk)
+            return
         except Exception as e:
-            logger.exception("Local save failed: %s", e)
-            
+            logger.exception("Image download failed: %s", e)
+            await client.chat_postEphemeral(
+                channel=channel_id,
+                user=user_id,
+                text="Could not download the uploaded image. Please try again.",
+            )
+            return
+
         try:
-            self.rengabot.service.save_image_file(
-                "slack", team_id, channel_id, user_id, local_path, file_ext
+            await asyncio.to_thread(
+                self.rengabot.service.save_image_file,
+                "slack",
+                team_id,
+                channel_id,
+                user_id,
+                local_path,
+                file_ext,
             )
         except ImageTooLargeError as e:
+            _discard_upload(local_path)
             await client.chat_postEphemeral(
                 channel=channel_id,
                 user=user_id,
@@ -278,6 +384,7 @@ class SlackMessenger(ChatMessenger):
             )
             return
         except InvalidImageError:
+            _discard_upload(local_path)
             await client.chat_postEphemeral(
                 channel=channel_id,
                 user=user_id,
@@ -291,8 +398,59 @@ class SlackMessenger(ChatMessenger):
             text=f"The renga has been reset.\n{file_permalink}"
         )
 
+    def _upload_too_large_message(self) -> str:
+        max_mb = self.max_upload_bytes / (1024 * 1024)
+        return f"Image file is too large. Max size is {max_mb:.0f}MB."
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.download_concurrency),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        return self._http_session
+
+    async def _download_file(self, url: str, dest_dir: str, ext: str) -> str:
+        """Download a private Slack file into a temp file under dest_dir without
+        blocking the event loop. Chunks are buffered in memory, which
+        max_upload_bytes bounds, and written out in one go on a worker thread.
+        The download is abandoned as soon as the declared or received size
+        passes max_upload_bytes, or the first bytes are not a PNG/JPEG header."""
+        if self._download_slots is None:
+            self._download_slots = asyncio.Semaphore(self.download_concurrency)
+        async with self._download_slots:
+            session = self._get_http_session()
+            async with session.get(
+                url, headers={"Authorization": f"Bearer {self.bot_token}"}
+            ) as resp:
+                resp.raise_for_status()
+                if (resp.content_length or 0) > self.max_upload_bytes:
+                    raise DownloadTooLargeError()
+                chunks = []
+                received = 0
+                header = b""
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    if len(header) < HEADER_SIZE:
+                        header += chunk[: HEADER_SIZE - len(header)]
+                        if len(header) == HEADER_SIZE:
+                            _check_image_header(header)
+                    received += len(chunk)
+                    if received > self.max_upload_bytes:
+                        raise DownloadTooLargeError()
+                    chunks.append(chunk)
+                if len(header) < HEADER_SIZE:
+                    _check_image_header(header)
+        return await asyncio.to_thread(_write_upload, dest_dir, ext, b"".join(chunks))
+
+    async def _close_http_session(self):
+        if self._http_session is not None:
+            await self._http_session.close()
+
     def run(self):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         handler = AsyncSocketModeHandler(self.app, self.app_token, loop=loop)
-        loop.run_until_complete(handler.start_async())
+        try:
+            loop.run_until_complete(handler.start_async())
+        finally:
+            loop.run_until_complete(self._close_http_session())
@@ -1,8 +1,14 @@
+import asyncio
 import importlib
 from abc import ABC, abstractmethod
 from typing import Tuple
 
 class AIModel(ABC):
+    # Models may also implement prepare_image_input(image_bytes, mime_type)
+    # together with generate_image_from_input(prompt, image_input) and its
+    # _async variant. GameService then caches the prepared input per image
+    # version instead of handing the model a path to re-read every turn.
+
     @abstractmethod
     def validate_prompt(self, prompt: str) -> Tuple[bool, str]:
         pass
@@ -10,6 +16,16 @@ class AIModel(ABC):
     @abstractmethod
     def generate_image(self, prompt: str, image_path: str) -> bytes:
         pass
+
+    async def validate_prompt_async(self, prompt: str) -> Tuple[bool, str]:
+        """Async counterpart of validate_prompt. Models with a native async
+        client should override this; the default runs the blocking call in a
+        worker thread."""
+        return await asyncio.to_thread(self.validate_prompt, prompt)
+
+    async def generate_image_async(self, prompt: str, image_path: str) -> bytes:
+        """Async counterpart of generate_image, see validate_prompt_async."""
+        return await asyncio.to_thread(self.generate_image, prompt, image_path)
     
 def load_model(class_path: str, args: dict):
     module_name, class_name = class_path.rsplit(".", 1)
@@ -0,0 +1,171 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Verdict = Tuple[bool, Optional[str]]
+
+
+class BatchParseError(ValueError):
+    """The model's answer to a batched request didn't line up with the
+    prompts that were sent."""
+
+
+class ValidationBatcher:
+    """Collects validation requests from every channel for up to `window`
+    seconds (or until max_batch are waiting) and sends them as one request.
+    Callers on any thread or event loop get their own verdict back; if the
+    batched answer can't be parsed, each prompt is validated on its own."""
+
+    def __init__(
+        self,
+        validate_batch: Callable[[list[str]], list[Verdict]],
+        validate_one: Callable[[str], Verdict],
+        window: float = 0.05,
+        max_batch: int = 16,
+        max_workers: int = 8,
+    ):
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        self.validate_batch = validate_batch
+        self.validate_one = validate_one
+        self.window = window
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending: list[tuple[str, Future, contextvars.Context]] = []
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="rengabot-validate-batch"
+        )
+        self.batches = 0
+        self.batched_prompts = 0
+        self.single_calls = 0
+        self.fallbacks = 0
+
+    def validate(self, prompt: str) -> Verdict:
+        return self.submit(prompt).result()
+
+    async def validate_async(self, prompt: str) -> Verdict:
+        return await asyncio.wrap_future(self.submit(prompt))
+
+    def submit(self, prompt: str) -> Future:
+        future: Future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("validation batcher is stopped")
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name="rengabot-validate-batcher"
+                )
+                self._thread.start()
+            self._pending.append((prompt, future, contextvars.copy_context()))
+            self._cond.notify()
+        return future
+
+    def stop(self, timeout: float = 5.0) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "batches": self.batches,
+                "batched_prompts": self.batched_prompts,
+                "mean_batch_size": (
+                    self.batched_prompts / self.batches if self.batches else 0.0
+                ),
+                "single_calls": self.single_calls,
+                "fallbacks": self.fallbacks,
+                "pending": len(self._pending),
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # The window opens with the first waiting prompt, so a lone
+                # request is delayed by at most `window`.
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+            # A batch runs in the context of its first caller, so the
+            # batched request joins that caller's trace.
+            self._executor.submit(batch[0][2].copy().run, self._dispatch, batch)
+
+    def _dispatch(self, batch: list[tuple[str, Future, contextvars.Context]]) -> None:
+        batch = [(p, f, c) for p, f, c in batch if f.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        # The same prompt from several channels only needs one verdict.
+        prompts = list(dict.fromkeys(p for p, _, _ in batch))
+        if len(prompts) == 1:
+            self._validate_singly(prompts[0], [f for _, f, _ in batch])
+            return
+        try:
+            verdicts = self.validate_batch(prompts)
+        except BatchParseError as e:
+            logger.warning(
+                "Batched validation response was unusable; validating prompts singly",
+                extra={"batch_size": len(prompts), "error": repr(e)},
+            )
+            with self._cond:
+                self.fallbacks += 1
+            for prompt in prompts:
+                entries = [(f, c) for p, f, c in batch if p == prompt]
+                self._executor.submit(
+                    entries[0][1].copy().run,
+                    self._validate_singly,
+                    prompt,
+                    [f for f, _ in entries],
+                )
+            return
+        except Exception as e:
+            for _, future, _ in batch:
+                _settle(future, error=e)
+            return
+        with self._cond:
+            self.batches += 1
+            self.batched_prompts += len(prompts)
+        by_prompt = dict(zip(prompts, verdicts))
+        for prompt, future, _ in batch:
+            _settle(future, result=by_prompt[prompt])
+
+    def _validate_singly(self, prompt: str, futures: list[Future]) -> None:
+        with self._cond:
+            self.single_calls += 1
+        try:
+            verdict = self.validate_one(prompt)
+        except Exception as e:
+            for future in futures:
+                _settle(future, error=e)
+            return
+        for future in futures:
+            _settle(future, result=verdict)
+
+
+def _settle(future: Future, result=None, error: Optional[BaseException] = None) -> None:
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
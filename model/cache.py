@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from cachetools import TLRUCache
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION = " \t\n.,;:!?\"'`"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse the trivial differences between repeats of the same prompt
+    (case, whitespace, surrounding punctuation) so they share a cache key."""
+    text = re.sub(r"\s+", " ", (prompt or "").lower())
+    return text.strip(_PUNCTUATION)
+
+
+class ValidationCache:
+    """Bounded LRU cache of validation verdicts where every entry also expires
+    after a TTL. Both valid and invalid verdicts are cached. If a path is given
+    the cache is saved to disk as JSON every save_interval seconds by a
+    background thread, so it survives restarts without a write per miss."""
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 86400,
+        path: Optional[str] = None,
+        save_interval: float = 5.0,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = TLRUCache(
+            maxsize=maxsize,
+            ttu=lambda _key, value, _now: value[2],
+            timer=time.time,
+        )
+        self._dirty = False
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if self.path:
+            self._load()
+            self._thread = threading.Thread(
+                target=self._save_loop, daemon=True, name="rengabot-validation-cache"
+            )
+            self._thread.start()
+
+    def get(self, prompt: str) -> Optional[Tuple[bool, Optional[str]]]:
+        key = normalize_prompt(prompt)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return (entry[0], entry[1])
+
+    def __contains__(self, prompt: str) -> bool:
+        """Whether a live verdict is cached, without counting a lookup."""
+        key = normalize_prompt(prompt)
+        with self._lock:
+            return key in self._cache
+
+    def put(self, prompt: str, valid: bool, reason: Optional[str]) -> None:
+        key = normalize_prompt(prompt)
+        if not key:
+            return
+        with self._lock:
+            self._cache[key] = (bool(valid), reason, time.time() + self.ttl)
+            self._dirty = True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._cache),
+                "maxsize": self.maxsize,
+            }
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = [[key, *value] for key, value in self._cache.items()]
+            self._dirty = False
+        # Several worker processes may share the file, so each writes its
+        # own temp file and the last rename wins.
+        tmp_path = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            logger.exception("Failed to persist validation cache.")
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(5.0)
+        if self.path:
+            self.save()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception:
+            logger.exception("Failed to load validation cache; starting empty.")
+            return
+        now = time.time()
+        for key, valid, reason, expires_at in entries:
+            if expires_at > now:
+                self._cache[key] = (valid, reason, expires_at)
+
+    def _save_loop(self) -> None:
+        while not self._stopped.wait(self.save_interval):
+            self.save()
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ModelFailover:
+    """Ordered list of interchangeable models. Calls go to the first healthy
+    model; one that fails failure_threshold times in a row, or is reported
+    missing, is demoted for `cooldown` seconds and only tried after all the
+    healthy ones, so a broken primary doesn't add a failed call to every turn."""
+
+    def __init__(self, models: list[str], failure_threshold: int = 2, cooldown: float = 300.0):
+        if not models:
+            raise ValueError("at least one model is required")
+        self.models = list(models)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures: dict[str, int] = {}
+        self._demoted_until: dict[str, float] = {}
+        self.demotions = 0
+        self.failovers = 0
+
+    def order(self) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            for model, until in list(self._demoted_until.items()):
+                if until <= now:
+                    del self._demoted_until[model]
+            healthy = [m for m in self.models if m not in self._demoted_until]
+            demoted = sorted(self._demoted_until, key=self._demoted_until.get)
+        return healthy + demoted
+
+    def record_success(self, model: str, attempt: int = 0) -> None:
+        with self._lock:
+            self._failures.pop(model, None)
+            self._demoted_until.pop(model, None)
+            if attempt:
+                self.failovers += 1
+
+    def record_failure(self, model: str) -> None:
+        with self._lock:
+            failures = self._failures.get(model, 0) + 1
+            self._failures[model] = failures
+        if failures >= self.failure_threshold:
+            self.demote(model)
+
+    def demote(self, model: str) -> None:
+        with self._lock:
+            self._failures.pop(model, None)
+            self._demoted_until[model] = time.monotonic() + self.cooldown
+            self.demotions += 1
+        logger.warning(
+            "Demoted image model",
+            extra={"model": model, "cooldown": self.cooldown},
+        )
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "demoted": {
+                    m: round(until - now, 1)
+                    for m, until in self._demoted_until.items()
+                    if until > now
+                },
+                "demotions": self.demotions,
+                "failovers": self.failovers,
+            }
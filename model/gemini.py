@@ -1,10 +1,21 @@
+import asyncio
 import json
 import logging
 import os
-from typing import Tuple
-from google import genai
-from google.genai import types
+import threading
+import time
+from typing import TYPE_CHECKING, Optional, Tuple
+from telemetry import metrics, tracing
 from .base import AIModel
+from .batching import BatchParseError, ValidationBatcher
+from .cache import ValidationCache
+from .failover import ModelFailover
+from .intent_cache import IntentCacheManager
+from .retry import Hedger, RetryPolicy, is_retryable
+
+if TYPE_CHECKING:
+    from google import genai
+    from google.genai import types
 
 DEFAULT_INTENT_MODEL = "gemini-2.5-flash-lite"
 DEFAULT_IMAGE_MODEL = "gemini-2.5-flash-image"
@@ -36,6 +47,14 @@ the prompt was deemed valid.
 The user's prompt is: 
 """
 
+BATCH_VALIDATION_PROMPT = """
+This time there are several prompts from different players, given below as a
+JSON array of strings. Judge each prompt on its own. Respond with a JSON array
+that has exactly one object per prompt, in the same order, each with the
+"valid" and "reason" fields described above.
+The prompts are:
+"""
+
 logger = logging.getLogger(__name__)
 
 class GeminiModel(AIModel):
@@ -44,7 +63,23 @@ class GeminiModel(AIModel):
         api_key=None,
         intent_model=DEFAULT_INTENT_MODEL,
         image_model=DEFAULT_IMAGE_MODEL,
+        image_models=None,
+        image_model_failure_threshold=2,
+        image_model_cooldown=300,
+        model_discovery_ttl=3600,
         intent_cache_ttl=None,
+        validation_cache_size=1024,
+        validation_cache_ttl=86400,
+        validation_cache_path=None,
+        validation_cache_save_interval=5.0,
+        retry_attempts=3,
+        retry_initial_backoff=0.5,
+        retry_max_backoff=8.0,
+        validation_hedge_percentile=None,
+        validation_hedge_min_samples=20,
+        validation_batch_window=None,
+        validation_batch_size=16,
+        preload_client=True,
     ):
         if os.environ.get("GEMINI_API_KEY"):
             self.api_key = os.environ["GEMINI_API_KEY"]
@@ -53,105 +88,381 @@ class GeminiModel(AIModel):
         else:
             raise Exception("no API key set for Gemini")
         self.intent_model = intent_model
-        self.image_model = image_model
-        self.client = genai.Client(api_key=self.api_key)
+        # image_models is an ordered fallback list; image_model is kept for
+        # configs that only name one.
+        self.image_failover = ModelFailover(
+            image_models or [image_model],
+            failure_threshold=image_model_failure_threshold,
+            cooldown=image_model_cooldown,
+        )
+        self.image_model = self.image_failover.models[0]
+        self.model_discovery_ttl = model_discovery_ttl
+        self._discovered_image_models: Optional[tuple[float, list[str]]] = None
+        self._discovery_lock = threading.Lock()
+        # google.genai takes about a second to import, so the client is built
+        # on first use. By default that happens on a background thread right
+        # away, which keeps it off both the startup path and the first turn.
+        self._client = None
+        self._client_lock = threading.Lock()
+        if preload_client:
+            threading.Thread(
+                target=self._preload_client, daemon=True, name="rengabot-genai-import"
+            ).start()
+        self.retry = RetryPolicy(
+            attempts=retry_attempts,
+            initial_backoff=retry_initial_backoff,
+            max_backoff=retry_max_backoff,
+        )
+        self.validation_hedger = None
+        if validation_hedge_percentile:
+            self.validation_hedger = Hedger(
+                "validate",
+                percentile=validation_hedge_percentile,
+                min_samples=validation_hedge_min_samples,
+            )
         self.intent_cache_ttl = intent_cache_ttl
-        self._intent_cache_name = None
+        # The rules prompt is cached server-side by a background thread; until
+        # it is ready (or if it can't be made) the rules are sent inline.
+        self.intent_cache = None
         if self.intent_cache_ttl:
-            try:
-                self._intent_cache_name = self._ensure_intent_cache()
-            except Exception:
-                logger.exception("Failed to create intent cache; falling back to inline prompt.")
-                self._intent_cache_name = None
-        
+            self.intent_cache = IntentCacheManager(
+                lambda: self.client,
+                self.intent_model,
+                _validation_rules_contents,
+                intent_cache_ttl,
+            )
+            self.intent_cache.start()
+            if metrics.registry() is not None:
+                metrics.register_collector(self.intent_cache.collect_metrics)
+        # Validation requests arriving within a short window share one API
+        # call, so the rules preamble is sent (and billed) once per batch.
+        self.validation_batcher = None
+        if validation_batch_window:
+            self.validation_batcher = ValidationBatcher(
+                self._validate_batch,
+                self._validate_uncached,
+                window=validation_batch_window,
+                max_batch=validation_batch_size,
+            )
+        self.validation_cache = None
+        if validation_cache_size:
+            self.validation_cache = ValidationCache(
+                maxsize=validation_cache_size,
+                ttl=validation_cache_ttl,
+                path=validation_cache_path,
+                save_interval=validation_cache_save_interval,
+            )
+
+    @property
+    def client(self) -> "genai.Client":
+        if self._client is None:
+            from google import genai
+
+            client = genai.Client(api_key=self.api_key)
+            with self._client_lock:
+                if self._client is None:
+                    self._client = client
+        return self._client
+
+    @client.setter
+    def client(self, value) -> None:
+        with self._client_lock:
+            self._client = value
+
+    def _preload_client(self) -> None:
+        try:
+            self.client
+        except Exception:
+            logger.exception("Failed to create the Gemini client")
+
     def validate_prompt(self, prompt: str) -> Tuple[bool, str]:
         """Make sure the user's prompt obeys the rules of the game. We do this
         separately from the image generation so we can use a cheaper model.
         Return a tuple of bool, str where the bool is whether the prompt
         was valid or not, and the string is what was wrong with the prompt
         if it wasn't deemed valid."""
-        if self._intent_cache_name:
+        if self.validation_cache:
+            cached = self.validation_cache.get(prompt)
+            if cached is not None:
+                return cached
+        if self.validation_batcher:
+            return self.validation_batcher.validate(prompt)
+        return self._validate_uncached(prompt)
+
+    async def validate_prompt_async(self, prompt: str) -> Tuple[bool, str]:
+        """Same as validate_prompt, but uses the async genai client so no
+        thread is held while waiting on the model."""
+        if self.validation_cache:
+            cached = self.validation_cache.get(prompt)
+            if cached is not None:
+                return cached
+        if self.validation_batcher:
+            return await self.validation_batcher.validate_async(prompt)
+        cache_name = self.intent_cache.name() if self.intent_cache else None
+        if cache_name:
             try:
-                response = self._generate_validation(prompt, self._intent_cache_name)
+                response = await self._generate_validation_async(prompt, cache_name)
             except Exception as e:
-                if self.intent_cache_ttl and "not found" in str(e).lower():
-                    self._intent_cache_name = self._ensure_intent_cache()
-                    response = self._generate_validation(prompt, self._intent_cache_name)
-                else:
+                if "not found" not in str(e).lower():
                     raise
+                self.intent_cache.invalidate(cache_name)
+                response = await self._generate_validation_async(prompt, None)
         else:
-            response = self._generate_validation(prompt, None)
+            response = await self._generate_validation_async(prompt, None)
+        return self._parse_validation(prompt, response)
+
+    def _validate_uncached(self, prompt: str) -> Tuple[bool, str]:
+        response = self._with_intent_cache(
+            lambda cache_name: self._generate_validation(prompt, cache_name)
+        )
+        return self._parse_validation(prompt, response)
+
+    def _validate_batch(self, prompts: list[str]) -> list[Tuple[bool, str]]:
+        """One request for several prompts. Raises BatchParseError when the
+        answer isn't a verdict per prompt so the batcher can retry singly."""
+        contents = BATCH_VALIDATION_PROMPT + json.dumps(prompts)
+        response = self._with_intent_cache(
+            lambda cache_name: self._generate_validation(
+                contents, cache_name, hedge=False, batch_size=len(prompts)
+            )
+        )
+        try:
+            r = json.loads(response.text)
+        except Exception as e:
+            raise BatchParseError(f"response is not JSON: {e}") from e
+        if not isinstance(r, list) or len(r) != len(prompts):
+            raise BatchParseError(f"expected {len(prompts)} verdicts")
+        if not all(isinstance(v, dict) and isinstance(v.get("valid"), bool) for v in r):
+            raise BatchParseError("verdict without a boolean 'valid' field")
+        verdicts = [(v["valid"], v.get("reason")) for v in r]
+        if self.validation_cache:
+            for prompt, verdict in zip(prompts, verdicts):
+                self.validation_cache.put(prompt, *verdict)
+        return verdicts
+
+    def _with_intent_cache(self, send):
+        cache_name = self.intent_cache.name() if self.intent_cache else None
+        if not cache_name:
+            return send(None)
+        try:
+            return send(cache_name)
+        except Exception as e:
+            if "not found" not in str(e).lower():
+                raise
+            self.intent_cache.invalidate(cache_name)
+            return send(None)
+
+    def _parse_validation(self, prompt: str, response) -> Tuple[bool, str]:
         try:
             r = json.loads(response.text)
         except Exception:
             return (False, "AI model returned a bad response")
-        return (r.get("valid", False), r.get("reason"))
+        verdict = (r.get("valid", False), r.get("reason"))
+        if self.validation_cache:
+            self.validation_cache.put(prompt, *verdict)
+        return verdict
+
+    def prepare_image_input(self, image_bytes: bytes, mime_type: str) -> "types.Part":
+        from google.genai import types
+
+        return types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
 
     def generate_image(self, prompt: str, image_path: str) -> bytes:
-        with open(image_path, "rb") as f:
-            image_bytes = f.read()
-        mime_type = _guess_mime_type(image_path)
-        image_part = types.Part.from_bytes(data=image_bytes, mime_type=mime_type)
-        try:
-            response = self.client.models.generate_content(
-                model=self.image_model,
-                contents=[prompt, image_part],
-                config=types.GenerateContentConfig(
-                    response_modalities=["TEXT", "IMAGE"],
-                ),
+        image_part = self.prepare_image_input(
+            _read_file(image_path), _guess_mime_type(image_path)
+        )
+        return self.generate_image_from_input(prompt, image_part)
+
+    async def generate_image_async(self, prompt: str, image_path: str) -> bytes:
+        image_bytes = await asyncio.to_thread(_read_file, image_path)
+        image_part = self.prepare_image_input(image_bytes, _guess_mime_type(image_path))
+        return await self.generate_image_from_input_async(prompt, image_part)
+
+    def generate_image_from_input(self, prompt: str, image_part: "types.Part") -> bytes:
+        last_error = None
+        for attempt, model in enumerate(self.image_failover.order()):
+            try:
+                response = self.retry.call(
+                    "generate", lambda: self._generate_with(model, prompt, image_part)
+                )
+            except Exception as e:
+                if not self._record_image_failure(model, e):
+                    raise
+                last_error = e
+                continue
+            self.image_failover.record_success(model, attempt)
+            return _extract_image_bytes(response)
+        if _is_model_unavailable(last_error):
+            candidates = self.available_image_models()
+            if candidates:
+                raise _model_unavailable_error(candidates) from last_error
+        raise last_error
+
+    async def generate_image_from_input_async(
+        self, prompt: str, image_part: "types.Part"
+    ) -> bytes:
+        last_error = None
+        for attempt, model in enumerate(self.image_failover.order()):
+            try:
+                response = await self.retry.call_async(
+                    "generate", lambda: self._generate_with_async(model, prompt, image_part)
+                )
+            except Exception as e:
+                if not self._record_image_failure(model, e):
+                    raise
+                last_error = e
+                continue
+            self.image_failover.record_success(model, attempt)
+            return _extract_image_bytes(response)
+        if _is_model_unavailable(last_error):
+            candidates = await asyncio.to_thread(self.available_image_models)
+            if candidates:
+                raise _model_unavailable_error(candidates) from last_error
+        raise last_error
+
+    def _generate_with(self, model: str, prompt: str, image_part):
+        with tracing.span("gemini.generate_content", model=model):
+            return self.client.models.generate_content(
+                **self._image_request(model, prompt, image_part)
             )
-        except Exception as e:
-            error_text = str(e)
-            if "not found" in error_text.lower() or "not supported" in error_text.lower():
-                candidates = _list_image_models(self.client)
-                if candidates:
-                    raise Exception(
-                        "Image model not available. Configure a working image model. "
-                        f"Available image-like models: {', '.join(candidates)}"
-                    ) from e
-            raise
-        parts = []
-        if getattr(response, "parts", None):
-            parts = response.parts
-        elif response.candidates and response.candidates[0].content:
-            parts = response.candidates[0].content.parts
-        for part in parts:
-            if part.inline_data and part.inline_data.data:
-                return part.inline_data.data
-        raise Exception("AI model did not return image data")
-
-    def _ensure_intent_cache(self) -> str:
-        cache = self.client.caches.create(
-            model=self.intent_model,
-            config=types.CreateCachedContentConfig(
-                contents=[
-                    types.Content(
-                        role="user",
-                        parts=[types.Part.from_text(text=VALIDATION_PROMPT)],
-                    )
-                ],
-                ttl=self.intent_cache_ttl,
-                display_name="rengabot-validation-rules",
-            ),
+
+    async def _generate_with_async(self, model: str, prompt: str, image_part):
+        with tracing.span("gemini.generate_content", model=model):
+            return await self.client.aio.models.generate_content(
+                **self._image_request(model, prompt, image_part)
+            )
+
+    def _record_image_failure(self, model: str, e: Exception) -> bool:
+        """Note a failed image model and say whether the next one should be
+        tried. Missing models are demoted at once; transient errors count
+        towards demotion. Anything else is a problem with the request."""
+        if _is_model_unavailable(e):
+            self.image_failover.demote(model)
+        elif is_retryable(e):
+            self.image_failover.record_failure(model)
+        else:
+            return False
+        logger.warning(
+            "Image model failed, trying the next one",
+            extra={"model": model, "error": repr(e)},
         )
-        return cache.name
+        return True
+
+    def available_image_models(self) -> list[str]:
+        """Image-capable models the API key can use. Listing is paginated and
+        slow, so the result is kept for model_discovery_ttl seconds."""
+        with self._discovery_lock:
+            cached = self._discovered_image_models
+            if cached and time.monotonic() - cached[0] < self.model_discovery_ttl:
+                return cached[1]
+            models = _list_image_models(self.client)
+            self._discovered_image_models = (time.monotonic(), models)
+            return models
+
+    def _image_request(self, model: str, prompt: str, image_part) -> dict:
+        from google.genai import types
 
-    def _generate_validation(self, prompt: str, cache_name: str | None):
+        return {
+            "model": model,
+            "contents": [prompt, image_part],
+            "config": types.GenerateContentConfig(
+                response_modalities=["TEXT", "IMAGE"],
+            ),
+        }
+
+    def _validation_request(self, prompt: str, cache_name: str | None) -> dict:
         if cache_name:
             contents = prompt
         else:
             contents = VALIDATION_PROMPT + prompt
-        return self.client.models.generate_content(
-            model=self.intent_model,
-            contents=contents,
-            config=types.GenerateContentConfig(
+        from google.genai import types
+
+        return {
+            "model": self.intent_model,
+            "contents": contents,
+            "config": types.GenerateContentConfig(
                 thinking_config=types.ThinkingConfig(thinking_budget=0),
                 response_mime_type="application/json",
                 cached_content=cache_name,
             ),
+        }
+
+    def _generate_validation(
+        self, prompt: str, cache_name: str | None, hedge: bool = True, batch_size: int = 1
+    ):
+        request = self._validation_request(prompt, cache_name)
+
+        def attempt():
+            with tracing.span(
+                "gemini.generate_content",
+                model=self.intent_model,
+                cached_rules=bool(cache_name),
+                batch_size=batch_size,
+            ):
+                return self.client.models.generate_content(**request)
+
+        if self.validation_hedger and hedge:
+            hedger = self.validation_hedger
+            return self.retry.call("validate", lambda: hedger.run(attempt))
+        return self.retry.call("validate", attempt)
+
+    async def _generate_validation_async(self, prompt: str, cache_name: str | None):
+        request = self._validation_request(prompt, cache_name)
+
+        async def attempt():
+            with tracing.span(
+                "gemini.generate_content", model=self.intent_model, cached_rules=bool(cache_name)
+            ):
+                return await self.client.aio.models.generate_content(**request)
+
+        if self.validation_hedger:
+            hedger = self.validation_hedger
+            return await self.retry.call_async("validate", lambda: hedger.run_async(attempt))
+        return await self.retry.call_async("validate", attempt)
+
+    def call_stats(self) -> dict:
+        stats = self.retry.stats()
+        stats["image_models"] = self.image_failover.stats()
+        if self.intent_cache:
+            stats["intent_cache"] = self.intent_cache.stats()
+        if self.validation_hedger:
+            stats["validation_hedging"] = self.validation_hedger.stats()
+        if self.validation_batcher:
+            stats["validation_batching"] = self.validation_batcher.stats()
+        return stats
+
+def _validation_rules_contents() -> list:
+    from google.genai import types
+
+    return [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=VALIDATION_PROMPT)],
         )
+    ]
 
-def _list_image_models(client: genai.Client) -> list[str]:
+def _extract_image_bytes(response) -> bytes:
+    parts = []
+    if getattr(response, "parts", None):
+        parts = response.parts
+    elif response.candidates and response.candidates[0].content:
+        parts = response.candidates[0].content.parts
+    for part in parts:
+        if part.inline_data and part.inline_data.data:
+            return part.inline_data.data
+    raise Exception("AI model did not return image data")
+
+def _is_model_unavailable(e: Exception) -> bool:
+    error_text = str(e).lower()
+    return "not found" in error_text or "not supported" in error_text
+
+def _model_unavailable_error(candidates: list[str]) -> Exception:
+    return Exception(
+        "Image model not available. Configure a working image model. "
+        f"Available image-like models: {', '.join(candidates)}"
+    )
+
+def _list_image_models(client: "genai.Client") -> list[str]:
     models = []
     for m in client.models.list():
         name = getattr(m, "name", "")
@@ -164,8 +475,14 @@ def _list_image_models(client: genai.Client) -> list[str]:
             models.append(name)
     return models
 
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
 def _guess_mime_type(path: str) -> str:
     ext = os.path.splitext(path)[1].lower()
     if ext == ".jpg" or ext == ".jpeg":
         return "image/jpeg"
+    if ext == ".webp":
+        return "image/webp"
     return "image/png"
@@ -0,0 +1,241 @@
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_NAME = "rengabot-validation-rules"
+MIN_RETRY_DELAY = 15.0
+MAX_RETRY_DELAY = 300.0
+
+
+def parse_ttl(ttl) -> float:
+    """Accepts seconds as a number or the API's duration string ("3600s")."""
+    if isinstance(ttl, (int, float)):
+        return float(ttl)
+    text = str(ttl).strip()
+    if text.endswith("s"):
+        text = text[:-1]
+    return float(text)
+
+
+def owner_tag() -> str:
+    return f"{DISPLAY_NAME}:{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_orphan(display_name: Optional[str], hostname: str) -> bool:
+    """Caches made by older versions carry the bare display name; newer ones
+    add host and PID. Only those from a dead process on this host are safe
+    to delete, since other hosts may still be using theirs."""
+    if display_name == DISPLAY_NAME:
+        return True
+    parts = (display_name or "").split(":")
+    if len(parts) != 3 or parts[0] != DISPLAY_NAME or parts[1] != hostname:
+        return False
+    try:
+        pid = int(parts[2])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+
+class IntentCacheManager:
+    """Owns the cached-content copy of the validation rules. A daemon thread
+    creates it after startup, extends its TTL before it expires and recreates
+    it if it disappears, so validation never waits on cache management:
+    until a cache is ready, name() returns None and callers send the rules
+    inline."""
+
+    def __init__(
+        self,
+        get_client: Callable,
+        model: str,
+        contents: Callable[[], list],
+        ttl,
+        refresh_margin: float = 0.2,
+    ):
+        self.get_client = get_client
+        self.model = model
+        self.contents = contents
+        self.ttl = parse_ttl(ttl)
+        # Renew once this fraction of the TTL is left.
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._name: Optional[str] = None
+        self._created_at: Optional[float] = None
+        self._expires_at: Optional[float] = None
+        self._retry_delay = MIN_RETRY_DELAY
+        self.refreshes = 0
+        self.recreations = 0
+        self.refresh_failures = 0
+        self.orphans_deleted = 0
+        self.last_error: Optional[str] = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="rengabot-intent-cache"
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def name(self) -> Optional[str]:
+        with self._lock:
+            if self._name and self._expires_at and self._expires_at > time.time():
+                return self._name
+            return None
+
+    def invalidate(self, name: str) -> None:
+        """The API no longer knows this cache; stop handing it out and have
+        the refresher replace it right away."""
+        with self._lock:
+            if self._name != name:
+                return
+            self._name = None
+            self._expires_at = None
+        logger.warning("Intent cache vanished; recreating", extra={"cache": name})
+        self._wake.set()
+
+    def refresh(self) -> None:
+        """Extend the current cache, or create one if there is none. Called
+        by the background thread; safe to call directly."""
+        from google.genai import types
+
+        client = self.get_client()
+        with self._lock:
+            name = self._name
+        if name:
+            try:
+                updated = client.caches.update(
+                    name=name,
+                    config=types.UpdateCachedContentConfig(ttl=self._ttl_string()),
+                )
+                self._set(updated.name or name, renewed=True)
+                return
+            except Exception as e:
+                logger.warning(
+                    "Failed to extend intent cache; creating a new one",
+                    extra={"cache": name, "error": repr(e)},
+                )
+        created = client.caches.create(
+            model=self.model,
+            config=types.CreateCachedContentConfig(
+                contents=self.contents(),
+                ttl=self._ttl_string(),
+                display_name=owner_tag(),
+            ),
+        )
+        self._set(created.name, renewed=False)
+        if name and name != created.name:
+            self._delete(name)
+
+    def cleanup_orphans(self) -> int:
+        hostname = socket.gethostname()
+        deleted = 0
+        for cache in self.get_client().caches.list():
+            if cache.name == self._name:
+                continue
+            if _is_orphan(getattr(cache, "display_name", None), hostname):
+                if self._delete(cache.name):
+                    deleted += 1
+        if deleted:
+            logger.info("Deleted orphaned intent caches", extra={"count": deleted})
+        with self._lock:
+            self.orphans_deleted += deleted
+        return deleted
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                "name": self._name,
+                "age_seconds": (now - self._created_at) if self._created_at else None,
+                "expires_in": (self._expires_at - now) if self._expires_at else None,
+                "refreshes": self.refreshes,
+                "recreations": self.recreations,
+                "refresh_failures": self.refresh_failures,
+                "orphans_deleted": self.orphans_deleted,
+                "last_error": self.last_error,
+            }
+
+    def collect_metrics(self):
+        stats = self.stats()
+        if stats["age_seconds"] is not None:
+            yield (
+                "rengabot_intent_cache_age_seconds",
+                "Age of the cached validation rules",
+                {},
+                stats["age_seconds"],
+            )
+        yield (
+            "rengabot_intent_cache_refresh_failures",
+            "Failed attempts to create or extend the cached validation rules",
+            {},
+            stats["refresh_failures"],
+        )
+
+    def _run(self) -> None:
+        try:
+            self.cleanup_orphans()
+        except Exception:
+            logger.exception("Failed to clean up orphaned intent caches")
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+                self._retry_delay = MIN_RETRY_DELAY
+                delay = self.ttl * (1 - self.refresh_margin)
+            except Exception as e:
+                with self._lock:
+                    self.refresh_failures += 1
+                    self.last_error = repr(e)
+                logger.exception("Failed to refresh intent cache")
+                delay = self._retry_delay
+                self._retry_delay = min(MAX_RETRY_DELAY, self._retry_delay * 2)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def _set(self, name: str, renewed: bool) -> None:
+        now = time.time()
+        with self._lock:
+            if not renewed or self._name != name:
+                self._created_at = now
+            self._name = name
+            self._expires_at = now + self.ttl
+            self.refreshes += 1
+            if not renewed:
+                self.recreations += 1
+            self.last_error = None
+
+    def _delete(self, name: str) -> bool:
+        try:
+            self.get_client().caches.delete(name=name)
+            return True
+        except Exception as e:
+            logger.warning(
+                "Failed to delete intent cache",
+                extra={"cache": name, "error": repr(e)},
+            )
+            return False
+
+    def _ttl_string(self) -> str:
+        return f"{int(self.ttl)}s"
@@ -0,0 +1,246 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Rate limiting, timeouts and server-side failures are worth another try;
+# other 4xx responses (bad request, auth, model not found) are not.
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def is_retryable(e: BaseException) -> bool:
+    # google.genai's APIError carries the HTTP status as `code`.
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    return isinstance(e, _transport_errors())
+
+
+def _transport_errors() -> tuple:
+    # Only check the HTTP stacks that are already loaded; an exception can't
+    # come from a library nobody imported, and importing them here would
+    # undo the lazy loading in model.gemini.
+    errors = [asyncio.TimeoutError, ConnectionError]
+    httpx = sys.modules.get("httpx")
+    if httpx is not None:
+        errors.append(httpx.TransportError)
+    aiohttp = sys.modules.get("aiohttp")
+    if aiohttp is not None:
+        errors.append(aiohttp.ClientConnectionError)
+    return tuple(errors)
+
+
+class RetryPolicy:
+    """Retries transient model API failures with full-jitter exponential
+    backoff: attempt n sleeps a random time up to
+    min(max_backoff, initial_backoff * 2**n)."""
+
+    def __init__(self, attempts: int = 3, initial_backoff: float = 0.5, max_backoff: float = 8.0):
+        self.attempts = max(1, attempts)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.retries: dict[str, int] = {}
+        self.exhausted: dict[str, int] = {}
+
+    def call(self, operation: str, fn: Callable[[], T]) -> T:
+        try:
+            return Retrying(**self._options(operation))(fn)
+        except Exception as e:
+            self._count_exhausted(operation, e)
+            raise
+
+    async def call_async(self, operation: str, fn: Callable[[], Awaitable[T]]) -> T:
+        try:
+            return await AsyncRetrying(**self._options(operation))(fn)
+        except Exception as e:
+            self._count_exhausted(operation, e)
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"retries": dict(self.retries), "exhausted": dict(self.exhausted)}
+
+    def _options(self, operation: str) -> dict:
+        def before_sleep(state: RetryCallState) -> None:
+            with self._lock:
+                self.retries[operation] = self.retries.get(operation, 0) + 1
+            metrics.inc("rengabot_model_retries_total", operation=operation)
+            logger.warning(
+                "Retrying model call after transient error",
+                extra={
+                    "operation": operation,
+                    "attempt": state.attempt_number,
+                    "sleep": round(state.next_action.sleep, 3),
+                    "error": repr(state.outcome.exception()),
+                },
+            )
+
+        return {
+            "stop": stop_after_attempt(self.attempts),
+            "wait": wait_random_exponential(
+                multiplier=self.initial_backoff, max=self.max_backoff
+            ),
+            "retry": retry_if_exception(is_retryable),
+            "before_sleep": before_sleep,
+            "reraise": True,
+        }
+
+    def _count_exhausted(self, operation: str, e: Exception) -> None:
+        if self.attempts > 1 and is_retryable(e):
+            with self._lock:
+                self.exhausted[operation] = self.exhausted.get(operation, 0) + 1
+
+
+class Hedger:
+    """Sends a second copy of a slow request once the first has been running
+    longer than the given percentile of recent latencies; whichever succeeds
+    first wins. Hedging starts after min_samples calls have been seen."""
+
+    def __init__(
+        self,
+        name: str,
+        percentile: float = 95,
+        min_samples: int = 20,
+        window: int = 200,
+    ):
+        self.name = name
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))
+        return ordered[index]
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def run(self, fn: Callable[[], T]) -> T:
+        delay = self._start()
+        if delay is None:
+            return self._timed(fn)
+        executor = self._get_executor()
+        first = executor.submit(contextvars.copy_context().run, self._timed, fn)
+        done, _ = concurrent.futures.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        self._count_hedge()
+        second = executor.submit(contextvars.copy_context().run, self._timed, fn)
+        # The loser keeps running in its thread; its result is dropped.
+        pending = {first, second}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count_win()
+                    return future.result()
+        return first.result()
+
+    async def run_async(self, fn: Callable[[], Awaitable[T]]) -> T:
+        delay = self._start()
+        if delay is None:
+            return await self._timed_async(fn)
+        first = asyncio.ensure_future(self._timed_async(fn))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+            self._count_hedge()
+            second = asyncio.ensure_future(self._timed_async(fn))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._count_win()
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "samples": len(self._latencies),
+            }
+
+    def _start(self) -> Optional[float]:
+        with self._lock:
+            self.calls += 1
+        return self.delay()
+
+    def _timed(self, fn: Callable[[], T]) -> T:
+        started = time.monotonic()
+        try:
+            return fn()
+        finally:
+            self.observe(time.monotonic() - started)
+
+    async def _timed_async(self, fn: Callable[[], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        try:
+            return await fn()
+        finally:
+            # Cancelled losers record how long they ran, a lower bound that
+            # still keeps the slow tail in the window.
+            self.observe(time.monotonic() - started)
+
+    def _count_hedge(self) -> None:
+        with self._lock:
+            self.hedged += 1
+        metrics.inc("rengabot_model_hedges_total", operation=self.name, result="sent")
+
+    def _count_win(self) -> None:
+        with self._lock:
+            self.hedge_wins += 1
+        metrics.inc("rengabot_model_hedges_total", operation=self.name, result="won")
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=8, thread_name_prefix=f"rengabot-hedge-{self.name}"
+                )
+            return self._executor
@@ -0,0 +1,224 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+HISTOGRAMS = {
+    "rengabot_lock_wait_seconds": "Time from a change request until its channel lock was held",
+    "rengabot_validation_seconds": "Prompt validation latency",
+    "rengabot_generation_seconds": "Image generation latency",
+    "rengabot_save_seconds": "Time to normalize and store a generated image",
+    "rengabot_upload_seconds": "Time to upload an image to the chat platform",
+}
+
+COUNTERS = {
+    "rengabot_change_outcomes_total": "Change requests by outcome",
+    "rengabot_model_retries_total": "Model API calls retried after a transient error",
+    "rengabot_model_hedges_total": "Hedged model requests sent and won",
+    "rengabot_model_rejections_total": "Model calls refused by the circuit breaker or limiter",
+    "rengabot_prefilter_hits_total": "Prompts matched by a local prefilter rule",
+    "rengabot_rate_limited_total": "Change requests refused by a rate limit",
+}
+
+# A collector returns (name, help, labels, value) gauge samples on scrape.
+Collector = Callable[[], Iterable[tuple[str, str, dict, float]]]
+
+# Metrics are off until enable() is called. While disabled every helper below
+# returns after a single check, so instrumented code costs next to nothing.
+_registry: Optional["Registry"] = None
+_collectors: list[Collector] = []
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: dict[str, dict[tuple, _Histogram]] = {n: {} for n in HISTOGRAMS}
+        self._counters: dict[str, dict[tuple, float]] = {n: {} for n in COUNTERS}
+
+    def observe(self, name: str, value: float, labels: dict) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(LATENCY_BUCKETS)
+            histogram.observe(value)
+
+    def inc(self, name: str, labels: dict, amount: float = 1) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + amount
+
+    def histogram(self, name: str, **labels) -> Optional[_Histogram]:
+        with self._lock:
+            return self._histograms[name].get(tuple(sorted(labels.items())))
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters[name].get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in self._histograms.items():
+                lines.append(f"# HELP {name} {HISTOGRAMS[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(series.items()):
+                    labels = dict(key)
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            f"{name}_bucket{_labels(labels, le=_number(bound))} {cumulative}"
+                        )
+                    lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {histogram.count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(histogram.sum)}")
+                    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+            for name, series in self._counters.items():
+                lines.append(f"# HELP {name} {COUNTERS[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(dict(key))} {_number(value)}")
+        gauges: dict[str, tuple[str, list]] = {}
+        for collector in list(_collectors):
+            try:
+                for name, help_text, labels, value in collector():
+                    gauges.setdefault(name, (help_text, []))[1].append((labels, value))
+            except Exception:
+                logger.exception("Metrics collector failed")
+        for name, (help_text, samples) in gauges.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.monotonic() - self.start, **self.labels)
+        return False
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def enable() -> Registry:
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+
+def disable() -> None:
+    global _registry
+    _registry = None
+
+
+def registry() -> Optional[Registry]:
+    return _registry
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if _registry is not None:
+        _registry.observe(name, value, labels)
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    if _registry is not None:
+        _registry.inc(name, labels, amount)
+
+
+def timed(name: str, **labels):
+    """Context manager observing the duration of its block into a histogram."""
+    if _registry is None:
+        return _NOOP_TIMER
+    return _Timer(name, labels)
+
+
+def register_collector(collector: Collector) -> None:
+    _collectors.append(collector)
+
+
+def unregister_collector(collector: Collector) -> None:
+    try:
+        _collectors.remove(collector)
+    except ValueError:
+        pass
+
+
+def serve(host: str = "127.0.0.1", port: int = 9464) -> ThreadingHTTPServer:
+    """Serve GET /metrics from a daemon thread and return the server."""
+    reg = enable()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = reg.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="rengabot-metrics").start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, server.server_port)
+    return server
+
+
+def _labels(labels: dict, **extra) -> str:
+    merged = {**labels, **extra}
+    if not merged:
+        return ""
+    parts = [f'{k}="{_escape(v)}"' for k, v in merged.items()]
+    return "{" + ",".join(parts) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
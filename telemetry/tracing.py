@@ -0,0 +1,175 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# The active trace and span follow the code through asyncio tasks and
+# asyncio.to_thread, both of which copy the current context.
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "rengabot_trace_id", default=None
+)
+_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "rengabot_span", default=None
+)
+_exporter: Optional["JsonLinesExporter"] = None
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attrs: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._started = time.monotonic()
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def finish(self) -> None:
+        self.duration = time.monotonic() - self._started
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attrs": self.attrs,
+        }
+
+
+class JsonLinesExporter:
+    """Appends one JSON object per finished span to a file, so a request's
+    timeline can be rebuilt offline by grouping on trace_id."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def configure_export(path: Optional[str]) -> None:
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+    _exporter = JsonLinesExporter(path) if path else None
+
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    """Begin a new request trace with a root span. Tasks and threads started
+    inside the block keep the trace after the block exits."""
+    trace_token = _trace_id.set(os.urandom(8).hex())
+    span_token = _span.set(None)
+    try:
+        with span(name, **attrs) as root:
+            yield root
+    finally:
+        _span.reset(span_token)
+        _trace_id.reset(trace_token)
+
+
+def current_parent() -> Optional[Tuple[str, Optional[str]]]:
+    """The active trace and span ids, for continuing the trace in another
+    process with continue_trace. None outside of a trace."""
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        return None
+    parent = _span.get()
+    return (trace_id, parent.span_id if parent else None)
+
+
+class _RemoteParent:
+    def __init__(self, span_id: str):
+        self.span_id = span_id
+
+
+@contextmanager
+def continue_trace(parent: Optional[Tuple[str, Optional[str]]]):
+    """Make spans inside the block part of a trace begun elsewhere, as
+    children of the span current_parent() returned there."""
+    if parent is None:
+        yield
+        return
+    trace_id, span_id = parent
+    trace_token = _trace_id.set(trace_id)
+    span_token = _span.set(_RemoteParent(span_id) if span_id else None)
+    try:
+        yield
+    finally:
+        _span.reset(span_token)
+        _trace_id.reset(trace_token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Time a block as a child of the current span. Outside of a trace this
+    does nothing and yields None."""
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        yield None
+        return
+    parent = _span.get()
+    current = Span(name, trace_id, parent.span_id if parent else None, attrs)
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        _span.reset(token)
+        current.finish()
+        _export(current)
+
+
+def _export(finished: Span) -> None:
+    if _exporter is None:
+        return
+    try:
+        _exporter.export(finished)
+    except Exception:
+        logger.exception("Failed to export span")
+
+
+def record_span(name: str, duration: float, **attrs) -> None:
+    """Record a span for something that already happened (e.g. time spent
+    waiting in a queue) and ended just now."""
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        return
+    parent = _span.get()
+    done = Span(name, trace_id, parent.span_id if parent else None, attrs)
+    done.start -= duration
+    done.duration = duration
+    _export(done)
@@ -0,0 +1,12 @@
+from bench import imports
+
+
+def test_main_import_does_not_load_platform_or_model_sdks():
+    result = imports.measure(imports.SCENARIOS["main"])
+    assert result["heavy_modules"] == []
+    assert result["import_seconds"] > 0
+
+
+def test_gemini_import_defers_genai():
+    result = imports.measure(imports.SCENARIOS["gemini"])
+    assert "google.genai" not in result["heavy_modules"]
@@ -0,0 +1,55 @@
+import json
+import random
+
+from bench import compare, load
+
+
+def test_arrival_schedule_is_seeded_and_sorted():
+    first = load.arrival_schedule(random.Random(1), 5.0, 3.0, 4.0, 0.5, 8, 20, 1.0)
+    second = load.arrival_schedule(random.Random(1), 5.0, 3.0, 4.0, 0.5, 8, 20, 1.0)
+    assert [a.at for a in first] == [a.at for a in second]
+    assert [a.at for a in first] == sorted(a.at for a in first)
+    assert all(0 <= a.channel < 8 and 0 <= a.user < 20 for a in first)
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert load.percentile(values, 50) == 50.0
+    assert load.percentile(values, 99) == 99.0
+    assert load.percentile([], 50) is None
+
+
+def _run(tmp_path, target):
+    out = tmp_path / f"{target}.json"
+    load.main(
+        [
+            "--target", target,
+            "--duration", "0.5",
+            "--burst-rate", "10",
+            "--channels", "2",
+            "--validation-latency", "0",
+            "--generation-latency", "0.01",
+            "--image-side", "32",
+            "--lock-backend", "memory",
+            "--out", str(out),
+        ]
+    )
+    return json.loads(out.read_text())
+
+
+def test_load_report_for_each_target(tmp_path):
+    for target in load.TARGETS:
+        report = _run(tmp_path, target)
+        assert report["requests"] == sum(report["outcomes"].values())
+        assert report["outcomes"].get("ok", 0) > 0
+        assert report["latency_seconds"]["p99"] >= report["latency_seconds"]["p50"]
+        assert report["peak_traced_memory_bytes"] > 0
+
+
+def test_compare_reports():
+    base = {"throughput_rps": 2.0, "latency_seconds": {"p95": 4.0}}
+    head = {"throughput_rps": 3.0, "latency_seconds": {"p95": 2.0}}
+    rows = {row["metric"]: row for row in compare.compare(base, head)}
+    assert rows["throughput_rps"]["change"] == 0.5
+    assert rows["latency p95"]["change"] == -0.5
+    assert "latency p50" not in rows
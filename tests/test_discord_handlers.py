@@ -1,8 +1,15 @@
+import asyncio
+import io
 import os
 import types
 
+import discord
 import pytest
+from PIL import Image
 
+from bench.fakes import FakeDiscordChannel, FakeS3, fake_discord_message
+from game.backpressure import ModelGuard
+from game.ratelimit import RateLimiter
 from messengers.discord import DiscordMessenger
 from game.service import GameService
 
@@ -12,26 +19,104 @@ class DummyModel:
         self.valid = valid
         self.reason = reason
         self.image_bytes = image_bytes
+        self.generate_calls = []
 
     def validate_prompt(self, prompt):
         return (self.valid, self.reason)
 
     def generate_image(self, prompt, image_path):
+        self.generate_calls.append(prompt)
+        return self.image_bytes
+
+
+class GatedModel(DummyModel):
+    """Holds every generation until the gate is opened."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.gate = asyncio.Event()
+
+    async def generate_image_async(self, prompt, image_path):
+        await self.gate.wait()
         return self.image_bytes
 
 
 class DummyRengabot:
-    def __init__(self, model):
+    def __init__(self, model, **service_args):
         self.model = model
-        self.service = GameService(model)
+        self.service = GameService(model, **service_args)
 
 
-def _make_discord(tmp_path):
+def _make_discord(tmp_path, model=None, **service_args):
     config = {"bot_token": "x", "guild_id": "1", "admins": ["1"]}
-    dm = DiscordMessenger(config, DummyRengabot(DummyModel()))
+    service_args.setdefault("uploads_dir", str(tmp_path))
+    dm = DiscordMessenger(config, DummyRengabot(model or DummyModel(), **service_args))
     return dm
 
 
+class DummyAttachment:
+    """Writes its bytes in two steps, yielding in between like a download."""
+
+    def __init__(self, data, filename="base.png", content_type="image/png"):
+        self.data = data
+        self.filename = filename
+        self.content_type = content_type
+
+    async def save(self, fp):
+        if isinstance(fp, str):
+            with open(fp, "wb") as f:
+                return await self.save(f)
+        half = len(self.data) // 2
+        fp.write(self.data[:half])
+        await asyncio.sleep(0.01)
+        fp.write(self.data[half:])
+
+
+class DummyFollowup:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append({"content": content, **kwargs})
+
+
+class DummyResponse:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, content=None, **kwargs):
+        self.sent.append({"content": content, **kwargs})
+
+    async def defer(self, **kwargs):
+        pass
+
+
+def _interaction(channel, user_id=1, guild_id=1):
+    return types.SimpleNamespace(
+        user=types.SimpleNamespace(id=user_id),
+        guild_id=guild_id,
+        channel_id=channel.id,
+        channel=channel,
+        response=DummyResponse(),
+        followup=DummyFollowup(),
+    )
+
+
+def _command(dm, name):
+    group = dm.tree.get_command("rengabot", guild=discord.Object(id=1))
+    return group.get_command(name).callback
+
+
+def _png(color):
+    out = io.BytesIO()
+    Image.new("RGB", (8, 8), color=color).save(out, format="PNG")
+    return out.getvalue()
+
+
+def _sent_text(channel):
+    return [m["content"] for m in channel.sent if m["content"]]
+
+
 def test_discord_channel_dir(tmp_path, monkeypatch):
     monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
     dm = _make_discord(tmp_path)
@@ -54,3 +139,143 @@ def test_discord_admin_gate(tmp_path):
     dm = _make_discord(tmp_path)
     user = types.SimpleNamespace(id=2)
     assert dm._is_admin(user) is False
+
+
+async def test_discord_change_uploads_new_image_bytes(tmp_path):
+    dm = _make_discord(tmp_path, DummyModel(image_bytes=b"newpng"))
+    dm.rengabot.service.save_image_bytes("discord", "1", "10", "1", b"base")
+    channel = FakeDiscordChannel(10)
+
+    await dm._handle_change_message(fake_discord_message(1, channel, 2), "add a bird")
+
+    assert channel.sent[0]["file"].fp.read() == b"newpng"
+
+
+async def test_discord_change_reports_queue_position(tmp_path):
+    model = GatedModel()
+    dm = _make_discord(tmp_path, model, queue_depth=1)
+    dm.rengabot.service.save_image_bytes("discord", "1", "10", "1", b"base")
+    channel = FakeDiscordChannel(10)
+
+    first = asyncio.create_task(
+        dm._handle_change_message(fake_discord_message(1, channel, 2), "add a bird")
+    )
+    await asyncio.sleep(0.01)
+    second = asyncio.create_task(
+        dm._handle_change_message(fake_discord_message(1, channel, 3), "add a cat")
+    )
+    await asyncio.sleep(0.01)
+    assert _sent_text(channel) == [GameService.format_queue_position(1)]
+    model.gate.set()
+    await asyncio.gather(first, second)
+    assert len([m for m in channel.sent if m["file"]]) == 2
+
+
+async def test_discord_change_reports_full_queue(tmp_path):
+    model = GatedModel()
+    dm = _make_discord(tmp_path, model, queue_depth=0)
+    dm.rengabot.service.save_image_bytes("discord", "1", "10", "1", b"base")
+    channel = FakeDiscordChannel(10)
+
+    first = asyncio.create_task(
+        dm._handle_change_message(fake_discord_message(1, channel, 2), "add a bird")
+    )
+    await asyncio.sleep(0.01)
+    await dm._handle_change_message(fake_discord_message(1, channel, 3), "add a cat")
+    assert _sent_text(channel) == [GameService.CHANGE_IN_PROGRESS_MESSAGE]
+
+    dm.rengabot.service.queue_depth = 1
+    blocked = asyncio.create_task(
+        dm._handle_change_message(fake_discord_message(1, channel, 3), "add a cat")
+    )
+    await asyncio.sleep(0.01)
+    await dm._handle_change_message(fake_discord_message(1, channel, 4), "add a dog")
+    assert _sent_text(channel)[-1] == GameService.QUEUE_FULL_MESSAGE
+    model.gate.set()
+    await asyncio.gather(first, blocked)
+
+
+async def test_discord_change_reports_model_unavailable(tmp_path):
+    model = DummyModel()
+    dm = _make_discord(tmp_path, model)
+    service = dm.rengabot.service
+    service.save_image_bytes("discord", "1", "10", "1", b"base")
+    service.model_guards["generate"] = ModelGuard("generate", failure_threshold=1)
+    service.model_guards["generate"].breaker.record(False)
+    channel = FakeDiscordChannel(10)
+
+    await dm._handle_change_message(fake_discord_message(1, channel, 2), "add a bird")
+
+    assert model.generate_calls == []
+    assert _sent_text(channel) == [service.format_model_unavailable(30)]
+    assert not [m for m in channel.sent if m["file"]]
+
+
+async def test_discord_change_reports_rate_limit(tmp_path):
+    model = DummyModel()
+    dm = _make_discord(tmp_path, model)
+    service = dm.rengabot.service
+    service.save_image_bytes("discord", "1", "10", "1", b"base")
+    service.rate_limiter = RateLimiter(user={"rate": 0.5, "per": 60, "burst": 1})
+    service.rate_limiter.acquire("discord", "1", "10", "2")
+    channel = FakeDiscordChannel(10)
+
+    await dm._handle_change_message(fake_discord_message(1, channel, 2), "add a bird")
+
+    assert model.generate_calls == []
+    assert _sent_text(channel) == [service.format_rate_limited(120, "user")]
+
+
+async def test_discord_concurrent_set_images_keep_their_own_upload(tmp_path):
+    dm = _make_discord(tmp_path)
+    set_image = _command(dm, "set-image")
+    channel = FakeDiscordChannel(10)
+    red, blue = _png((255, 0, 0)), _png((0, 0, 255))
+
+    interactions = [_interaction(channel), _interaction(channel)]
+    await asyncio.gather(
+        set_image(interactions[0], DummyAttachment(red), "red"),
+        set_image(interactions[1], DummyAttachment(blue), "blue"),
+    )
+
+    assert [i.followup.sent[0]["content"] for i in interactions] == [
+        "The renga has been reset: red",
+        "The renga has been reset: blue",
+    ]
+    history = dm.rengabot.service.get_history("discord", "1", "10")
+    assert {h["size"] for h in history} == {len(red), len(blue)}
+    assert len({h["digest"] for h in history}) == 2
+    assert [f for f in os.listdir(dm._channel_dir("1", "10")) if f.startswith(".upload")] == []
+
+
+async def test_discord_set_and_show_image_with_s3_storage(tmp_path):
+    client = FakeS3()
+    dm = _make_discord(
+        tmp_path, storage={"backend": "s3", "client": client, "bucket": "renga"}
+    )
+    channel = FakeDiscordChannel(10)
+    png = _png((0, 128, 0))
+
+    interaction = _interaction(channel)
+    await _command(dm, "set-image")(interaction, DummyAttachment(png), "a field")
+
+    assert interaction.followup.sent[0]["content"] == "The renga has been reset: a field"
+    assert channel.sent[0]["content"] == "Renga reset: a field"
+    assert channel.sent[0]["file"].fp.read() == png
+    assert png in client.objects.values()
+    assert os.listdir(dm._channel_dir("1", "10")) == []
+
+    await _command(dm, "show-image")(_interaction(channel))
+    assert channel.sent[1]["content"] == "Current renga image:"
+    assert channel.sent[1]["file"].fp.read() == png
+
+
+async def test_discord_show_image_without_image(tmp_path):
+    dm = _make_discord(tmp_path)
+    channel = FakeDiscordChannel(10)
+    interaction = _interaction(channel)
+
+    await _command(dm, "show-image")(interaction)
+
+    assert interaction.followup.sent[0]["content"] == GameService.NO_IMAGE_MESSAGE
+    assert channel.sent == []
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+
+from game.backpressure import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    AdaptiveLimiter,
+    CircuitBreaker,
+    ModelGuard,
+    is_backend_failure,
+)
+
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} error")
+        self.code = code
+
+
+def test_backend_failure_classification():
+    assert is_backend_failure(ApiError(429))
+    assert is_backend_failure(ApiError(503))
+    assert is_backend_failure(TimeoutError())
+    assert not is_backend_failure(ApiError(400))
+    assert not is_backend_failure(Exception("AI model did not return image data"))
+
+
+def test_limiter_grows_when_saturated_and_halves_on_overload():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=4, decrease_interval=0)
+    assert limiter.acquire(0) and limiter.acquire(0)
+    assert not limiter.acquire(0)
+    limiter.release(0.1)
+    assert limiter.limit == 2.5
+    limiter.release(0.1)
+    assert limiter.limit == 2.5  # not saturated, so no growth
+    assert limiter.acquire(0)
+    limiter.release(0.1, overloaded=True)
+    assert limiter.limit == 1.25
+    assert limiter.stats()["decreases"] == 1
+
+
+def test_limiter_slow_calls_shrink_limit():
+    limiter = AdaptiveLimiter(initial_limit=8, latency_target=1.0, decrease_interval=0)
+    assert limiter.acquire(0)
+    limiter.release(5.0)
+    assert limiter.limit == 4
+
+
+def test_limiter_hands_slots_to_waiters_in_order():
+    limiter = AdaptiveLimiter(initial_limit=1)
+    assert limiter.acquire(0)
+    order = []
+
+    def wait(name):
+        assert limiter.acquire(5)
+        order.append(name)
+        limiter.release()
+
+    threads = []
+    for name in ("a", "b"):
+        t = threading.Thread(target=wait, args=(name,))
+        t.start()
+        threads.append(t)
+        while len(limiter._waiters) < len(threads):
+            time.sleep(0.001)
+    limiter.release()
+    for t in threads:
+        t.join()
+    assert order == ["a", "b"]
+    assert limiter.stats()["in_flight"] == 0
+
+
+async def test_limiter_async_waiter_times_out_and_is_woken():
+    limiter = AdaptiveLimiter(initial_limit=1)
+    assert await limiter.acquire_async(0)
+    assert not await limiter.acquire_async(0.01)
+    waiter = asyncio.create_task(limiter.acquire_async(5))
+    await asyncio.sleep(0)
+    limiter.release()
+    assert await waiter
+    assert limiter.stats() == {
+        "limit": 1,
+        "in_flight": 1,
+        "waiting": 0,
+        "increases": 0,
+        "decreases": 0,
+    }
+
+
+def test_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker("generate", failure_threshold=2, reset_timeout=0.05, probes=1)
+    for _ in range(2):
+        assert breaker.allow() is None
+        breaker.record(False)
+    assert breaker.state == OPEN
+    assert breaker.allow() > 0
+    time.sleep(0.06)
+    assert breaker.retry_after() is None
+    assert breaker.allow() is None
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() is not None  # only one probe at a time
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["opened"] == 1
+
+
+def test_breaker_reopens_when_probe_fails():
+    breaker = CircuitBreaker("generate", failure_threshold=1, reset_timeout=0.01)
+    breaker.record(False)
+    time.sleep(0.02)
+    assert breaker.allow() is None
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert breaker.stats()["opened"] == 2
+
+
+def test_guard_counts_only_backend_failures():
+    guard = ModelGuard("generate", failure_threshold=1)
+    assert guard.admit() is None
+    guard.done(0.1, Exception("AI model did not return image data"))
+    assert guard.breaker.state == CLOSED
+    assert guard.admit() is None
+    guard.done(0.1, ApiError(503))
+    assert guard.breaker.state == OPEN
+    assert guard.admit() is not None
+    assert guard.limiter.stats()["in_flight"] == 0
@@ -0,0 +1,43 @@
+from game.image_cache import ImageCache, mime_type_for
+
+
+def test_cache_hit_requires_matching_version():
+    cache = ImageCache(max_bytes=100)
+    cache.put("C1", "/a.png", b"aaaa", "image/png")
+    assert cache.get("C1", "/a.png").data == b"aaaa"
+    assert cache.get("C1", "/b.png") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_evicts_to_stay_within_budget():
+    cache = ImageCache(max_bytes=10)
+    cache.put("C1", "/a.png", b"x" * 4, "image/png")
+    cache.put("C2", "/b.png", b"x" * 4, "image/png")
+    cache.get("C1", "/a.png")
+    cache.put("C3", "/c.png", b"x" * 4, "image/png")
+    assert cache.get("C2", "/b.png") is None
+    assert cache.get("C1", "/a.png")
+    assert cache.stats()["resident_bytes"] == 8
+
+
+def test_cache_replaces_channel_entry_and_skips_oversize():
+    cache = ImageCache(max_bytes=10)
+    cache.put("C1", "/a.png", b"x" * 4, "image/png")
+    cache.put("C1", "/b.png", b"x" * 20, "image/png")
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["resident_bytes"] == 0
+
+
+def test_model_input_is_prepared_once():
+    cache = ImageCache(max_bytes=100)
+    entry = cache.put("C1", "/a.jpg", b"data", mime_type_for("/a.jpg"))
+    calls = []
+
+    def prepare(data, mime_type):
+        calls.append(mime_type)
+        return (data, mime_type)
+
+    cache.model_input(entry, prepare)
+    cache.model_input(entry, prepare)
+    assert calls == ["image/jpeg"]
@@ -0,0 +1,71 @@
+import io
+
+from PIL import Image
+
+from game.imaging import ImagePreprocessor, OutputNormalizer
+
+
+def _png(size, mode="RGB"):
+    img = Image.effect_noise(size, 64).convert(mode)
+    if mode == "RGBA":
+        img.putalpha(128)
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+def test_preprocess_downscales_and_reencodes():
+    data = _png((1024, 768))
+    pre = ImagePreprocessor(max_side=512, format="jpeg", quality=80)
+    out, mime = pre.process(data, "image/png")
+    assert mime == "image/jpeg"
+    with Image.open(io.BytesIO(out)) as img:
+        assert img.size == (512, 384)
+        assert img.format == "JPEG"
+        assert not img.info.get("exif")
+    assert len(out) < len(data)
+
+
+def test_preprocess_webp_keeps_alpha():
+    pre = ImagePreprocessor(max_side=64, format="webp", quality=70)
+    out, mime = pre.process(_png((128, 128), mode="RGBA"), "image/png")
+    assert mime == "image/webp"
+    with Image.open(io.BytesIO(out)) as img:
+        assert img.mode == "RGBA"
+
+
+def test_preprocess_passes_through_undecodable_bytes():
+    pre = ImagePreprocessor()
+    assert pre.process(b"not an image", "image/png") == (b"not an image", "image/png")
+
+
+def test_preprocess_records_bytes_saved():
+    pre = ImagePreprocessor()
+    pre.record_turn(1000, 400)
+    pre.record_turn(1000, 400)
+    assert pre.stats()["bytes_saved"] == 1200
+
+
+def test_normalize_sniffs_real_format():
+    out = io.BytesIO()
+    Image.new("RGB", (32, 32)).save(out, format="JPEG")
+    normalizer = OutputNormalizer(1024, 1024)
+    data, ext, info = normalizer.normalize(out.getvalue())
+    assert ext == "jpg"
+    assert data == out.getvalue()
+    assert info["source_format"] == "JPEG"
+
+
+def test_normalize_enforces_max_dimensions_and_format():
+    normalizer = OutputNormalizer(256, 256, format="webp", quality=60)
+    data, ext, info = normalizer.normalize(_png((1024, 512)))
+    assert ext == "webp"
+    assert (info["width"], info["height"]) == (256, 128)
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.format == "WEBP"
+    assert normalizer.stats()["bytes_out"] == len(data)
+
+
+def test_normalize_passes_through_undecodable_output():
+    normalizer = OutputNormalizer(1024, 1024, format="jpeg")
+    assert normalizer.normalize(b"img")[:2] == (b"img", "png")
@@ -0,0 +1,61 @@
+import json
+import os
+import sqlite3
+import time
+
+from game.index import ChannelIndex, main
+from game.service import GameService
+from game.store import ImageVersion
+
+
+def test_service_updates_index_in_batches(tmp_path):
+    db = str(tmp_path / "channels.db")
+    svc = GameService(
+        object(), uploads_dir=str(tmp_path / "uploads"), index={"path": db, "flush_interval": 60}
+    )
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    svc.save_image_bytes("slack", "T1", "C1", "U2", b"next")
+    svc.save_image_bytes("slack", "T1", "C2", "U3", b"base")
+
+    # Nothing written yet: updates wait for the batch.
+    assert sqlite3.connect(db).execute("SELECT COUNT(*) FROM channels").fetchone()[0] == 0
+    assert svc.channel_index.flush() == 2
+
+    row = svc.channel_index.get("slack", "T1", "C1")
+    assert row["turns"] == 2
+    assert row["last_user_id"] == "U2"
+    assert row["path"] == svc.get_current_image_path("slack", "T1", "C1")
+    assert sqlite3.connect(db).execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    svc.channel_index.close()
+
+
+def test_most_active_and_stale_queries(tmp_path):
+    index = ChannelIndex(str(tmp_path / "channels.db"))
+    now = time.time()
+    for channel, turns, at in (("C1", 3, now), ("C2", 9, now - 86400 * 40), ("C3", 5, now)):
+        index.record("slack", "T1", channel, ImageVersion("d", "png", "p", turns), "U1", at=at)
+
+    assert [r["channel_id"] for r in index.most_active()] == ["C2", "C3", "C1"]
+    assert [r["channel_id"] for r in index.most_active(since=now - 86400)] == ["C3", "C1"]
+    assert [r["channel_id"] for r in index.stale(86400 * 30)] == ["C2"]
+    index.close()
+
+
+def test_rebuild_from_disk_and_cli(tmp_path, capsys):
+    uploads = tmp_path / "uploads"
+    svc = GameService(object(), uploads_dir=str(uploads))
+    svc.save_image_bytes("discord", "G1", "C1", "U1", b"base")
+    svc.save_image_bytes("discord", "G1", "C1", "U2", b"next")
+    legacy = uploads / "slack" / "T1" / "C9"
+    legacy.mkdir(parents=True)
+    (legacy / "current.png").write_bytes(b"old")
+    os.makedirs(uploads / "slack" / "T1" / "empty")
+
+    db = str(tmp_path / "channels.db")
+    assert main(["--db", db, "rebuild", "--uploads-dir", str(uploads)]) == 0
+    assert main(["--db", db, "--json", "most-active"]) == 0
+    rows = json.loads(capsys.readouterr().out.split("\n", 1)[1])
+    assert [(r["channel_id"], r["turns"], r["last_user_id"]) for r in rows] == [
+        ("C1", 2, "U2"),
+        ("C9", 0, None),
+    ]
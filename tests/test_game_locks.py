@@ -0,0 +1,135 @@
+import json
+import os
+import socket
+import time
+
+from bench.fakes import FakeRedis
+from game.locks import (
+    FileLeaseLockManager,
+    InMemoryLockManager,
+    RedisLockManager,
+    create_lock_manager,
+)
+
+
+def test_memory_lock_is_exclusive_until_released():
+    locks = InMemoryLockManager(ttl=60)
+    lease = locks.acquire("slack/T1/C1")
+    assert lease
+    assert locks.acquire("slack/T1/C1") is None
+    locks.release(lease)
+    assert locks.acquire("slack/T1/C1")
+    stats = locks.stats.snapshot()
+    assert stats["acquired"] == 2
+    assert stats["rejected"] == 1
+    assert stats["hold_count"] == 1
+
+
+def test_memory_lock_expired_lease_is_taken_over():
+    locks = InMemoryLockManager(ttl=0.01)
+    assert locks.acquire("k")
+    time.sleep(0.02)
+    assert locks.acquire("k")
+    assert locks.stats.snapshot()["takeovers"] == 1
+
+
+def test_file_lease_records_owner_and_releases(tmp_path):
+    locks = FileLeaseLockManager(ttl=60)
+    path = str(tmp_path / "C1" / ".change.lock")
+    lease = locks.acquire(path)
+    record = json.load(open(path))
+    assert record["pid"] == os.getpid()
+    assert record["host"] == socket.gethostname()
+    assert record["token"] == lease.token
+    assert locks.acquire(path) is None
+    locks.release(lease)
+    assert not os.path.exists(path)
+
+
+def test_file_lease_takes_over_dead_owner(tmp_path):
+    path = tmp_path / ".change.lock"
+    # PIDs are capped well below this, so no process can own it.
+    record = {"pid": 2**30, "token": "dead", "expires_at": time.time() + 60}
+    path.write_text(json.dumps({"host": socket.gethostname(), **record}))
+    locks = FileLeaseLockManager(ttl=60)
+    lease = locks.acquire(str(path))
+    assert lease
+    assert json.load(open(path))["token"] == lease.token
+    assert locks.stats.snapshot()["takeovers"] == 1
+
+
+def test_file_lease_from_another_host_is_kept_until_expiry(tmp_path):
+    path = tmp_path / ".change.lock"
+    record = {"host": "other-host", "pid": 2**30, "token": "remote"}
+    path.write_text(json.dumps({**record, "expires_at": time.time() + 60}))
+    locks = FileLeaseLockManager(ttl=60)
+    assert locks.acquire(str(path)) is None
+
+    path.write_text(json.dumps({**record, "expires_at": time.time() - 1}))
+    assert locks.acquire(str(path))
+
+
+def test_file_lease_takes_over_expired_legacy_lock(tmp_path):
+    path = tmp_path / ".change.lock"
+    path.write_text("locked")
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    locks = FileLeaseLockManager(ttl=60)
+    assert locks.acquire(str(path))
+
+
+def test_file_lease_release_ignores_foreign_lease(tmp_path):
+    path = str(tmp_path / ".change.lock")
+    locks = FileLeaseLockManager(ttl=0.01)
+    stale = locks.acquire(path)
+    time.sleep(0.02)
+    fresh = FileLeaseLockManager(ttl=60).acquire(path)
+    locks.release(stale)
+    assert json.load(open(path))["token"] == fresh.token
+
+
+def test_redis_lease_is_fenced_and_released_only_by_owner():
+    client = FakeRedis()
+    locks = RedisLockManager(client, ttl=60)
+    lease = locks.acquire("slack/T1/C1")
+    assert lease.fence == 1
+    assert RedisLockManager(client, ttl=60).acquire("slack/T1/C1") is None
+    locks.release(lease)
+    other = RedisLockManager(client, ttl=60).acquire("slack/T1/C1")
+    assert other.fence == 3
+    locks.release(lease)
+    assert locks.is_held(other)
+
+
+def test_redis_lease_is_renewed_while_held():
+    client = FakeRedis()
+    locks = RedisLockManager(client, ttl=0.2, renew_interval=0.05)
+    lease = locks.acquire("k")
+    time.sleep(0.5)
+    assert locks.is_held(lease)
+    assert RedisLockManager(client, ttl=0.2).acquire("k") is None
+    assert locks.stats.snapshot()["renewals"] > 0
+    locks.release(lease)
+
+
+def test_redis_lease_taken_over_after_expiry_is_reported_lost():
+    client = FakeRedis()
+    locks = RedisLockManager(client, ttl=0.05, renew_interval=60)
+    lease = locks.acquire("k")
+    time.sleep(0.1)
+    other = RedisLockManager(client, ttl=60).acquire("k")
+    assert other
+    assert not locks.is_held(lease)
+    locks._renew(lease)
+    assert locks.stats.snapshot()["lost"] == 1
+    locks.release(lease)
+    assert client.get("rengabot:lock:k")
+
+
+def test_lock_ttl_defaults_per_backend():
+    assert create_lock_manager("file").ttl == 600
+    assert create_lock_manager("memory").ttl == 600
+    redis_locks = create_lock_manager("redis", client=FakeRedis())
+    assert redis_locks.ttl == 30
+    assert redis_locks.renew_interval == 10
+    assert create_lock_manager("redis", 90, client=FakeRedis()).ttl == 90
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+from game.ratelimit import RateLimiter
+
+
+def test_user_bucket_allows_burst_then_reports_wait():
+    limiter = RateLimiter(user={"rate": 1, "per": 60, "burst": 2})
+    assert limiter.acquire("slack", "T1", "C1", "U1") is None
+    assert limiter.acquire("slack", "T1", "C2", "U1") is None
+    scope, retry_after = limiter.acquire("slack", "T1", "C1", "U1")
+    assert scope == "user"
+    assert 55 < retry_after <= 60
+    # Other users have their own bucket.
+    assert limiter.acquire("slack", "T1", "C1", "U2") is None
+    assert limiter.stats()["limited"] == {"user": 1}
+
+
+def test_request_takes_tokens_from_every_scope_or_none():
+    limiter = RateLimiter(
+        user={"rate": 10, "per": 60}, workspace={"rate": 1, "per": 60}
+    )
+    assert limiter.acquire("slack", "T1", "C1", "U1") is None
+    assert limiter.acquire("slack", "T1", "C1", "U1")[0] == "workspace"
+    # The refused request didn't spend the user's token.
+    assert limiter._buckets[("user", "slack", "T1", "U1")][0] == pytest.approx(9, abs=0.01)
+
+
+def test_buckets_refill_over_time():
+    limiter = RateLimiter(channel={"rate": 1, "per": 0.05})
+    assert limiter.acquire("slack", "T1", "C1", "U1") is None
+    assert limiter.acquire("slack", "T1", "C1", "U1") is not None
+    time.sleep(0.06)
+    assert limiter.acquire("slack", "T1", "C1", "U1") is None
+
+
+def test_state_survives_restart(tmp_path):
+    path = str(tmp_path / "limits.json")
+    limiter = RateLimiter(user={"rate": 1, "per": 600}, path=path, save_interval=60)
+    assert limiter.acquire("slack", "T1", "C1", "U1") is None
+    limiter.close()
+
+    restarted = RateLimiter(user={"rate": 1, "per": 600}, path=path, save_interval=60)
+    assert restarted.acquire("slack", "T1", "C1", "U1")[0] == "user"
+    restarted.close()
@@ -1,15 +1,21 @@
+import asyncio
 import os
 
 import pytest
 from PIL import Image
 
+from game.backpressure import OPEN, ModelGuard
 from game.service import (
     ChangeInProgressError,
+    ChangeQueueFullError,
     GameService,
+    GenerationError,
     ImageTooLargeError,
     InvalidPromptError,
+    ModelUnavailableError,
     NoImageError,
 )
+from model.cache import ValidationCache
 
 
 class DummyModel:
@@ -69,3 +75,434 @@ def test_change_image_fails_when_locked(tmp_path, monkeypatch):
         lock_file.write("locked")
     with pytest.raises(ChangeInProgressError):
         svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+
+
+class AsyncDummyModel(DummyModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.async_calls = []
+
+    async def validate_prompt_async(self, prompt):
+        self.async_calls.append("validate")
+        return (self.valid, self.reason)
+
+    async def generate_image_async(self, prompt, image_path):
+        self.async_calls.append("generate")
+        return self.image_bytes
+
+
+async def test_change_image_async_awaits_model(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = AsyncDummyModel(valid=True, image_bytes=b"new")
+    svc = GameService(model)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    path = await svc.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+    assert open(path, "rb").read() == b"new"
+    assert model.async_calls == ["validate", "generate"]
+
+
+async def test_change_image_async_falls_back_to_sync_model(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    svc = GameService(DummyModel(valid=False, reason="two changes"))
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    with pytest.raises(InvalidPromptError):
+        await svc.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+    assert not os.path.exists(svc._change_lock_path("slack", "T1", "C1"))
+
+
+async def test_speculative_change_discards_generation_on_invalid(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = AsyncDummyModel(valid=False, reason="two changes")
+    svc = GameService(model, speculative=True)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    with pytest.raises(InvalidPromptError):
+        await svc.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+    assert svc.speculation_stats() == {"generations": 1, "wasted": 1, "wasted_rate": 1.0}
+
+
+def test_speculative_change_commits_when_valid(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    svc = GameService(DummyModel(valid=True, image_bytes=b"new"), speculative=True)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    path = svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    assert open(path, "rb").read() == b"new"
+    assert svc.speculation_stats()["wasted"] == 0
+
+
+class GatedModel(DummyModel):
+    """Async model whose generations block until the test releases them."""
+
+    def __init__(self, invalid_prompts=()):
+        super().__init__()
+        self.invalid_prompts = set(invalid_prompts)
+        self.gate = asyncio.Event()
+        self.inputs = []
+
+    async def validate_prompt_async(self, prompt):
+        if prompt in self.invalid_prompts:
+            return (False, "nope")
+        return (True, None)
+
+    async def generate_image_async(self, prompt, image_path):
+        self.inputs.append(open(image_path, "rb").read())
+        await self.gate.wait()
+        return prompt.encode()
+
+
+async def test_queued_change_runs_against_previous_result(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = GatedModel()
+    svc = GameService(model, queue_depth=2)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    positions = []
+
+    async def on_queued(position):
+        positions.append(position)
+
+    first = asyncio.create_task(svc.change_image_async("slack", "T1", "C1", "U1", "one"))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(
+        svc.change_image_async("slack", "T1", "C1", "U2", "two", on_queued=on_queued)
+    )
+    await asyncio.sleep(0.01)
+    model.gate.set()
+    await first
+    path = await second
+    assert positions == [1]
+    assert model.inputs == [b"base", b"one"]
+    assert open(path, "rb").read() == b"two"
+
+
+async def test_queue_rejects_over_depth(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = GatedModel()
+    svc = GameService(model, queue_depth=1)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    tasks = [
+        asyncio.create_task(svc.change_image_async("slack", "T1", "C1", "U1", "one")),
+        asyncio.create_task(svc.change_image_async("slack", "T1", "C1", "U2", "two")),
+    ]
+    await asyncio.sleep(0.01)
+    with pytest.raises(ChangeQueueFullError):
+        await svc.change_image_async("slack", "T1", "C1", "U3", "three")
+    model.gate.set()
+    await asyncio.gather(*tasks)
+
+
+async def test_queued_invalid_prompt_fails_without_waiting(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = GatedModel(invalid_prompts={"two"})
+    svc = GameService(model, queue_depth=1)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    first = asyncio.create_task(svc.change_image_async("slack", "T1", "C1", "U1", "one"))
+    await asyncio.sleep(0.01)
+    with pytest.raises(InvalidPromptError):
+        await asyncio.wait_for(
+            svc.change_image_async("slack", "T1", "C1", "U2", "two"), timeout=1
+        )
+    assert not first.done()
+    model.gate.set()
+    await first
+    assert svc._channel_queues == {}
+
+
+def test_change_image_keeps_history(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    svc = GameService(DummyModel(valid=True, image_bytes=b"new"))
+    base = svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    path = svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    assert open(base, "rb").read() == b"base"
+    assert svc.get_current_image_path("slack", "T1", "C1") == path
+    history = svc.get_history("slack", "T1", "C1")
+    assert [(h["user_id"], h["prompt"]) for h in history] == [("U1", None), ("U2", "add a bird")]
+
+
+class PreparedInputModel(DummyModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prepared = []
+
+    def prepare_image_input(self, image_bytes, mime_type):
+        self.prepared.append(image_bytes)
+        return ("part", image_bytes)
+
+    async def generate_image_from_input_async(self, prompt, image_input):
+        return image_input[1] + b"+" + prompt.encode()
+
+
+async def test_change_image_serves_model_input_from_memory(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = PreparedInputModel()
+    svc = GameService(model)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    path = await svc.change_image_async("slack", "T1", "C1", "U2", "a")
+    os.unlink(path)
+    # The latest image is still served from memory after the file is gone.
+    assert await svc.read_image_async("slack", "T1", "C1", path) == b"base+a"
+    assert model.prepared == [b"base"]
+    assert svc.image_cache.stats()["misses"] == 0
+
+
+async def test_input_image_preprocessed_once_per_version(tmp_path, monkeypatch):
+    import io
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = PreparedInputModel()
+    svc = GameService(model, input_image={"max_side": 256, "format": "jpeg"})
+    out = io.BytesIO()
+    Image.new("RGB", (1024, 1024), color=(200, 10, 10)).save(out, format="PNG")
+    svc.save_image_bytes("slack", "T1", "C1", "U1", out.getvalue())
+    entry = await svc._cached_image_async(
+        ("slack", "T1", "C1"), svc.get_current_image_path("slack", "T1", "C1")
+    )
+    svc._model_input(entry)
+    svc._model_input(entry)
+    assert len(model.prepared) == 1
+    with Image.open(io.BytesIO(model.prepared[0])) as img:
+        assert img.size == (256, 256)
+    assert svc.input_preprocessor.stats()["turns"] == 2
+    assert svc.input_preprocessor.stats()["bytes_saved"] > 0
+
+
+def test_change_image_normalizes_generated_output(tmp_path, monkeypatch):
+    import io
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    out = io.BytesIO()
+    Image.new("RGB", (2048, 1024)).save(out, format="PNG")
+    svc = GameService(
+        DummyModel(valid=True, image_bytes=out.getvalue()),
+        output_image={"format": "jpeg", "quality": 80},
+    )
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    path = svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    assert path.endswith(".jpg")
+    with Image.open(path) as img:
+        assert img.size == (1024, 512)
+    record = svc.get_history("slack", "T1", "C1")[-1]
+    assert record["size"] == os.path.getsize(path)
+    assert record["source_format"] == "PNG"
+
+
+def test_open_circuit_fails_fast_without_calling_model(tmp_path):
+    class OverloadedError(Exception):
+        code = 429
+
+    class FlakyModel(DummyModel):
+        def generate_image(self, prompt, image_path):
+            self.generate_calls.append(prompt)
+            raise OverloadedError("RESOURCE_EXHAUSTED")
+
+    model = FlakyModel()
+    model.generate_calls = []
+    service = GameService(
+        model,
+        uploads_dir=str(tmp_path),
+        model_guard={"failure_threshold": 2, "reset_timeout": 60},
+    )
+    service.save_image_bytes("slack", "w", "c", "u", b"img")
+    for _ in range(2):
+        with pytest.raises(GenerationError):
+            service.change_image("slack", "w", "c", "u", "add a bird")
+    with pytest.raises(ModelUnavailableError) as excinfo:
+        service.change_image("slack", "w", "c", "u", "add a bird")
+    assert len(model.generate_calls) == 2
+    assert 0 < excinfo.value.retry_after <= 60
+    assert service.model_guards["generate"].limiter.limit < 8
+    assert "try again in 60s" in service.format_model_unavailable(excinfo.value.retry_after)
+
+
+async def test_validation_cache_hits_bypass_the_model_guard(tmp_path):
+    model = AsyncDummyModel(image_bytes=b"new")
+    model.validation_cache = ValidationCache(maxsize=4, ttl=60)
+    model.validation_cache.put("add a bird", True, None)
+    service = GameService(model, uploads_dir=str(tmp_path))
+    guard = service.model_guards["validate"] = ModelGuard(
+        "validate", failure_threshold=1, reset_timeout=0
+    )
+    guard.breaker.record(False)
+    service.save_image_bytes("slack", "w", "c", "u", b"img")
+
+    await service.change_image_async("slack", "w", "c", "u", "Add a bird!")
+    service.change_image("slack", "w", "c", "u", "add a bird")
+
+    assert model.async_calls == ["generate"]
+    # The breaker is still waiting for a real call to probe the backend.
+    assert guard.breaker.state == OPEN
+    assert guard.limiter.stats()["increases"] == 0
+    assert model.validation_cache.stats()["hits"] == 2
+
+
+class CountingModel(DummyModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.validations = 0
+
+    def validate_prompt(self, prompt):
+        self.validations += 1
+        return super().validate_prompt(prompt)
+
+
+def test_prefilter_rejects_without_model_call(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = CountingModel()
+    svc = GameService(model, prefilter={})
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    with pytest.raises(InvalidPromptError) as exc:
+        svc.change_image("slack", "T1", "C1", "U2", "make it 8k")
+    assert "image size" in str(exc.value)
+    assert model.validations == 0
+    assert svc.prefilter.stats()["hits"]["resolution"] == 1
+
+
+def test_prefilter_shadow_mode_still_asks_model(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = CountingModel(valid=True, image_bytes=b"new")
+    svc = GameService(model, prefilter={"mode": "shadow"})
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    svc.change_image("slack", "T1", "C1", "U2", "make it 8k")
+    assert model.validations == 1
+    assert svc.prefilter.stats()["disagreed"]["resolution"] == 1
+
+
+def test_change_is_discarded_when_redis_lease_is_lost(tmp_path, monkeypatch):
+    from bench.fakes import FakeRedis
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    client = FakeRedis()
+
+    class StealingModel(DummyModel):
+        def generate_image(self, prompt, image_path):
+            client.set("rengabot:lock:slack/T1/C1", "someone-else")
+            return b"new"
+
+    svc = GameService(
+        StealingModel(), lock_backend="redis", lock_ttl=60, lock_options={"client": client}
+    )
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    before = svc.get_current_image_path("slack", "T1", "C1")
+    with pytest.raises(ChangeInProgressError):
+        svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    assert svc.get_current_image_path("slack", "T1", "C1") == before
+
+
+async def test_async_change_takes_redis_lease_off_the_event_loop(tmp_path):
+    import threading
+
+    from bench.fakes import FakeRedis
+
+    client = FakeRedis()
+    loop_thread = threading.current_thread()
+    calls = []
+
+    class RecordingRedis:
+        def set(self, key, *args, **kwargs):
+            calls.append(("set", key, threading.current_thread()))
+            return client.set(key, *args, **kwargs)
+
+        def eval(self, script, numkeys, key, *args):
+            calls.append(("eval", key, threading.current_thread()))
+            return client.eval(script, numkeys, key, *args)
+
+        def __getattr__(self, name):
+            return getattr(client, name)
+
+    svc = GameService(
+        AsyncDummyModel(image_bytes=b"new"),
+        uploads_dir=str(tmp_path),
+        lock_backend="redis",
+        lock_options={"client": RecordingRedis()},
+    )
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    calls.clear()
+    await svc.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+    change_lock = "rengabot:lock:slack/T1/C1"
+    assert [name for name, key, _ in calls if key == change_lock] == ["set", "eval"]
+    assert all(thread is not loop_thread for _, _, thread in calls)
+    assert client.get("rengabot:lock:slack/T1/C1") is None
+
+
+def test_rate_limit_rejects_before_model_call(tmp_path, monkeypatch):
+    from game.service import RateLimitedError
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = CountingModel(valid=True, image_bytes=b"new")
+    svc = GameService(model, rate_limits={"user": {"rate": 1, "per": 60}})
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    with pytest.raises(RateLimitedError) as exc:
+        svc.change_image("slack", "T1", "C1", "U2", "add a cat")
+    assert model.validations == 1
+    assert "try again in 60s" in GameService.format_rate_limited(exc.value.retry_after)
+
+
+def test_rate_limit_not_charged_when_lock_is_held(tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = CountingModel(valid=True, image_bytes=b"new")
+    svc = GameService(model, rate_limits={"user": {"rate": 1, "per": 60}})
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    lease = svc._acquire_change_lock("slack", "T1", "C1")
+    with pytest.raises(ChangeInProgressError):
+        svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    svc._release_change_lock(lease)
+    svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    assert model.validations == 1
+
+
+async def test_rate_limit_not_charged_when_queue_is_full(tmp_path, monkeypatch):
+    from game.service import RateLimitedError
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    model = GatedModel()
+    svc = GameService(model, rate_limits={"user": {"rate": 1, "per": 60}})
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    first = asyncio.create_task(svc.change_image_async("slack", "T1", "C1", "U1", "one"))
+    await asyncio.sleep(0.01)
+    with pytest.raises(ChangeInProgressError):
+        await svc.change_image_async("slack", "T1", "C1", "U2", "two")
+    model.gate.set()
+    await first
+    await svc.change_image_async("slack", "T1", "C1", "U2", "two")
+    with pytest.raises(RateLimitedError):
+        await svc.change_image_async("slack", "T1", "C1", "U2", "three")
+
+
+def test_concurrent_set_images_keep_every_turn(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    svc = GameService(DummyModel(), uploads_dir=str(tmp_path))
+    with ThreadPoolExecutor(4) as pool:
+        list(
+            pool.map(
+                lambda i: svc.save_image_bytes("slack", "T1", "C1", "U1", f"img{i}".encode()),
+                range(8),
+            )
+        )
+    history = svc.get_history("slack", "T1", "C1")
+    assert [h["turn"] for h in history] == list(range(1, 9))
+    assert len({h["digest"] for h in history}) == 8
+    assert svc.channel_store("slack", "T1", "C1").current().turn == 8
+
+
+def test_change_from_a_superseded_lease_is_fenced_out(tmp_path):
+    from bench.fakes import FakeRedis
+    from game.service import ChangeInProgressError
+
+    svc = GameService(
+        DummyModel(),
+        uploads_dir=str(tmp_path),
+        lock_backend="redis",
+        lock_options={"client": FakeRedis()},
+    )
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    key = svc._change_lock_key("slack", "T1", "C1")
+    old = svc.lock_manager.acquire(key)
+    svc.lock_manager.release(old)
+    new = svc.lock_manager.acquire(key)
+    svc._save_generated_image("slack", "T1", "C1", "U2", b"new", "add a bird", 0.0, new)
+    # The old holder's is_held check passed just before it lost the lease.
+    svc.lock_manager.is_held = lambda lease: True
+    with pytest.raises(ChangeInProgressError):
+        svc._save_generated_image("slack", "T1", "C1", "U3", b"old", "add a cat", 0.0, old)
+    assert [h["user_id"] for h in svc.get_history("slack", "T1", "C1")] == ["U1", "U2"]
+    svc.lock_manager.release(new)
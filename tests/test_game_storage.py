@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from bench.fakes import FakeS3
+from game.service import GameService
+from game.storage import FilesystemStorage, S3Storage
+from game.store import ChannelImageStore
+
+
+def test_s3_store_keeps_the_channel_layout():
+    client = FakeS3()
+    storage = S3Storage(client, "bucket", prefix="renga")
+    store = ChannelImageStore("slack/T1/C1", storage)
+    first = store.put_bytes(b"base", "png", "U1")
+    second = store.put_bytes(b"next", "png", "U2", prompt="add a bird")
+
+    assert first.path == f"slack/T1/C1/images/{first.digest}.png"
+    assert ("bucket", "renga/" + first.path) in client.objects
+    assert ("bucket", "renga/slack/T1/C1/turns/00000002.json") in client.objects
+    assert store.current().path == second.path
+    assert [h["prompt"] for h in store.history()] == [None, "add a bird"]
+
+
+def test_s3_reads_of_written_objects_are_cached_but_pointers_are_not():
+    client = FakeS3()
+    storage = S3Storage(client, "bucket")
+    storage.put("k/images/a.png", b"image")
+    assert storage.get("k/images/a.png") == b"image"
+    assert client.calls.get("get_object", 0) == 0
+
+    storage.swap_pointer("k/current", b"1")
+    client.objects[("bucket", "k/current")] = b"2"
+    assert storage.read_pointer("k/current") == b"2"
+    assert storage.read_pointer("k/missing") is None
+    with pytest.raises(FileNotFoundError):
+        storage.get("k/missing")
+
+
+def test_s3_large_files_are_streamed_in_parts(tmp_path):
+    client = FakeS3()
+    storage = S3Storage(client, "bucket", part_size=4, cache_bytes=0)
+    src = tmp_path / "upload.png"
+    src.write_bytes(b"0123456789")
+    storage.put_file("k/images/big.png", str(src))
+
+    assert not src.exists()
+    assert client.calls["upload_part"] == 3
+    assert storage.get("k/images/big.png") == b"0123456789"
+    assert storage.stats()["multipart_uploads"] == 1
+
+
+def test_filesystem_storage_lists_names_under_prefix(tmp_path):
+    storage = FilesystemStorage()
+    storage.put(str(tmp_path / "turns" / "b.json"), b"{}")
+    storage.put(str(tmp_path / "turns" / "a.json"), b"{}")
+    assert storage.list(str(tmp_path / "turns")) == ["a.json", "b.json"]
+    assert storage.list(str(tmp_path / "missing")) == []
+
+
+async def test_service_changes_images_in_object_storage(tmp_path):
+    class PathModel:
+        def validate_prompt(self, prompt):
+            return (True, None)
+
+        def generate_image(self, prompt, image_path):
+            assert os.path.exists(image_path)
+            return open(image_path, "rb").read() + b"+"
+
+    client = FakeS3()
+    svc = GameService(
+        PathModel(),
+        uploads_dir=str(tmp_path),
+        storage={"backend": "s3", "client": client, "bucket": "renga"},
+    )
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base", ext="jpg")
+    path = await svc.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+
+    other = GameService(
+        PathModel(),
+        uploads_dir=str(tmp_path / "other"),
+        storage={"backend": "s3", "client": client, "bucket": "renga"},
+    )
+    assert other.get_current_image_path("slack", "T1", "C1") == path
+    assert other.read_image("slack", "T1", "C1") == b"base+"
+
+
+@pytest.mark.parametrize("backend", ["filesystem", "s3"])
+def test_put_if_absent_never_overwrites(tmp_path, backend):
+    if backend == "s3":
+        storage = S3Storage(FakeS3(), "bucket")
+        key = "k/turns/00000001.json"
+    else:
+        storage = FilesystemStorage()
+        key = str(tmp_path / "turns" / "00000001.json")
+    assert storage.put_if_absent(key, b"first")
+    assert not storage.put_if_absent(key, b"second")
+    assert storage.get(key) == b"first"
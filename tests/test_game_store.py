@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from game.store import ChannelImageStore
+
+
+def test_put_bytes_is_content_addressed_and_moves_pointer(tmp_path):
+    store = ChannelImageStore(str(tmp_path))
+    first = store.put_bytes(b"base", "png", "U1")
+    second = store.put_bytes(b"next", "png", "U2", prompt="add a bird")
+    assert os.path.basename(first.path) == hashlib.sha256(b"base").hexdigest() + ".png"
+    assert open(first.path, "rb").read() == b"base"
+    assert store.current().path == second.path
+    assert store.current().turn == 2
+
+
+def test_history_records_each_turn(tmp_path):
+    store = ChannelImageStore(str(tmp_path))
+    first = store.put_bytes(b"base", "jpg", "U1")
+    store.put_bytes(b"next", "png", "U2", prompt="add a bird", requested_at=1.0)
+    history = store.history()
+    assert [h["turn"] for h in history] == [1, 2]
+    assert history[1]["parent"] == first.digest
+    assert history[1]["prompt"] == "add a bird"
+    assert history[1]["user_id"] == "U2"
+    assert history[1]["size"] == 4
+    assert history[1]["requested_at"] == 1.0
+
+
+def test_put_file_moves_upload_into_store(tmp_path):
+    store = ChannelImageStore(str(tmp_path / "C1"))
+    src = tmp_path / "upload.png"
+    src.write_bytes(b"uploaded")
+    version = store.put_file(str(src), "png", "U1")
+    assert not src.exists()
+    assert open(version.path, "rb").read() == b"uploaded"
+
+
+def test_legacy_current_file_is_read_until_first_version(tmp_path):
+    legacy = tmp_path / "current.jpeg"
+    legacy.write_bytes(b"old")
+    store = ChannelImageStore(str(tmp_path))
+    assert store.current().path == str(legacy)
+    version = store.put_bytes(b"new", "png", "U1")
+    assert store.current().path == version.path
+
+
+def test_no_temp_files_left_behind(tmp_path):
+    store = ChannelImageStore(str(tmp_path))
+    store.put_bytes(b"base", "png", "U1")
+    leftovers = [
+        name for _, _, files in os.walk(tmp_path) for name in files if name.endswith(".tmp")
+    ]
+    assert leftovers == []
+
+
+def test_commit_chains_onto_a_turn_taken_by_someone_else(tmp_path):
+    store = ChannelImageStore(str(tmp_path))
+    first = store.put_bytes(b"base", "png", "U1")
+    # Another writer committed turn 2 but hasn't moved the pointer yet.
+    (tmp_path / "turns" / "00000002.json").write_text(
+        json.dumps({"turn": 2, "digest": "theirs"})
+    )
+    version = store.put_bytes(b"next", "png", "U2")
+    assert version.turn == 3
+    history = store.history()
+    assert [h["turn"] for h in history] == [1, 2, 3]
+    assert history[1]["digest"] == "theirs"
+    assert history[2]["parent"] == "theirs"
+    assert first.digest == history[0]["digest"]
+
+
+def test_commit_with_an_older_fence_is_refused(tmp_path):
+    from game.store import StaleFenceError
+
+    store = ChannelImageStore(str(tmp_path))
+    store.put_bytes(b"new holder", "png", "U1", fence=5)
+    with pytest.raises(StaleFenceError):
+        store.put_bytes(b"old holder", "png", "U2", fence=4)
+    # Commits without a lease (set-image) keep the recorded fence.
+    store.put_bytes(b"reset", "png", "U3")
+    with pytest.raises(StaleFenceError):
+        store.put_bytes(b"old holder", "png", "U2", fence=4)
+    assert [h["user_id"] for h in store.history()] == ["U1", "U3"]
+    assert store.put_bytes(b"next", "png", "U4", fence=6).turn == 3
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from game.service import (
+    GameService,
+    GenerationError,
+    InvalidPromptError,
+    ModelUnavailableError,
+    NoImageError,
+    RateLimitedError,
+)
+from game.workers import (
+    _DONE,
+    _ERROR,
+    ShardedGameService,
+    _Job,
+    _Worker,
+    _decode_error,
+    _encode_error,
+    _shard_game_config,
+    shard_for,
+    supervisor_game_config,
+)
+from telemetry import tracing
+
+
+def _pool(tmp_path, processes=2, **model_args):
+    args = {"validation_latency": 0.0, "generation_latency": 0.0, "error_rate": 0.0}
+    args.update(model_args)
+    game = {"uploads_dir": str(tmp_path), "queue_depth": 8}
+    local = GameService(None, **game)
+    config = {"model": {"class": "bench.fakes.FakeModel", "args": args}, "game": game}
+    return local, ShardedGameService(local, config, processes)
+
+
+def test_shard_is_stable_and_in_range():
+    key = ("slack", "T1", "C1")
+    assert shard_for(key, 4) == shard_for(key, 4)
+    assert {shard_for(("slack", "T1", f"C{i}"), 4) for i in range(50)} == {0, 1, 2, 3}
+
+
+def test_errors_survive_the_round_trip():
+    error = _decode_error(_encode_error(ModelUnavailableError(12)))
+    assert isinstance(error, ModelUnavailableError)
+    assert error.retry_after == 12
+    assert _decode_error(_encode_error(InvalidPromptError(None))).reason is None
+
+
+def test_rate_limits_split_between_supervisor_and_shards():
+    limits = {"user": {"rate": 1}, "channel": {"rate": 2}, "path": "/var/limits.json"}
+    game = {"queue_depth": 8, "rate_limits": limits}
+    assert _shard_game_config(game, 1)["rate_limits"] == {
+        "channel": {"rate": 2},
+        "path": "/var/limits.shard1.json",
+    }
+    assert supervisor_game_config(game)["rate_limits"] == {
+        "user": {"rate": 1},
+        "path": "/var/limits.json",
+    }
+    assert game["rate_limits"] is limits and "channel" in limits
+    assert _shard_game_config({"queue_depth": 8, "rate_limits": {"user": {"rate": 1}}}, 1) == {
+        "queue_depth": 8
+    }
+    assert _shard_game_config({"queue_depth": 8}, 1) == {"queue_depth": 8}
+
+
+async def test_user_limits_are_enforced_before_dispatch(tmp_path):
+    _, pool = _pool(tmp_path, processes=2, invalid_rate=0.0)
+    game = {"uploads_dir": str(tmp_path), "rate_limits": {"user": {"rate": 1, "per": 60}}}
+    pool.service = local = GameService(None, **supervisor_game_config(game))
+    try:
+        # Turned away by the worker (no image yet), so the token comes back.
+        with pytest.raises(NoImageError):
+            await pool.change_image_async("slack", "T1", "C1", "U1", "add a bird")
+        local.save_image_bytes("slack", "T1", "C1", "U0", b"base")
+        local.save_image_bytes("slack", "T1", "C4", "U0", b"base")
+        await pool.change_image_async("slack", "T1", "C1", "U1", "add a bird")
+        # C4 is on the other worker, but U1's bucket is shared.
+        assert shard_for(("slack", "T1", "C4"), 2) != shard_for(("slack", "T1", "C1"), 2)
+        with pytest.raises(RateLimitedError) as exc:
+            await pool.change_image_async("slack", "T1", "C4", "U1", "add a cat")
+        stats = pool.stats()
+    finally:
+        pool.stop()
+    assert exc.value.scope == "user"
+    assert stats["pending"] == {0: 0, 1: 0}
+
+
+async def test_changes_run_in_workers_in_channel_order(tmp_path):
+    local, pool = _pool(tmp_path, invalid_rate=0.0)
+    local.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    try:
+        paths = await asyncio.gather(
+            *[
+                pool.change_image_async("slack", "T1", "C1", f"U{i}", f"add bird {i}")
+                for i in range(4)
+            ]
+        )
+    finally:
+        pool.stop()
+    history = local.get_history("slack", "T1", "C1")
+    assert [h["prompt"] for h in history[-4:]] == [f"add bird {i}" for i in range(4)]
+    assert local.show_image("slack", "T1", "C1") == paths[-1]
+
+
+async def test_worker_errors_come_back_as_game_errors(tmp_path):
+    local, pool = _pool(tmp_path, processes=1, invalid_rate=1.0)
+    local.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    try:
+        with pytest.raises(InvalidPromptError) as exc:
+            await pool.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+    finally:
+        pool.stop()
+    assert exc.value.reason == "that's two changes"
+
+
+async def test_dead_worker_is_restarted_and_job_requeued(tmp_path):
+    local, pool = _pool(tmp_path, processes=1, invalid_rate=0.0, generation_latency=1.0, sigma=0.01)
+    local.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    try:
+        change = asyncio.ensure_future(
+            pool.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+        )
+        deadline = time.monotonic() + 10
+        while not pool.stats()["pending"].get(0) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.5)
+        os.kill(pool._workers[0].process.pid, 9)
+        path = await asyncio.wait_for(change, 20)
+        stats = pool.stats()
+    finally:
+        pool.stop()
+    assert os.path.exists(path)
+    assert stats["restarts"] == 1
+    assert stats["requeued"] == 1
+
+
+def test_unreadable_result_fails_only_its_job(tmp_path):
+    _, pool = _pool(tmp_path, processes=1)
+    pool._workers = [_Worker(0, None, None)]
+    bad, good = _Job(1, (), None, None), _Job(2, (), None, None)
+    pool._workers[0].pending.update({1: bad, 2: good})
+    reader = threading.Thread(target=pool._read_results, daemon=True)
+    reader.start()
+    pool._results.put((_ERROR, 0, 1, b"not a pickle"))
+    pool._results.put((_DONE, 0, 2, "path"))
+    assert good.future.result(5) == "path"
+    with pytest.raises(GenerationError):
+        bad.future.result(5)
+    pool._results.put(None)
+    reader.join(5)
+
+
+async def test_worker_spans_join_the_callers_trace(tmp_path):
+    local, pool = _pool(tmp_path, processes=1, invalid_rate=0.0)
+    pool.config["tracing"] = {"export_path": str(tmp_path / "spans.jsonl")}
+    local.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    try:
+        with tracing.start_trace("slack.mention") as root:
+            await pool.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+    finally:
+        pool.stop()
+    lines = (tmp_path / "spans.worker0.jsonl").read_text().splitlines()
+    spans = [json.loads(line) for line in lines]
+    assert "service.change_image" in {s["name"] for s in spans}
+    assert {s["trace_id"] for s in spans} == {root.trace_id}
@@ -0,0 +1,38 @@
+import types
+
+from messengers import base
+
+
+def test_initialize_messenger_imports_module_on_first_use(monkeypatch):
+    module = types.ModuleType("fake_messenger")
+
+    def _load():
+        @base.register("fake")
+        class FakeMessenger(base.ChatMessenger):
+            def run(self):
+                pass
+
+        module.FakeMessenger = FakeMessenger
+
+    monkeypatch.setattr(base, "_REGISTRY", dict(base._REGISTRY))
+    monkeypatch.setitem(base._MODULES, "fake", "fake_messenger")
+    imported = []
+
+    def import_module(name):
+        imported.append(name)
+        _load()
+        return module
+
+    monkeypatch.setattr(base.importlib, "import_module", import_module)
+    messenger = base.initialize_messenger("fake", {}, rengabot=None)
+    assert isinstance(messenger, module.FakeMessenger)
+    base.initialize_messenger("fake", {}, rengabot=None)
+    assert imported == ["fake_messenger"]
+
+
+def test_initialize_messenger_uses_module_from_config(monkeypatch):
+    monkeypatch.setattr(base, "_REGISTRY", dict(base._REGISTRY))
+    imported = []
+    monkeypatch.setattr(base.importlib, "import_module", imported.append)
+    assert base.initialize_messenger("custom", {"module": "my.messenger"}, None) is None
+    assert imported == ["my.messenger"]
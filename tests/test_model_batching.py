@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+from model.batching import BatchParseError, ValidationBatcher
+
+
+def _validate_concurrently(batcher, prompts):
+    results = {}
+
+    def worker(prompt):
+        results[prompt] = batcher.validate(prompt)
+
+    threads = [threading.Thread(target=worker, args=(p,)) for p in prompts]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_batches_concurrent_requests_and_fans_out_verdicts():
+    batches = []
+
+    def validate_batch(prompts):
+        batches.append(list(prompts))
+        return [(not p.startswith("bad"), p) for p in prompts]
+
+    batcher = ValidationBatcher(validate_batch, lambda p: (True, None), window=0.2, max_batch=3)
+    results = _validate_concurrently(batcher, ["add a cat", "bad one", "add a dog"])
+
+    assert results == {
+        "add a cat": (True, "add a cat"),
+        "bad one": (False, "bad one"),
+        "add a dog": (True, "add a dog"),
+    }
+    assert len(batches) == 1
+    assert batcher.stats()["batches"] == 1
+    batcher.stop()
+
+
+def test_single_request_skips_batch_format():
+    batcher = ValidationBatcher(
+        lambda prompts: [], lambda p: (False, "single"), window=0.01
+    )
+    assert batcher.validate("add a cat") == (False, "single")
+    assert batcher.stats()["single_calls"] == 1
+    batcher.stop()
+
+
+def test_falls_back_to_single_calls_when_batch_cannot_be_parsed():
+    def validate_batch(prompts):
+        raise BatchParseError("expected 2 verdicts")
+
+    batcher = ValidationBatcher(
+        validate_batch, lambda p: (True, p.upper()), window=0.2, max_batch=2
+    )
+    results = _validate_concurrently(batcher, ["add a cat", "add a dog"])
+
+    assert results == {"add a cat": (True, "ADD A CAT"), "add a dog": (True, "ADD A DOG")}
+    assert batcher.stats()["fallbacks"] == 1
+    assert batcher.stats()["single_calls"] == 2
+    batcher.stop()
+
+
+async def test_async_callers_share_a_batch():
+    batches = []
+
+    def validate_batch(prompts):
+        batches.append(prompts)
+        return [(True, None)] * len(prompts)
+
+    batcher = ValidationBatcher(validate_batch, lambda p: (True, None), window=0.2, max_batch=2)
+    results = await asyncio.gather(
+        batcher.validate_async("add a cat"), batcher.validate_async("add a dog")
+    )
+    assert results == [(True, None), (True, None)]
+    assert batches == [["add a cat", "add a dog"]]
+    batcher.stop()
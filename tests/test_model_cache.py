@@ -0,0 +1,46 @@
+import time
+
+from model.cache import ValidationCache, normalize_prompt
+
+
+def test_normalize_prompt_collapses_trivial_differences():
+    assert normalize_prompt("  Make it a   PAINTING! ") == "make it a painting"
+    assert normalize_prompt("add a cat.") == normalize_prompt("Add a cat")
+
+
+def test_cache_counts_hits_and_misses():
+    cache = ValidationCache(maxsize=4, ttl=60)
+    assert cache.get("add a cat") is None
+    cache.put("add a cat", False, "too vague")
+    assert cache.get("Add a cat.") == (False, "too vague")
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_expires_entries():
+    cache = ValidationCache(maxsize=4, ttl=0.01)
+    cache.put("add a cat", True, None)
+    time.sleep(0.02)
+    assert cache.get("add a cat") is None
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ValidationCache(maxsize=2, ttl=60)
+    cache.put("one", True, None)
+    cache.put("two", True, None)
+    cache.get("one")
+    cache.put("three", True, None)
+    assert cache.get("two") is None
+    assert cache.get("one") == (True, None)
+
+
+def test_cache_persists_to_disk(tmp_path):
+    path = tmp_path / "validation-cache.json"
+    cache = ValidationCache(maxsize=4, ttl=60, path=str(path), save_interval=60)
+    cache.put("new rule: two changes", False, "rule change")
+    # Saving is left to the background thread, not done on put.
+    assert not path.exists()
+    cache.close()
+    assert [p.name for p in tmp_path.iterdir()] == ["validation-cache.json"]
+    reloaded = ValidationCache(maxsize=4, ttl=60, path=str(path))
+    assert reloaded.get("new rule: two changes") == (False, "rule change")
@@ -1,6 +1,9 @@
 import json
 import types
 
+import pytest
+
+from model.batching import BatchParseError
 from model.gemini import GeminiModel
 
 
@@ -8,10 +11,16 @@ class DummyClient:
     def __init__(self, response):
         self._response = response
         self.models = types.SimpleNamespace(generate_content=self._generate_content, list=self._list)
+        self.aio = types.SimpleNamespace(
+            models=types.SimpleNamespace(generate_content=self._generate_content_async)
+        )
 
     def _generate_content(self, **kwargs):
         return self._response
 
+    async def _generate_content_async(self, **kwargs):
+        return self._response
+
     def _list(self):
         return []
 
@@ -46,3 +55,164 @@ def test_generate_image_extracts_bytes(monkeypatch, tmp_path):
     path.write_bytes(b"base")
     data = model.generate_image("add a bird", str(path))
     assert data == b"img"
+
+
+def test_validate_prompt_uses_cache(monkeypatch):
+    calls = []
+    response = types.SimpleNamespace(text=json.dumps({"valid": False, "reason": "two changes"}))
+    model = GeminiModel(api_key="x", intent_cache_ttl=None)
+    model.client = DummyClient(response)
+    monkeypatch.setattr(
+        model.client.models, "generate_content", lambda **kw: calls.append(kw) or response
+    )
+
+    assert model.validate_prompt("add a bird and a cat") == (False, "two changes")
+    assert model.validate_prompt("Add a bird and a cat.") == (False, "two changes")
+    assert len(calls) == 1
+    assert model.validation_cache.hits == 1
+
+
+async def test_validate_prompt_async_uses_aio_client():
+    response = types.SimpleNamespace(text=json.dumps({"valid": False, "reason": "rule change"}))
+    model = GeminiModel(api_key="x", intent_cache_ttl=None)
+    model.client = DummyClient(response)
+
+    assert await model.validate_prompt_async("new rule") == (False, "rule change")
+
+
+async def test_generate_image_async_extracts_bytes(tmp_path):
+    part = types.SimpleNamespace(inline_data=types.SimpleNamespace(data=b"img"))
+    response = types.SimpleNamespace(parts=[part])
+    model = GeminiModel(api_key="x", intent_cache_ttl=None)
+    model.client = DummyClient(response)
+
+    path = tmp_path / "current.jpg"
+    path.write_bytes(b"base")
+    assert await model.generate_image_async("add a bird", str(path)) == b"img"
+
+
+def test_generate_image_retries_transient_errors(tmp_path):
+    from google.genai import errors
+
+    part = types.SimpleNamespace(inline_data=types.SimpleNamespace(data=b"img"))
+    response = types.SimpleNamespace(parts=[part])
+    model = GeminiModel(api_key="x", intent_cache_ttl=None, retry_initial_backoff=0)
+    model.client = DummyClient(response)
+    calls = []
+
+    def flaky(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise errors.ServerError(503, {"error": {"message": "overloaded"}})
+        return response
+
+    model.client.models.generate_content = flaky
+    path = tmp_path / "current.png"
+    path.write_bytes(b"base")
+    assert model.generate_image("add a bird", str(path)) == b"img"
+    assert len(calls) == 2
+    assert model.call_stats()["retries"] == {"generate": 1}
+
+
+def _image_response(data):
+    part = types.SimpleNamespace(inline_data=types.SimpleNamespace(data=data))
+    return types.SimpleNamespace(parts=[part])
+
+
+def test_generate_image_fails_over_and_demotes_missing_model():
+    model = GeminiModel(
+        api_key="x",
+        intent_cache_ttl=None,
+        image_models=["primary", "backup"],
+        retry_initial_backoff=0,
+    )
+    model.client = DummyClient(None)
+    calls = []
+
+    def generate(**kwargs):
+        calls.append(kwargs["model"])
+        if kwargs["model"] == "primary":
+            raise Exception("404 NOT_FOUND. models/primary is not found")
+        return _image_response(b"img")
+
+    model.client.models.generate_content = generate
+    assert model.generate_image_from_input("add a bird", "part") == b"img"
+    assert model.generate_image_from_input("add a cat", "part") == b"img"
+    # The demoted primary is skipped on the second turn.
+    assert calls == ["primary", "backup", "backup"]
+    stats = model.call_stats()["image_models"]
+    assert list(stats["demoted"]) == ["primary"]
+    assert stats["failovers"] == 1
+
+
+def test_generate_image_caches_model_discovery():
+    model = GeminiModel(api_key="x", intent_cache_ttl=None, image_models=["only"])
+    model.client = DummyClient(None)
+    listed = []
+
+    def list_models():
+        listed.append(1)
+        return [
+            types.SimpleNamespace(
+                name="models/other-image", supported_actions=["generateContent"]
+            )
+        ]
+
+    def generate(**kwargs):
+        raise Exception("model is not supported for generateContent")
+
+    model.client.models.list = list_models
+    model.client.models.generate_content = generate
+    for _ in range(2):
+        with pytest.raises(Exception, match="models/other-image"):
+            model.generate_image_from_input("add a bird", "part")
+    assert len(listed) == 1
+
+
+def test_failover_counts_transient_failures_before_demoting():
+    from model.failover import ModelFailover
+
+    failover = ModelFailover(["a", "b"], failure_threshold=2, cooldown=60)
+    failover.record_failure("a")
+    assert failover.order() == ["a", "b"]
+    failover.record_failure("a")
+    assert failover.order() == ["b", "a"]
+    failover.record_success("a")
+    assert failover.order() == ["a", "b"]
+
+
+def test_validate_prompt_falls_back_inline_when_intent_cache_vanishes():
+    from model.intent_cache import IntentCacheManager
+
+    response = types.SimpleNamespace(text=json.dumps({"valid": True}))
+    model = GeminiModel(api_key="x", intent_cache_ttl=None, validation_cache_size=0)
+    model.client = DummyClient(response)
+    model.intent_cache = IntentCacheManager(lambda: model.client, "intent", lambda: [], 60)
+    model.intent_cache._set("cachedContents/gone", renewed=False)
+    sent = []
+
+    def generate(**kwargs):
+        sent.append(kwargs["config"].cached_content)
+        if kwargs["config"].cached_content:
+            raise Exception("404 NOT_FOUND: cachedContents/gone not found")
+        return response
+
+    model.client.models.generate_content = generate
+    assert model.validate_prompt("add a bird") == (True, None)
+    assert sent == ["cachedContents/gone", None]
+    assert model.intent_cache.name() is None
+
+
+def test_validate_batch_parses_verdicts_and_rejects_mismatched_answers():
+    response = types.SimpleNamespace(
+        text=json.dumps([{"valid": True}, {"valid": False, "reason": "two changes"}])
+    )
+    model = GeminiModel(api_key="x", intent_cache_ttl=None, validation_batch_window=0.01)
+    model.client = DummyClient(response)
+
+    verdicts = model._validate_batch(["add a cat", "add a dog and a cat"])
+    assert verdicts == [(True, None), (False, "two changes")]
+    assert model.validate_prompt("add a dog and a cat") == (False, "two changes")
+
+    with pytest.raises(BatchParseError):
+        model._validate_batch(["a", "b", "c"])
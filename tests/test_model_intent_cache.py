@@ -0,0 +1,105 @@
+import os
+import socket
+import time
+import types
+
+from model.intent_cache import DISPLAY_NAME, IntentCacheManager, owner_tag, parse_ttl
+
+
+class FakeCaches:
+    def __init__(self, existing=()):
+        self.caches = {c.name: c for c in existing}
+        self.created = 0
+        self.fail_update = False
+        self.fail_create = False
+
+    def create(self, model, config):
+        if self.fail_create:
+            raise RuntimeError("quota")
+        self.created += 1
+        cache = types.SimpleNamespace(
+            name=f"cachedContents/{self.created}", display_name=config.display_name
+        )
+        self.caches[cache.name] = cache
+        return cache
+
+    def update(self, name, config):
+        if self.fail_update or name not in self.caches:
+            raise RuntimeError("404 NOT_FOUND")
+        return self.caches[name]
+
+    def list(self):
+        return list(self.caches.values())
+
+    def delete(self, name):
+        del self.caches[name]
+
+
+def _manager(caches, ttl="60s"):
+    client = types.SimpleNamespace(caches=caches)
+    return IntentCacheManager(lambda: client, "intent", lambda: [], ttl)
+
+
+def _cache(name, display_name):
+    return types.SimpleNamespace(name=name, display_name=display_name)
+
+
+def test_parse_ttl():
+    assert parse_ttl("3600s") == 3600
+    assert parse_ttl(90) == 90
+
+
+def test_refresh_creates_then_extends():
+    caches = FakeCaches()
+    manager = _manager(caches)
+    assert manager.name() is None
+    manager.refresh()
+    assert manager.name() == "cachedContents/1"
+    manager.refresh()
+    assert caches.created == 1
+    stats = manager.stats()
+    assert stats["refreshes"] == 2
+    assert stats["recreations"] == 1
+    assert 0 < stats["expires_in"] <= 60
+
+
+def test_invalidated_cache_is_recreated():
+    caches = FakeCaches()
+    manager = _manager(caches)
+    manager.refresh()
+    manager.invalidate("cachedContents/1")
+    assert manager.name() is None
+    manager.refresh()
+    assert manager.name() == "cachedContents/2"
+
+
+def test_cleanup_only_deletes_orphans():
+    host = socket.gethostname()
+    caches = FakeCaches(
+        [
+            _cache("legacy", DISPLAY_NAME),
+            _cache("dead", f"{DISPLAY_NAME}:{host}:999999999"),
+            _cache("live", owner_tag()),
+            _cache("parent", f"{DISPLAY_NAME}:{host}:{os.getppid()}"),
+            _cache("remote", f"{DISPLAY_NAME}:elsewhere:1"),
+            _cache("other", "someone-else"),
+        ]
+    )
+    manager = _manager(caches)
+    assert manager.cleanup_orphans() == 2
+    assert sorted(caches.caches) == ["live", "other", "parent", "remote"]
+
+
+def test_background_thread_records_failures_and_keeps_running():
+    caches = FakeCaches()
+    caches.fail_create = True
+    manager = _manager(caches)
+    manager.start()
+    deadline = time.time() + 2
+    while manager.stats()["refresh_failures"] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    manager.stop()
+    stats = manager.stats()
+    assert stats["refresh_failures"] == 1
+    assert "quota" in stats["last_error"]
+    assert manager.name() is None
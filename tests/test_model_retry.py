@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+from google.genai import errors
+
+from model.retry import Hedger, RetryPolicy, is_retryable
+
+
+def _api_error(code):
+    cls = errors.ServerError if code >= 500 else errors.ClientError
+    return cls(code, {"error": {"message": "boom", "status": str(code)}})
+
+
+def test_is_retryable_classifies_status_codes():
+    assert is_retryable(_api_error(429))
+    assert is_retryable(_api_error(503))
+    assert not is_retryable(_api_error(400))
+    assert not is_retryable(_api_error(404))
+    assert is_retryable(ConnectionResetError())
+    assert not is_retryable(ValueError("bad json"))
+
+
+def test_retry_policy_retries_transient_errors():
+    policy = RetryPolicy(attempts=3, initial_backoff=0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _api_error(503)
+        return "ok"
+
+    assert policy.call("generate", flaky) == "ok"
+    assert len(calls) == 3
+    assert policy.stats() == {"retries": {"generate": 2}, "exhausted": {}}
+
+
+def test_retry_policy_gives_up_and_skips_permanent_errors():
+    policy = RetryPolicy(attempts=2, initial_backoff=0)
+    calls = []
+
+    def rate_limited():
+        calls.append(1)
+        raise _api_error(429)
+
+    with pytest.raises(errors.ClientError):
+        policy.call("validate", rate_limited)
+    assert len(calls) == 2
+    assert policy.stats()["exhausted"] == {"validate": 1}
+
+    def bad_request():
+        calls.append(1)
+        raise _api_error(400)
+
+    calls.clear()
+    with pytest.raises(errors.ClientError):
+        policy.call("validate", bad_request)
+    assert len(calls) == 1
+
+
+async def test_retry_policy_async():
+    policy = RetryPolicy(attempts=2, initial_backoff=0)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) == 1:
+            raise asyncio.TimeoutError()
+        return "ok"
+
+    assert await policy.call_async("validate", flaky) == "ok"
+    assert policy.stats()["retries"] == {"validate": 1}
+
+
+async def test_hedger_second_request_wins_when_first_is_slow():
+    hedger = Hedger("validate", percentile=50, min_samples=3)
+    for _ in range(3):
+        hedger.observe(0.01)
+    delays = iter([1.0, 0.0])
+
+    async def call():
+        delay = next(delays)
+        await asyncio.sleep(delay)
+        return delay
+
+    started = time.monotonic()
+    assert await hedger.run_async(call) == 0.0
+    assert time.monotonic() - started < 0.5
+    assert hedger.stats()["hedged"] == 1
+    assert hedger.stats()["hedge_wins"] == 1
+
+
+def test_hedger_waits_for_samples_before_hedging():
+    hedger = Hedger("validate", percentile=50, min_samples=3)
+    assert hedger.delay() is None
+    assert hedger.run(lambda: "ok") == "ok"
+    assert hedger.stats()["hedged"] == 0
+
+    for _ in range(3):
+        hedger.observe(0.01)
+    delays = iter([0.5, 0.0])
+
+    def call():
+        delay = next(delays)
+        time.sleep(delay)
+        return delay
+
+    assert hedger.run(call) == 0.0
+    assert hedger.stats()["hedge_wins"] == 1
@@ -5,6 +5,8 @@ import os
 import pytest
 
 from messengers.slack import SlackMessenger
+from game.backpressure import ModelGuard
+from game.ratelimit import RateLimiter
 from game.service import GameService
 
 
@@ -158,6 +160,83 @@ async def test_slack_change_validation_short_circuit(tmp_path, monkeypatch):
     assert "Disallowed change" in client.messages[0]["text"]
 
 
+@pytest.mark.asyncio
+async def test_slack_change_uploads_new_image_bytes(tmp_path, monkeypatch):
+    config = {"bot_token": "x", "app_token": "y", "admins": []}
+    model = DummyModel(valid=True, image_bytes=b"newpng")
+    sm = _make_slack(config, model)
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    sm.rengabot.service.save_image_bytes(
+        "slack", "T1", "C1", "U1", b"base", ext="png"
+    )
+
+    client = DummyClient()
+    await sm._handle_change_async(
+        client,
+        types.SimpleNamespace(exception=lambda *a, **k: None),
+        "U1",
+        "T1",
+        "C1",
+        "add a bird",
+    )
+    assert client.uploads
+    assert client.uploads[0]["content"] == b"newpng"
+
+
+@pytest.mark.asyncio
+async def test_slack_change_reports_model_unavailable(tmp_path, monkeypatch):
+    config = {"bot_token": "x", "app_token": "y", "admins": []}
+    model = DummyModel(valid=True)
+    sm = _make_slack(config, model)
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    service = sm.rengabot.service
+    service.save_image_bytes("slack", "T1", "C1", "U1", b"base", ext="png")
+    service.model_guards["generate"] = ModelGuard("generate", failure_threshold=1)
+    service.model_guards["generate"].breaker.record(False)
+
+    client = DummyClient()
+    await sm._handle_change_async(
+        client,
+        types.SimpleNamespace(exception=lambda *a, **k: None),
+        "U1",
+        "T1",
+        "C1",
+        "add a bird",
+    )
+    assert model.generate_calls == []
+    assert not client.uploads
+    assert "Please try again in 30s" in client.messages[0]["text"]
+
+
+@pytest.mark.asyncio
+async def test_slack_change_reports_rate_limit_to_user(tmp_path, monkeypatch):
+    config = {"bot_token": "x", "app_token": "y", "admins": []}
+    model = DummyModel(valid=True)
+    sm = _make_slack(config, model)
+
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    service = sm.rengabot.service
+    service.save_image_bytes("slack", "T1", "C1", "U1", b"base", ext="png")
+    service.rate_limiter = RateLimiter(user={"rate": 0.5, "per": 60, "burst": 1})
+    service.rate_limiter.acquire("slack", "T1", "C1", "U1")
+
+    client = DummyClient()
+    await sm._handle_change_async(
+        client,
+        types.SimpleNamespace(exception=lambda *a, **k: None),
+        "U1",
+        "T1",
+        "C1",
+        "add a bird",
+    )
+    assert model.generate_calls == []
+    assert not client.messages
+    assert client.ephemeral[0]["user"] == "U1"
+    assert "Please try again in 120s" in client.ephemeral[0]["text"]
+
+
 @pytest.mark.asyncio
 async def test_slack_change_valid_prompt_uploads(tmp_path, monkeypatch):
     config = {"bot_token": "x", "app_token": "y", "admins": []}
@@ -215,4 +294,66 @@ def test_slack_channel_dir_and_get_current(tmp_path, monkeypatch):
     path = os.path.join(channel_dir, "current.jpeg")
     with open(path, "wb") as f:
         f.write(b"x")
-    assert sm._get_current_image_path("T1", "C1") == path
+    assert sm.rengabot.service.get_current_image_path("slack", "T1", "C1") == path
+
+
+async def _serve(handler):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    app = web.Application()
+    app.router.add_get("/file", handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+@pytest.mark.asyncio
+async def test_slack_download_streams_to_temp_file(tmp_path):
+    from aiohttp import web
+
+    payload = b"\x89PNG\r\n\x1a\n" + b"x" * 200_000
+    seen = {}
+
+    async def handler(request):
+        seen["auth"] = request.headers.get("Authorization")
+        return web.Response(body=payload)
+
+    server = await _serve(handler)
+    sm = _make_slack({"bot_token": "x", "app_token": "y"}, DummyModel())
+    try:
+        path = await sm._download_file(str(server.make_url("/file")), str(tmp_path), "png")
+    finally:
+        await sm._close_http_session()
+        await server.close()
+    assert open(path, "rb").read() == payload
+    assert os.path.basename(path).startswith(".upload.")
+    assert seen["auth"] == "Bearer x"
+
+
+@pytest.mark.asyncio
+async def test_slack_download_rejects_oversize_and_non_images(tmp_path):
+    from aiohttp import web
+    from game.service import InvalidImageError
+    from messengers.slack import DownloadTooLargeError
+
+    async def handler(request):
+        body = request.query.get("body", "png")
+        if body == "png":
+            return web.Response(body=b"\x89PNG\r\n\x1a\n" + b"x" * 5000)
+        return web.Response(body=b"<html>not an image</html>")
+
+    server = await _serve(handler)
+    sm = _make_slack({"bot_token": "x", "app_token": "y", "max_upload_bytes": 1024}, DummyModel())
+    try:
+        with pytest.raises(DownloadTooLargeError):
+            await sm._download_file(str(server.make_url("/file")), str(tmp_path), "png")
+        sm.max_upload_bytes = 1_000_000
+        with pytest.raises(InvalidImageError):
+            await sm._download_file(
+                str(server.make_url("/file?body=html")), str(tmp_path), "png"
+            )
+    finally:
+        await sm._close_http_session()
+        await server.close()
+    assert os.listdir(tmp_path) == []
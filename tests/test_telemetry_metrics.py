@@ -0,0 +1,79 @@
+import urllib.request
+
+import pytest
+
+from game.service import GameService, InvalidPromptError
+from telemetry import metrics
+
+
+class DummyModel:
+    def __init__(self, valid=True, reason=None, image_bytes=b"img"):
+        self.valid = valid
+        self.reason = reason
+        self.image_bytes = image_bytes
+
+    def validate_prompt(self, prompt):
+        return (self.valid, self.reason)
+
+    def generate_image(self, prompt, image_path):
+        return self.image_bytes
+
+
+@pytest.fixture
+def registry():
+    reg = metrics.enable()
+    yield reg
+    metrics.disable()
+    metrics._collectors.clear()
+
+
+def test_helpers_are_noops_when_disabled():
+    assert metrics.registry() is None
+    metrics.inc("rengabot_change_outcomes_total", outcome="ok")
+    with metrics.timed("rengabot_validation_seconds"):
+        pass
+    assert metrics.registry() is None
+
+
+def test_render_histograms_and_counters(registry):
+    metrics.observe("rengabot_generation_seconds", 0.3, platform="slack", workspace="T1")
+    metrics.inc("rengabot_change_outcomes_total", platform="slack", workspace="T1", outcome="ok")
+    text = registry.render()
+    assert (
+        'rengabot_generation_seconds_bucket{platform="slack",workspace="T1",le="0.5"} 1'
+        in text
+    )
+    assert 'rengabot_generation_seconds_count{platform="slack",workspace="T1"} 1' in text
+    assert (
+        'rengabot_change_outcomes_total{outcome="ok",platform="slack",workspace="T1"} 1'
+        in text
+    )
+
+
+def test_service_records_phases_and_outcomes(registry, tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    svc = GameService(DummyModel())
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    svc.model.valid = False
+    with pytest.raises(InvalidPromptError):
+        svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    labels = {"platform": "slack", "workspace": "T1"}
+    for phase in ("lock_wait", "validation", "generation", "save"):
+        assert registry.histogram(f"rengabot_{phase}_seconds", **labels).count >= 1
+    assert registry.counter("rengabot_change_outcomes_total", outcome="ok", **labels) == 1
+    assert (
+        registry.counter("rengabot_change_outcomes_total", outcome="invalid_prompt", **labels)
+        == 1
+    )
+    assert "rengabot_image_cache_resident_bytes" in registry.render()
+
+
+def test_serve_exposes_metrics_endpoint(registry):
+    server = metrics.serve("127.0.0.1", 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        body = urllib.request.urlopen(url, timeout=5).read().decode()
+    finally:
+        server.shutdown()
+    assert "# TYPE rengabot_validation_seconds histogram" in body
@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pytest
+
+from game.service import GameService
+from telemetry import tracing
+
+
+class DummyModel:
+    def validate_prompt(self, prompt):
+        return (True, None)
+
+    def generate_image(self, prompt, image_path):
+        return b"img"
+
+
+@pytest.fixture
+def export_path(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracing.configure_export(str(path))
+    yield path
+    tracing.configure_export(None)
+
+
+def _spans(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_span_is_noop_outside_trace(export_path):
+    with tracing.span("orphan") as span:
+        assert span is None
+    assert tracing.current_trace_id() is None
+    assert export_path.read_text() == ""
+
+
+def test_spans_nest_and_export(export_path):
+    with tracing.start_trace("request", user_id="U1") as root:
+        with tracing.span("child"):
+            tracing.record_span("waited", 0.5)
+    assert tracing.current_trace_id() is None
+    spans = {s["name"]: s for s in _spans(export_path)}
+    assert spans["child"]["parent_id"] == root.span_id
+    assert spans["waited"]["duration"] == 0.5
+    assert {s["trace_id"] for s in spans.values()} == {root.trace_id}
+    assert spans["request"]["attrs"] == {"user_id": "U1"}
+
+
+def test_span_records_error(export_path):
+    with pytest.raises(ValueError):
+        with tracing.start_trace("request"):
+            raise ValueError("boom")
+    assert _spans(export_path)[0]["error"] == "ValueError"
+
+
+async def test_trace_follows_tasks_and_threads_through_service(
+    export_path, tmp_path, monkeypatch
+):
+    monkeypatch.setenv("UPLOADS_DIR", str(tmp_path))
+    svc = GameService(DummyModel())
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    with tracing.start_trace("slack.mention") as root:
+        task = asyncio.create_task(
+            svc.change_image_async("slack", "T1", "C1", "U2", "add a bird")
+        )
+    await task
+    spans = _spans(export_path)
+    names = {s["name"] for s in spans}
+    assert {"slack.mention", "service.change_image", "validate", "generate", "save"} <= names
+    assert {s["trace_id"] for s in spans} == {root.trace_id}
+
+
+def test_trace_follows_speculative_generation(export_path, tmp_path):
+    svc = GameService(DummyModel(), uploads_dir=str(tmp_path), speculative=True)
+    svc.save_image_bytes("slack", "T1", "C1", "U1", b"base")
+    with tracing.start_trace("slack.mention") as root:
+        svc.change_image("slack", "T1", "C1", "U2", "add a bird")
+    spans = _spans(export_path)
+    assert "generate" in {s["name"] for s in spans}
+    assert {s["trace_id"] for s in spans} == {root.trace_id}
+
+
+def test_trace_follows_batched_validation(export_path):
+    from model.batching import ValidationBatcher
+
+    def validate_one(prompt):
+        with tracing.span("validate_one"):
+            return (True, None)
+
+    batcher = ValidationBatcher(lambda prompts: [], validate_one, window=0.01)
+    with tracing.start_trace("request") as root:
+        assert batcher.validate("add a cat") == (True, None)
+    batcher.stop()
+    spans = {s["name"]: s for s in _spans(export_path)}
+    assert spans["validate_one"]["trace_id"] == root.trace_id
+    assert spans["validate_one"]["parent_id"] == root.span_id